@@ -0,0 +1,379 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Local cache of charms fetched from bzr branches and tarball URLs
+
+Each fetched charm is kept once, under a name derived from where it came
+from and which revision it is: the bzr revision id of a branch, or the
+ETag (or content hash) of a tarball. A charm whose revision has not
+changed is not fetched again, and with nothing reachable the last
+revision fetched is used, so a cache directory copied from another host
+works offline.
+
+    cache = charm_cache(config)
+    cache.install(cache.bzr_branch('lp:charms/trusty/keystone'), dest)
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+import requests
+
+from cloudinstall.placement.autosave import write_atomic
+
+log = logging.getLogger('cloudinstall.charm_cache')
+
+DEFAULT_MAX_MB = 512
+INDEX_FILENAME = 'index.json'
+DIGEST_SUFFIX = '.cache-digest'
+
+
+class CharmCacheError(Exception):
+
+    "A charm that could be neither fetched nor found in the cache"
+
+
+def _tree_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fname in filenames:
+            fpath = os.path.join(dirpath, fname)
+            if not os.path.islink(fpath):
+                size += os.path.getsize(fpath)
+    return size
+
+
+def _digest(source, revision):
+    key = '{}\0{}'.format(source, revision)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _check_members(tar):
+    for member in tar.getmembers():
+        name = os.path.normpath(member.name)
+        if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+            raise CharmCacheError("Unsafe path in tarball: "
+                                  "{}".format(member.name))
+
+
+class CharmCache:
+
+    """ Charm trees under cache_dir/objects, with an index of which
+    revision of each source was fetched last and when each tree was last
+    used
+
+    Trees are extracted to a temporary directory and renamed into place,
+    so a tree in objects is always complete. Once the trees add up to
+    more than max_bytes, the least recently used are removed, except
+    those handed out by bzr_branch() or tarball() and not yet copied by
+    install() (or given back with release()).
+
+    With offline set, nothing is fetched; otherwise a failed fetch falls
+    back to the cached revision too.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, offline=False,
+                 timeout=60):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        self.max_bytes = max_bytes or DEFAULT_MAX_MB * 1024 * 1024
+        self.offline = offline
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._source_locks = {}
+        self._pins = {}
+        self.fetch_count = 0
+        self.hit_count = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('sources', {})
+        index.setdefault('objects', {})
+        return index
+
+    def _write_index(self):
+        write_atomic(self.index_path,
+                     json.dumps(self._index, indent=1, sort_keys=True))
+
+    def _source_lock(self, source):
+        with self._lock:
+            return self._source_locks.setdefault(source, threading.Lock())
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _lookup(self, source, revision=None):
+        """ Digest of the cached tree for source, at revision or the
+        last one fetched, or None """
+        if revision is not None:
+            digest = _digest(source, revision)
+        else:
+            with self._lock:
+                entry = self._index['sources'].get(source, None)
+            if entry is None:
+                return None
+            digest = entry['object']
+        if os.path.isdir(self.object_path(digest)):
+            return digest
+        return None
+
+    def _use(self, source, digest, hit=False, **entry):
+        """ Records digest as source's current tree, marks it used and
+        pins it until release() """
+        with self._lock:
+            if hit:
+                self.hit_count += 1
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+            sources = self._index['sources']
+            entry = dict(sources.get(source, {}), object=digest, **entry)
+            sources[source] = entry
+            obj = self._index['objects'].setdefault(digest, {})
+            obj['used'] = time.time()
+            if 'size' not in obj:
+                obj['size'] = _tree_size(self.object_path(digest))
+            self._prune(keep=digest)
+            self._write_index()
+        return self.object_path(digest)
+
+    def _add(self, digest, fill):
+        """ Runs fill(tmpdir) and moves what it left in tmpdir to
+        objects/digest """
+        tmpdir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.fetch-')
+        try:
+            tree = fill(tmpdir)
+            try:
+                os.rename(tree, self.object_path(digest))
+            except OSError:
+                # fetched at the same time by another installer
+                if not os.path.isdir(self.object_path(digest)):
+                    raise
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        with self._lock:
+            self.fetch_count += 1
+
+    def _cached(self, source, reason):
+        digest = self._lookup(source)
+        if digest is None:
+            raise CharmCacheError("{} is not cached, and "
+                                  "{}".format(source, reason))
+        log.info("Using cached {}: {}".format(source, reason))
+        return self._use(source, digest, hit=True)
+
+    def bzr_branch(self, branch_name):
+        """ Tree of the latest revision of a bzr branch
+
+        :param str branch_name: eg. lp:~openstack-charmers/charms/trusty/ntp
+        :returns: path of the cached tree
+        :raises CharmCacheError: if the branch can't be reached and is not
+                                 cached
+        """
+        with self._source_lock(branch_name):
+            if self.offline:
+                return self._cached(branch_name, "working offline")
+            try:
+                out = subprocess.check_output(
+                    ['bzr', 'revision-info', '-d', branch_name],
+                    stderr=subprocess.STDOUT, timeout=self.timeout)
+                revid = out.decode('utf-8').split()[-1]
+            except (OSError, subprocess.SubprocessError, IndexError) as e:
+                log.warning("Can't get revision of {}: {}".format(
+                    branch_name, getattr(e, 'output', e)))
+                return self._cached(branch_name, "the branch is unreachable")
+
+            digest = self._lookup(branch_name, revid)
+            if digest is not None:
+                return self._use(branch_name, digest, hit=True,
+                                 revision=revid)
+
+            def export(tmpdir):
+                tree = os.path.join(tmpdir, 'tree')
+                try:
+                    subprocess.check_output(
+                        ['bzr', 'export', '-r', 'revid:' + revid,
+                         tree, branch_name], stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    log.warning("error exporting charm: "
+                                "rc={} out={}".format(e.returncode,
+                                                      e.output))
+                    raise CharmCacheError("Could not export "
+                                          "{}".format(branch_name))
+                return tree
+
+            digest = _digest(branch_name, revid)
+            self._add(digest, export)
+            return self._use(branch_name, digest, revision=revid)
+
+    def tarball(self, url):
+        """ Tree from a tarball holding one top-level directory, such as
+        a GitHub tarball
+
+        The request carries the ETag of the cached copy, so an unchanged
+        tarball is not downloaded again.
+
+        :returns: path of the cached tree
+        :raises CharmCacheError: if the url can't be fetched and is not
+                                 cached
+        """
+        with self._source_lock(url):
+            if self.offline:
+                return self._cached(url, "working offline")
+            headers = {}
+            with self._lock:
+                entry = self._index['sources'].get(url, None)
+            if entry is not None and entry.get('etag', None) and \
+               self._lookup(url) is not None:
+                headers['If-None-Match'] = entry['etag']
+            try:
+                r = requests.get(url, headers=headers, verify=True,
+                                 timeout=self.timeout)
+                if r.status_code == 304:
+                    return self._use(url, entry['object'], hit=True)
+                r.raise_for_status()
+            except requests.RequestException as e:
+                log.warning("Can't download {}: {}".format(url, e))
+                return self._cached(url, "it can't be downloaded")
+
+            etag = r.headers.get('ETag', None)
+            revision = etag or hashlib.sha256(r.content).hexdigest()
+            digest = self._lookup(url, revision)
+            if digest is not None:
+                return self._use(url, digest, hit=True, revision=revision,
+                                 etag=etag)
+
+            def extract(tmpdir):
+                tarball_name = os.path.join(tmpdir, 'charm.tar.gz')
+                with open(tarball_name, mode='wb') as f:
+                    f.write(r.content)
+                tree = os.path.join(tmpdir, 'tree')
+                with tarfile.open(tarball_name) as tar:
+                    _check_members(tar)
+                    tar.extractall(tree)
+                tops = os.listdir(tree)
+                if len(tops) != 1:
+                    raise CharmCacheError("Expected one directory in {}, "
+                                          "got {}".format(url, tops))
+                return os.path.join(tree, tops[0])
+
+            digest = _digest(url, revision)
+            self._add(digest, extract)
+            return self._use(url, digest, revision=revision, etag=etag)
+
+    def release(self, tree):
+        """ Lets tree, as returned by bzr_branch() or tarball(), be pruned
+        again """
+        digest = os.path.basename(tree)
+        with self._lock:
+            n = self._pins.get(digest, 0) - 1
+            if n > 0:
+                self._pins[digest] = n
+            else:
+                self._pins.pop(digest, None)
+
+    def install(self, tree, dest):
+        """ Puts a copy of a cached tree at dest, replacing what was there,
+        unless dest already is a copy of it, and then releases tree
+
+        :param tree: path returned by bzr_branch() or tarball()
+        :param dest: e.g. local-charms/trusty/keystone
+        """
+        try:
+            return self._install(tree, dest)
+        finally:
+            self.release(tree)
+
+    def _install(self, tree, dest):
+        digest = os.path.basename(tree)
+        marker = dest + DIGEST_SUFFIX
+        try:
+            with open(marker) as f:
+                if f.read() == digest and os.path.isdir(dest):
+                    log.debug("{} is up to date".format(dest))
+                    return dest
+        except OSError:
+            pass
+
+        parent = os.path.dirname(dest)
+        os.makedirs(parent, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=parent, prefix='.install-')
+        try:
+            new = os.path.join(tmpdir, 'new')
+            shutil.copytree(tree, new, symlinks=True)
+            if os.path.lexists(dest):
+                os.rename(dest, os.path.join(tmpdir, 'old'))
+            os.rename(new, dest)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        write_atomic(marker, digest)
+        return dest
+
+    def _prune(self, keep=None):
+        objects = self._index['objects']
+        total = sum(obj.get('size', 0) for obj in objects.values())
+        for digest in sorted(objects, key=lambda d: objects[d]['used']):
+            if total <= self.max_bytes:
+                break
+            if digest == keep or digest in self._pins:
+                continue
+            log.debug("Pruning cached charm {}".format(digest))
+            shutil.rmtree(self.object_path(digest), ignore_errors=True)
+            total -= objects.pop(digest).get('size', 0)
+
+    def prune(self):
+        """ Removes least recently used trees until they fit max_bytes """
+        with self._lock:
+            self._prune()
+            self._write_index()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def charm_cache(config):
+    """ The shared CharmCache for a config
+
+    Uses the charm_cache_dir, charm_cache_max_mb and charm_cache_offline
+    options, with the cache in charm-cache under the config directory by
+    default.
+
+    :rtype: :class:`CharmCache`
+    """
+    cache_dir = config.getopt('charm_cache_dir') or \
+        os.path.join(config.cfg_path, 'charm-cache')
+    max_mb = config.getopt('charm_cache_max_mb') or DEFAULT_MAX_MB
+    with _caches_lock:
+        cache = _caches.get(cache_dir, None)
+        if cache is None:
+            cache = _caches[cache_dir] = CharmCache(
+                cache_dir, max_bytes=int(max_mb) * 1024 * 1024)
+    cache.offline = bool(config.getopt('charm_cache_offline'))
+    return cache
@@ -0,0 +1,147 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Process-wide registry of charm classes
+
+utils.load_charms() scans the charms package, imports any plugin
+charms and reads the openstack_release file every time it is called.
+The registry calls it once, and again only when the plugin directory
+or the release file has changed.
+
+    registry = charm_registry(config.getopt('charm_plugin_dir'))
+    registry.get('keystone')
+"""
+
+import logging
+import os
+import threading
+import time
+
+from cloudinstall import utils
+
+log = logging.getLogger('cloudinstall.charm_registry')
+
+
+def release_path():
+    """ Path of the file naming the OpenStack release to install """
+    return os.path.join(utils.install_home(),
+                        '.cloud-install/openstack_release')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class CharmRegistry:
+
+    """ The charm modules utils.load_charms() finds, indexed
+
+    The plugin charms directory and the release file are checked at
+    most every check_interval seconds; when either has changed, the
+    charms are loaded again. invalidate() forces that on next use.
+    """
+
+    def __init__(self, ext_charm_path=None, check_interval=2):
+        """ :param ext_charm_path: plugin directory, as for
+                                   utils.load_charms()
+        """
+        self.ext_charm_path = ext_charm_path or None
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._checked = 0
+        self.modules = []
+        self.charm_classes = []
+        self.by_name = {}
+        self.enabled = []
+        self.core = []
+        self.subordinate = []
+        self.isolated = []
+        self.load_count = 0
+
+    def _current_stamp(self):
+        plugin_mtime = None
+        if self.ext_charm_path:
+            plugin_mtime = _mtime(os.path.join(self.ext_charm_path,
+                                               'charms'))
+        return (plugin_mtime, _mtime(release_path()))
+
+    def refresh(self):
+        """ Loads the charms if they have not been, or may have changed
+
+        :returns: self
+        """
+        with self._lock:
+            now = time.time()
+            if self._stamp is not None and \
+               now - self._checked < self.check_interval:
+                return self
+            self._checked = now
+            stamp = self._current_stamp()
+            if stamp != self._stamp:
+                self._load()
+                self._stamp = stamp
+        return self
+
+    def invalidate(self):
+        """ Reloads the charms on next use """
+        with self._lock:
+            self._stamp = None
+
+    def _load(self):
+        self.modules = utils.load_charms(self.ext_charm_path)
+        self.charm_classes = [m.__charm_class__ for m in self.modules]
+        self.by_name = {cc.name(): cc for cc in self.charm_classes}
+        self.enabled = [cc for cc in self.charm_classes if not cc.disabled]
+        self.core = [cc for cc in self.enabled
+                     if not (cc.subordinate or cc.isolate)]
+        self.subordinate = [cc for cc in self.enabled if cc.subordinate]
+        self.isolated = [cc for cc in self.enabled if cc.isolate]
+        self.load_count += 1
+        log.debug("Loaded {} charms".format(len(self.charm_classes)))
+
+    def get(self, charm_name):
+        """ Charm class by charm name, or None
+
+        :rtype: :class:`~cloudinstall.charms.CharmBase` subclass
+        """
+        return self.refresh().by_name.get(charm_name, None)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def charm_registry(ext_charm_path=None):
+    """ The shared, refreshed CharmRegistry for a plugin directory
+
+    Lists on the registry (charm_classes, enabled, core, subordinate,
+    isolated) are shared and must not be modified.
+
+    :param ext_charm_path: plugin directory, or None for the installer's
+                           own charms
+    :rtype: :class:`CharmRegistry`
+    """
+    ext_charm_path = ext_charm_path or None
+    with _registries_lock:
+        registry = _registries.get(ext_charm_path, None)
+        if registry is None:
+            registry = _registries[ext_charm_path] = \
+                CharmRegistry(ext_charm_path)
+    return registry.refresh()
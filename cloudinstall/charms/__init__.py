@@ -16,36 +16,134 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import Counter
+from functools import partial
 import logging
 from os import path
 import os
 import sys
+import threading
 import yaml
-from queue import Queue
 import subprocess
-import time
 import requests
 
-from macumba import MacumbaError, ServerError
-from cloudinstall import utils
+from macumba import MacumbaError
+from cloudinstall import tracer, utils
+from cloudinstall.charm_cache import charm_cache, CharmCacheError
+from cloudinstall.charm_registry import charm_registry
+from cloudinstall.post_proc_scheduler import PostProcScheduler
+from cloudinstall.relation_engine import is_related, RelationEngine
 from cloudinstall.placement.controller import AssignmentType
+from cloudinstall.service import Service
 
 log = logging.getLogger('cloudinstall.charms')
 
 CHARM_CONFIG_FILENAME = path.expanduser("~/.cloud-install/charmconf.yaml")
 
 
+class CharmConfigCache:
+
+    """ The charm config file, parsed once and again only when its
+    mtime or size changes
+
+    Each charm's section is also kept serialised on its own, as the
+    config_yaml for deploying that charm, and written to a file of its
+    own on request for `juju deploy --config`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.section_dir = path.join(path.dirname(filename), 'charmconf.d')
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._config = {}
+        self._raw = None
+        self._sections = {}
+        self._section_files = {}
+        self.load_count = 0
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.filename)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp and self.load_count > 0:
+            return
+        self._config = {}
+        self._raw = None
+        if stamp is not None:
+            with open(self.filename) as f:
+                self._raw = f.read()
+            self._config = yaml.load(self._raw) or {}
+        self._stamp = stamp
+        self._sections = {}
+        self.load_count += 1
+
+    def get(self):
+        """ Charm config as python dict and raw yaml, as get_charm_config()
+        """
+        with self._lock:
+            self._refresh()
+            return self._config, self._raw
+
+    def section(self, charm_name):
+        """ {charm_name: options} as yaml, or "" if the file has no
+        section for charm_name
+        """
+        with self._lock:
+            self._refresh()
+            if charm_name not in self._sections:
+                if charm_name in self._config:
+                    self._sections[charm_name] = yaml.safe_dump(
+                        {charm_name: self._config[charm_name]},
+                        default_flow_style=False)
+                else:
+                    self._sections[charm_name] = ""
+            return self._sections[charm_name]
+
+    def section_file(self, charm_name):
+        """ Path of a file holding only section(charm_name), or None if
+        there is no such section
+        """
+        section = self.section(charm_name)
+        if section == "":
+            return None
+        with self._lock:
+            fname = path.join(self.section_dir, charm_name + '.yaml')
+            if self._section_files.get(charm_name, None) != section or \
+               not path.exists(fname):
+                os.makedirs(self.section_dir, exist_ok=True)
+                utils.spew(fname, section)
+                self._section_files[charm_name] = section
+            return fname
+
+
+_charm_config_cache = CharmConfigCache(CHARM_CONFIG_FILENAME)
+
+
 def get_charm_config():
     """Returns charm config as python dict and raw yaml, if the file exists.
     Returns {}, None if the file does not exist.
+
+    The file is parsed again only once it has changed, and the dict is
+    shared: do not modify it.
     """
-    charm_config = {}
-    charm_config_raw = None
-    if path.exists(CHARM_CONFIG_FILENAME):
-        with open(CHARM_CONFIG_FILENAME) as f:
-            charm_config_raw = f.read()
-            charm_config = yaml.load(charm_config_raw)
-    return charm_config, charm_config_raw
+    return _charm_config_cache.get()
+
+
+def get_charm_config_section(charm_name):
+    """Returns the charm config for charm_name alone, as yaml suitable
+    for deploying it, or "" if there is none.
+    """
+    return _charm_config_cache.section(charm_name)
+
+
+def get_charm_config_file(charm_name):
+    """Returns the path of a config file for `juju deploy --config` with
+    only charm_name's section, or None if there is none.
+    """
+    return _charm_config_cache.section_file(charm_name)
 
 
 def query_cs(charm, series='trusty'):
@@ -79,13 +177,32 @@ def get_charm(charm_name, juju, juju_state, ui, config):
     :rtype: Charm
     :returns: charm class
     """
-    for charm in utils.load_charms():
-        c = charm.__charm_class__(juju=juju,
-                                  juju_state=juju_state,
-                                  ui=ui,
-                                  config=config)
-        if charm_name == c.name():
-            return c
+    charm_class = charm_registry().get(charm_name)
+    if charm_class is None:
+        return None
+    return charm_class(juju=juju,
+                       juju_state=juju_state,
+                       ui=ui,
+                       config=config)
+
+
+def _placement_directive(machine_spec):
+    """ Juju API placement for a machine spec such as '3' or 'lxc:3' """
+    if ':' in machine_spec:
+        scope, directive = machine_spec.split(':', 1)
+    else:
+        # juju's scope for an existing machine
+        scope, directive = '#', machine_spec
+    return dict(Scope=scope, Directive=directive)
+
+
+def _machine_spec_of(machine_id):
+    """ Machine spec a unit on machine_id was placed with, eg. 'lxc:3'
+    for '3/lxc/1' """
+    if '/' in machine_id:
+        host, scope, _ = machine_id.rsplit('/', 2)
+        return '{}:{}'.format(scope, host)
+    return machine_id
 
 
 class CharmBase:
@@ -125,6 +242,8 @@ class CharmBase:
         self.juju_state = juju_state
         self.ui = ui
         self.config = config
+        # set by CharmQueue, see relations_set()
+        self.relation_engine = None
 
     def _openstack_env(self, user, password, tenant, auth_url):
         """ setup openstack environment vars """
@@ -206,14 +325,10 @@ export OS_REGION_NAME=RegionOne
         Note that the False (no-error) return value does not indicate
         that service is up and running.
         """
-        config_yaml = ""
-
         _charm_name_rev = self.charm_name
 
-        charm_config, charm_config_raw = get_charm_config()
-        log.debug("charm_config = {} ".format(charm_config))
-        if self.charm_name in charm_config:
-            config_yaml = charm_config_raw
+        config_yaml = get_charm_config_section(self.charm_name)
+        log.debug("charm_config = {} ".format(config_yaml))
 
         # Set revision
         if self.charm_rev:
@@ -269,14 +384,11 @@ export OS_REGION_NAME=RegionOne
         localrepo = os.path.join(self.config.cfg_path,
                                  'local-charms',
                                  series, self.charm_name)
-        os.makedirs(localrepo, exist_ok=True)
+        cache = charm_cache(self.config)
         try:
-            subprocess.check_output(['bzr', 'co', '--lightweight',
-                                     branch_name, localrepo])
-        except Exception as e:
-            log.warning("error checking out charm: "
-                        "rc={} out={}".format(e.returncode,
-                                              e.output))
+            cache.install(cache.bzr_branch(branch_name), localrepo)
+        except CharmCacheError as e:
+            log.warning("error checking out charm: {}".format(e))
             raise e
 
     def local_deploy(self, mspec, series="trusty"):
@@ -298,9 +410,9 @@ export OS_REGION_NAME=RegionOne
         if not self.subordinate:
             cmd += ' --to ' + mspec
 
-        charm_config, _ = get_charm_config()
-        if self.charm_name in charm_config:
-            cmd += ' --config ' + CHARM_CONFIG_FILENAME
+        config_file = get_charm_config_file(self.charm_name)
+        if config_file is not None:
+            cmd += ' --config ' + config_file
 
         try:
             infostr = ("Deploying {} from local: {}".format(self.charm_name,
@@ -330,6 +442,75 @@ export OS_REGION_NAME=RegionOne
             return True
         return False
 
+    def add_units(self, machine_specs, existing=()):
+        """Add one unit of an already-deployed service onto each of
+        machine_specs, in a single AddServiceUnits request with a
+        placement directive per unit.
+
+        Returns the positions in machine_specs of the units that were
+        not added. Juju adds units in order and stops at the first
+        failure, so those are the failed unit and everything after it.
+        The error does not say how far juju got, so on errors that is
+        counted from the units in a FullStatus fetched from juju: a spec
+        is added if the service has a unit there that no earlier spec,
+        nor existing, accounts for. Units with no machine spec can't be
+        told apart, and count as failed.
+
+        :param existing: machine specs of units the service had before,
+                         that may share a spec with machine_specs
+        """
+        if len(machine_specs) == 0:
+            return []
+
+        # units with no machine spec go wherever juju likes, after the
+        # placed ones
+        order = sorted(range(len(machine_specs)),
+                       key=lambda i: machine_specs[i] == '')
+        placement = [_placement_directive(machine_specs[i]) for i in order
+                     if machine_specs[i] != '']
+        params = dict(ServiceName=self.charm_name,
+                      NumUnits=len(machine_specs))
+        if len(placement) > 0:
+            params['Placement'] = placement
+
+        try:
+            self.juju.call(dict(Type="Client",
+                                Request="AddServiceUnits",
+                                Params=params))
+        except MacumbaError:
+            log.exception("Error adding units of {}".format(
+                self.charm_name))
+            try:
+                placements = self.unit_placements()
+            except MacumbaError:
+                log.exception("Can't tell which units of {} were "
+                              "added".format(self.charm_name))
+                return list(range(len(machine_specs)))
+            placements.subtract(existing)
+            n_added = 0
+            for i in order:
+                if placements[machine_specs[i]] <= 0:
+                    break
+                placements[machine_specs[i]] -= 1
+                n_added += 1
+            log.info("Added {} of {} units of {}".format(
+                n_added, len(machine_specs), self.charm_name))
+            return sorted(order[n_added:])
+        return []
+
+    def unit_placements(self):
+        """ Machine specs of this service's units, from a FullStatus
+        fetched from juju rather than a cached or watched status, which
+        may lag behind
+
+        :returns: {machine spec: number of units}
+        :rtype: Counter
+        """
+        status = self.juju.status() or {}
+        services = status.get('Services', None) or {}
+        svc = Service(self.charm_name, services.get(self.charm_name, {}))
+        return Counter(_machine_spec_of(u.machine_id) for u in svc.units)
+
     def post_proc(self):
         """ Perform any post processing
 
@@ -339,6 +520,41 @@ export OS_REGION_NAME=RegionOne
         """
         pass
 
+    def relations_set(self):
+        """ Are this charm's relations to deployed services in the
+        juju status?
+
+        Relations the relation engine gave up adding count as set, so
+        that post_proc() still runs without them.
+
+        :rtype: bool
+        """
+        for relation_a, relation_b in self.related:
+            names = [r.split(':')[0] for r in (relation_a, relation_b)]
+            if not all(self.juju_state.service(n).service for n in names):
+                continue
+            if self.relation_engine is not None and \
+               self.relation_engine.gave_up(relation_a, relation_b):
+                continue
+            if not is_related(self.juju_state, relation_a, relation_b):
+                return False
+        return True
+
+    def post_proc_ready(self):
+        """ Can post_proc() run yet?
+
+        Checked against the cached juju status before each post_proc().
+        By default, once a unit of the service is started and its
+        relations are set. Override where post_proc() needs more, or less.
+
+        :rtype: bool
+        """
+        if not self.subordinate:
+            units = self.juju_state.service(self.charm_name).units
+            if not any(u.agent_state == 'started' for u in units):
+                return False
+        return self.relations_set()
+
     def __repr__(self):
         return self.name()
 
@@ -350,12 +566,15 @@ class CharmQueue:
 
     def __init__(self, ui, config, juju_state=None, juju=None,
                  deployed_charms=None):
-        self.charm_post_proc_q = Queue()
         self.is_running = False
+        self.post_proc_scheduler = None
+        self.deploy_complete = threading.Condition()
+        self.is_deploy_complete = False
         self.ui = ui
         self.config = config
         self.juju = juju
         self.juju_state = juju_state
+        self.relation_engine = None
         if deployed_charms is None:
             self.deployed_charms = []
         else:
@@ -397,33 +616,43 @@ class CharmQueue:
 
         return valid_relations
 
-    @utils.async
+    def start_relations(self):
+        """ Starts adding the relations between deployed charms that are
+        not set yet, and returns at once
+
+        :returns: the :class:`~cloudinstall.relation_engine.RelationEngine`
+                  adding them
+        """
+        valid_relations = self.filter_valid_relations()
+        log.debug("Processing relations: {}".format(valid_relations))
+        self.relation_engine = RelationEngine(self.juju, self.juju_state)
+        futures = self.relation_engine.start(valid_relations)
+        for (relation_a, relation_b), f in futures.items():
+            f.add_done_callback(partial(self._relation_done,
+                                        relation_a, relation_b))
+        return self.relation_engine
+
+    def _relation_done(self, relation_a, relation_b, future):
+        e = future.exception()
+        if e is None:
+            return
+        msg = 'Failure in add_relation({}, {}): {}'.format(
+            relation_a, relation_b, e)
+        log.error(msg)
+        self.ui.status_info_message(msg)
+
     def watch_relations_async(self):
-        self.watch_relations()
+        """ Setup charm relations in the background """
+        return self.start_relations()
 
     def watch_relations(self):
         """ Setup charm relations
+
+        Raises the first error a relation failed with.
         """
-        valid_relations = self.filter_valid_relations()
-        completed_relations = []
-        if len(valid_relations) <= 0:
-            return
-        log.debug("Processing relations: {}".format(valid_relations))
-        while len(valid_relations) != len(completed_relations):
-            for relation_a, relation_b in valid_relations:
-                try:
-                    self.juju.add_relation(relation_a,
-                                           relation_b)
-                    completed_relations.append((relation_a,
-                                                relation_b))
-                except ServerError as e:
-                    msg = ('Failure in add_relation({}, {}): {}'.format(
-                        relation_a,
-                        relation_b,
-                        e))
-                    log.exception(msg)
-                    self.ui.status_info_message(msg)
-                    raise e
+        failures = self.start_relations().wait()
+        for e in failures.values():
+            raise e
 
     def _charm_classes(self):
         """ Returns instances of deployed charms """
@@ -434,6 +663,7 @@ class CharmQueue:
                               self.juju_state,
                               self.ui,
                               config=self.config)
+            charm.relation_engine = self.relation_engine
             charms.append(charm)
         return charms
 
@@ -442,20 +672,35 @@ class CharmQueue:
         self.watch_post_proc()
 
     def watch_post_proc(self):
-        for charm in self._charm_classes():
-            self.charm_post_proc_q.put(charm)
-
-        log.debug("Starting charm post processing watcher.")
-        while not self.charm_post_proc_q.empty():
-            try:
-                charm = self.charm_post_proc_q.get()
-                err = charm.post_proc()
-                if err:
-                    self.charm_post_proc_q.put(charm)
-                self.charm_post_proc_q.task_done()
-            except:
-                msg = "Exception in post-processing watcher, re-trying."
-                log.exception(msg)
-                self.ui.status_error_message(msg)
-            time.sleep(10)
+        """ Runs post_proc() of every deployed charm that has one, as each
+        becomes ready, several at a time. Returns once all have succeeded
+        and deploy_complete is set.
+        """
+        charms = [c for c in self._charm_classes()
+                  if type(c).post_proc is not CharmBase.post_proc]
+        log.debug("Starting charm post processing: {}".format(charms))
+        self.post_proc_scheduler = PostProcScheduler(
+            charms, on_error=self._post_proc_error)
+        self.post_proc_scheduler.run()
+        if not self.post_proc_scheduler.is_complete():
+            return
         self.config.setopt('deploy_complete', True)
+        with self.deploy_complete:
+            self.is_deploy_complete = True
+            self.deploy_complete.notify_all()
+        trace = tracer.get_tracer()
+        if trace is not None and trace.path:
+            trace.write()
+
+    def _post_proc_error(self, charm, e):
+        self.ui.status_error_message("Exception in post-processing "
+                                     "{}, re-trying.".format(charm))
+
+    def wait_deploy_complete(self, timeout=None):
+        """ Blocks until every charm's post processing is done
+
+        :returns: True if it is, False on timeout
+        """
+        with self.deploy_complete:
+            return self.deploy_complete.wait_for(
+                lambda: self.is_deploy_complete, timeout)
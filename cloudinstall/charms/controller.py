@@ -41,6 +41,13 @@ class CharmNovaCloudController(CharmBase):
     is_core = True
     have_nextbranch = True
 
+    def post_proc_ready(self):
+        """ also waits for keystone's address """
+        if not super().post_proc_ready():
+            return False
+        units = self.juju_state.service('keystone').units
+        return len(units) > 0 and units[0].public_address is not None
+
     def post_proc(self):
         """ post processing for nova-cloud-controller """
         svc = self.juju_state.service(self.charm_name)
@@ -52,40 +59,28 @@ class CharmNovaCloudController(CharmBase):
         if unit.machine_id == '-1':
             return True
 
+        session = utils.RemoteSession(
+            unit.machine_id,
+            juju_home=self.config.juju_home(use_expansion=True),
+            stop_on_error=True)
         for u in ['admin', 'ubuntu']:
             env = self._openstack_env(u,
                                       openstack_password,
                                       u, keystone.public_address)
             self._openstack_env_save(u, env)
-            utils.remote_cp(
-                unit.machine_id,
-                src=self._openstack_env_path(u),
-                dst='/tmp/openstack-{u}-rc'.format(u=u),
-                juju_home=self.config.juju_home(use_expansion=True))
+            session.put(self._openstack_env_path(u),
+                        '/tmp/openstack-{u}-rc'.format(u=u))
 
         setup_script_path = self.render_setup_script()
         remote_setup_script_path = "/tmp/nova-controller-setup.sh"
-        utils.remote_cp(
-            unit.machine_id,
-            src=setup_script_path,
-            dst=remote_setup_script_path,
-            juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(
-            unit.machine_id,
-            cmds="chmod +x {}".format(remote_setup_script_path),
-            juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_cp(
-            unit.machine_id,
-            src=utils.ssh_pubkey(),
-            dst="/tmp/id_rsa.pub",
-            juju_home=self.config.juju_home(use_expansion=True))
-        err = utils.remote_run(
-            unit.machine_id,
-            cmds="/tmp/nova-controller-setup.sh "
-            "{p} {install_type}".format(
-                p=openstack_password,
-                install_type=self.config.getopt('install_type')),
-            juju_home=self.config.juju_home(use_expansion=True))
+        session.put(setup_script_path, remote_setup_script_path)
+        session.put(utils.ssh_pubkey(), "/tmp/id_rsa.pub")
+        session.run("chmod +x {}".format(remote_setup_script_path))
+        session.run("/tmp/nova-controller-setup.sh "
+                    "{p} {install_type}".format(
+                        p=openstack_password,
+                        install_type=self.config.getopt('install_type')))
+        err = session.execute()[-1]
         if err['status'] != 0:
             # something happened during nova setup, re-run
             return True
@@ -13,17 +13,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import glob
 import logging
 import os
 import platform
-import requests
-import shutil
 import subprocess
 
+from cloudinstall.charm_cache import charm_cache
 from cloudinstall.charms import (CharmBase, DisplayPriorities,
-                                 get_charm_config,
-                                 CHARM_CONFIG_FILENAME)
+                                 get_charm_config_file)
 
 CHARM_STABLE_URL = ("https://api.github.com/repos/Ubuntu-Solutions-Engineering"
                     "/glance-simplestreams-sync-charm/tarball/stable")
@@ -48,38 +45,10 @@ class CharmGlanceSimplestreamsSync(CharmBase):
     is_core = True
 
     def download_stable(self):
-        if not os.path.exists(CHARMS_DIR):
-            os.makedirs(CHARMS_DIR)
-
-        r = requests.get(CHARM_STABLE_URL, verify=True)
-        tarball_name = os.path.join(CHARMS_DIR, 'stable.tar.gz')
-        with open(tarball_name, mode='wb') as tarball:
-            tarball.write(r.content)
-
-        try:
-            subprocess.check_output(['tar', '-C', CHARMS_DIR, '-zxf',
-                                     tarball_name], stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            log.warning("error untarring: rc={} out={}".format(e.returncode,
-                                                               e.output))
-            raise e
-
-        # filename includes commit hash at end:
-        srcpat = os.path.join(CHARMS_DIR,
-                              'Ubuntu-Solutions-Engineering-'
-                              'glance-simplestreams-sync-charm-*')
-        srcs = glob.glob(srcpat)
-        if len(srcs) != 1:
-            log.warning("error finding downloaded stable charm."
-                        " got {}".format(srcs))
-            raise Exception("Could not find downloaded stable charm.")
-
-        src = srcs[0]
+        cache = charm_cache(self.config)
         dest = os.path.join(CHARMS_DIR, CURRENT_DISTRO,
                             'glance-simplestreams-sync')
-        if os.path.exists(dest):
-            shutil.rmtree(dest)
-        os.renames(src, dest)
+        cache.install(cache.tarball(CHARM_STABLE_URL), dest)
 
     def deploy(self, mspec):
         """Temporary override to get local copy of charm."""
@@ -105,9 +74,9 @@ class CharmGlanceSimplestreamsSync(CharmBase):
                ' --constraints {constraints} '
                '--to {mspec}').format(juju_home=juju_home, **kwds)
 
-        charm_config, _ = get_charm_config()
-        if self.charm_name in charm_config:
-            cmd += ' --config ' + CHARM_CONFIG_FILENAME
+        config_file = get_charm_config_file(self.charm_name)
+        if config_file is not None:
+            cmd += ' --config ' + config_file
 
         try:
             log.debug("Deploying {} from local: {}".format(self.charm_name,
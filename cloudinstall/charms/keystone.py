@@ -44,6 +44,11 @@ class CharmKeystone(CharmBase):
                 return True
         return False
 
+    def post_proc_ready(self):
+        """ keystone's address is all post_proc needs """
+        units = self.juju_state.service('keystone').units
+        return len(units) > 0 and units[0].public_address is not None
+
     def post_proc(self):
         if self._is_auth_url_valid():
             return False
@@ -55,20 +55,15 @@ class CharmQuantum(CharmBase):
 
         self.ui.status_info_message("Validating network parameters "
                                     "for Neutron")
-        utils.remote_cp(
+        session = utils.RemoteSession(
             unit.machine_id,
-            src=os.path.join(self.config.tmpl_path, "quantum-network.sh"),
-            dst="/tmp/quantum-network.sh",
-            juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(
-            unit.machine_id,
-            cmds="sudo chmod +x /tmp/quantum-network.sh",
-            juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(
-            unit.machine_id,
-            cmds="sudo /tmp/quantum-network.sh {}".format(
-                self.config.getopt('install_type')),
             juju_home=self.config.juju_home(use_expansion=True))
+        session.put(os.path.join(self.config.tmpl_path, "quantum-network.sh"),
+                    "/tmp/quantum-network.sh")
+        session.run("sudo chmod +x /tmp/quantum-network.sh")
+        session.run("sudo /tmp/quantum-network.sh {}".format(
+            self.config.getopt('install_type')))
+        session.execute()
         return False
 
 
@@ -47,6 +47,12 @@ class CharmSwift(CharmBase):
             num_replicas = self.default_replicas
         return num_replicas
 
+    def post_proc_ready(self):
+        """ waits for glance-simplestreams-sync, which post_proc
+        configures """
+        svc = self.juju_state.service('glance-simplestreams-sync')
+        return len(svc.units) > 0
+
     def post_proc(self):
         self.juju.set_config('glance-simplestreams-sync',
                              {'use_swift': 'True'})
@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import threading
 import time
 import random
 import sys
@@ -23,12 +24,17 @@ from os import path, getenv
 
 from operator import attrgetter
 
-from cloudinstall import utils
+from cloudinstall import tracer, utils
+from cloudinstall.charm_registry import charm_registry
 from cloudinstall.state import ControllerState
-from cloudinstall.juju import JujuState
-from cloudinstall.maas import (connect_to_maas, FakeMaasState,
+from cloudinstall.events import StatusEventStream, EventType
+from cloudinstall.juju import JujuState, JujuWatcherState
+from cloudinstall.maas import (connect_to_maas, FakeMaasState, MaasState,
                                MaasMachineStatus)
+from cloudinstall.replay import (recorder_from_env, replay_from_env,
+                                 ReplayJujuClient, ReplayMaasClient)
 from cloudinstall.charms import CharmQueue
+from cloudinstall.deploy_scheduler import DeployScheduler
 from cloudinstall.log import PrettyLog
 from cloudinstall.placement.controller import (PlacementController,
                                                AssignmentType)
@@ -43,13 +49,19 @@ sys.excepthook = utils.global_exchandler
 
 class FakeJujuState:
 
+    def __init__(self):
+        self.events = StatusEventStream()
+
     @property
     def services(self):
         return []
 
-    def machines(self):
+    def machines(self, max_age=None):
         return []
 
+    def snapshot(self, max_age=None):
+        return None
+
     def invalidate_status_cache(self):
         "does nothing"
 
@@ -71,7 +83,11 @@ class Controller:
         self.juju_m_idmap = None  # for single, {instance_id: machine id}
         self.deployed_charm_classes = []
         self.placement_controller = None
+        # deploys run concurrently; see deploy_using_placement()
+        self.placement_lock = threading.Lock()
+        self._nodes_snapshot = None
         self.config.setopt('current_state', ControllerState.INSTALL_WAIT.value)
+        tracer.tracer_from_env()
 
     def update(self, *args, **kwargs):
         """Render UI according to current state and reset timer
@@ -108,15 +124,33 @@ class Controller:
         """
         if not self.juju_state:
             return
-        deployed_services = sorted(self.juju_state.services,
-                                   key=attrgetter('service_name'))
+
+        # charms and URLs only change along with juju status. Not every
+        # change is an event (eg. a new public address), so rebuild on
+        # every new status snapshot.
+        snapshot = self.juju_state.snapshot()
+        if snapshot is not self._nodes_snapshot:
+            self._nodes_snapshot = snapshot
+            deployed_services = sorted(self.juju_state.services,
+                                       key=attrgetter('service_name'))
+            self.update_nodes(deployed_services)
+
+        if len(self.nodes) == 0:
+            return
+        else:
+            self.ui.render_services_view(self.nodes, self.juju_state,
+                                         self.maas_state, self.config)
+
+    def update_nodes(self, deployed_services):
+        """ Matches deployed services with their charm classes, and picks
+        up the dashboard and juju-gui URLs
+        """
         deployed_service_names = [s.service_name for s in deployed_services]
 
+        registry = charm_registry(self.config.getopt('charm_plugin_dir'))
         charm_classes = sorted(
-            [m.__charm_class__ for m in
-             utils.load_charms(self.config.getopt('charm_plugin_dir'))
-             if m.__charm_class__.charm_name in
-             deployed_service_names],
+            [cc for cc in registry.charm_classes
+             if cc.charm_name in deployed_service_names],
             key=attrgetter('charm_name'))
 
         self.nodes = list(zip(charm_classes, deployed_services))
@@ -129,11 +163,12 @@ class Controller:
                         self.config.getopt('openstack_password'))
                 if u.is_jujugui and u.agent_state == "started":
                     self.ui.set_jujugui_url(u.public_address)
-        if len(self.nodes) == 0:
-            return
-        else:
-            self.ui.render_services_view(self.nodes, self.juju_state,
-                                         self.maas_state, self.config)
+
+    def log_unit_errors(self, events):
+        """ Status event subscriber, logs units as they fail """
+        for e in events:
+            log.error("Unit {} is in error: {}".format(
+                e.name, e.new.agent_state_info))
 
     def authenticate_juju(self):
         if not len(self.config.juju_env['state-servers']) > 0:
@@ -144,19 +179,35 @@ class Controller:
             url=path.join('wss://', state_server),
             password=self.config.juju_api_password)
         self.juju.login()
-        self.juju_state = JujuState(self.juju)
+        self.juju_state = JujuWatcherState(self.juju)
+        self.juju_state.events.subscribe(self.log_unit_errors,
+                                         [EventType.UNIT_ERROR])
+        self.juju_state.start()
         log.debug('Authenticated against juju api.')
 
     def initialize(self):
         """Authenticates against juju/maas and sets up placement controller."""
+        replay = replay_from_env()
         if getenv("FAKE_API_DATA"):
             self.juju_state = FakeJujuState()
             self.maas_state = FakeMaasState()
+        elif replay:
+            replay_path, clock = replay
+            self.juju = ReplayJujuClient(replay_path, clock)
+            self.juju_state = JujuState(self.juju)
+            if self.config.is_multi():
+                self.maas = ReplayMaasClient(replay_path, clock)
+                self.maas_state = MaasState(self.maas)
         else:
             self.authenticate_juju()
             if self.config.is_multi():
                 creds = self.config.getopt('maascreds')
                 self.maas, self.maas_state = connect_to_maas(creds)
+            recorder = recorder_from_env()
+            if recorder:
+                self.juju_state.recorder = recorder
+                if self.maas_state:
+                    self.maas_state.recorder = recorder
 
         self.placement_controller = PlacementController(
             self.maas_state, self.config)
@@ -255,34 +306,40 @@ class Controller:
         """
         self.begin_deployment()
 
+    @tracer.traced()
     def begin_deployment(self):
         if self.config.is_multi():
 
             # now all machines are added
-            self.maas.tag_fpi(self.maas.nodes)
-            self.maas.nodes_accept_all()
-            self.maas.tag_name(self.maas.nodes)
+            with tracer.span('tag and accept maas nodes'):
+                self.maas.tag_fpi(self.maas.nodes)
+                self.maas.nodes_accept_all()
+                self.maas.tag_name(self.maas.nodes)
 
-            while not self.all_maas_machines_ready():
-                time.sleep(3)
+            with tracer.span('wait for maas machines'):
+                while not self.all_maas_machines_ready():
+                    time.sleep(3)
+            # back to plain full listings
+            self.maas_state.watch([])
 
             self.add_machines_to_juju_multi()
 
         elif self.config.is_single():
             self.add_machines_to_juju_single()
 
-        # Quiet out some of the logging
-        _previous_summary = None
-        while not self.all_juju_machines_started():
-            sd = self.juju_state.machines_summary()
-            summary = ", ".join(["{} {}".format(v, k) for k, v
-                                 in sd.items()])
-            if summary != _previous_summary:
-                self.ui.status_info_message("Waiting for machines to "
-                                            "start: {}".format(summary))
-                _previous_summary = summary
+        # Only re-summarize when machine status has changed
+        generation = None
+        with tracer.span('wait for juju machines'):
+            while not self.all_juju_machines_started():
+                if generation != self.juju_state.events.generation:
+                    sd = self.juju_state.machines_summary()
+                    summary = ", ".join(["{} {}".format(v, k) for k, v
+                                         in sd.items()])
+                    self.ui.status_info_message("Waiting for machines to "
+                                                "start: {}".format(summary))
+                    generation = self.juju_state.events.generation
 
-            time.sleep(1)
+                self.juju_state.wait_for_events(generation, timeout=1)
 
         if len(self.juju_state.machines()) == 0:
             raise Exception("Expected some juju machines started.")
@@ -292,8 +349,7 @@ class Controller:
             controller_machine = self.juju_m_idmap['controller']
             self.configure_lxc_network(controller_machine)
 
-            for juju_machine_id in self.juju_m_idmap.values():
-                self.run_apt_go_fast(juju_machine_id)
+            self.run_apt_go_fast(list(self.juju_m_idmap.values()))
 
         if self.config.is_single():
             self.set_unique_hostnames()
@@ -302,6 +358,7 @@ class Controller:
         self.wait_for_deployed_services_ready()
         self.enqueue_deployed_charms()
 
+    @tracer.traced()
     def set_unique_hostnames(self):
         """checks for and ensures unique hostnames, so e.g. ceph can assume
         that.
@@ -309,6 +366,7 @@ class Controller:
         FIXME: Remove once http://pad.lv/1326091 is fixed
         """
         count = 0
+        sessions = []
         for machine in self.juju_state.machines():
             count += 1
             hostname = machine.machine.get('InstanceId',
@@ -316,21 +374,28 @@ class Controller:
 
             log.debug("Setting hostname of {} to {}".format(machine,
                                                             hostname))
-            juju_home = self.config.juju_home(use_expansion=True)
-            utils.remote_run(
-                machine.machine_id,
-                cmds="echo {} | sudo tee /etc/hostname".format(hostname),
-                juju_home=juju_home)
-            utils.remote_run(
+            session = utils.RemoteSession(
                 machine.machine_id,
-                cmds="sudo hostname {}".format(hostname),
-                juju_home=juju_home)
+                juju_home=self.config.juju_home(use_expansion=True))
+            session.run(["echo {} | sudo tee /etc/hostname".format(hostname),
+                         "sudo hostname {}".format(hostname)])
+            sessions.append(session)
+        report = utils.remote_fan_out(sessions)
+        failures = utils.remote_fan_out_failures(report)
+        for machine_id, reason in sorted(failures.items()):
+            log.error("Setting hostname of machine {} failed: "
+                      "{}".format(machine_id, reason))
+        if len(failures) > 0:
+            raise Exception("Could not set unique hostnames on machines "
+                            "{}".format(", ".join(sorted(failures))))
+        return report
 
     def all_maas_machines_ready(self):
+        pending = self.placement_controller.machines_pending()
+        self.maas_state.watch([m.system_id for m in pending])
         self.maas_state.invalidate_nodes_cache()
 
-        needed = set([m.instance_id for m in
-                      self.placement_controller.machines_pending()])
+        needed = set([m.instance_id for m in pending])
         ready = set([m.instance_id for m in
                      self.maas_state.machines(MaasMachineStatus.READY)])
         allocated = set([m.instance_id for m in
@@ -346,12 +411,13 @@ class Controller:
             return False
         return True
 
+    @tracer.traced()
     def add_machines_to_juju_multi(self):
         """Adds each of the machines used for the placement to juju, if it
         isn't already there."""
 
-        self.juju_state.invalidate_status_cache()
-        juju_ids = [jm.instance_id for jm in self.juju_state.machines()]
+        juju_ids = [jm.instance_id for jm in
+                    self.juju_state.machines(max_age=0)]
 
         machine_params = []
         for maas_machine in self.placement_controller.machines_pending():
@@ -371,16 +437,15 @@ class Controller:
             log.debug("add_machines returned '{}'".format(rv))
 
     def all_juju_machines_started(self):
-        self.juju_state.invalidate_status_cache()
         n_needed = len(self.placement_controller.machines_pending())
-        n_allocated = len([jm for jm in self.juju_state.machines()
+        n_allocated = len([jm for jm in self.juju_state.machines(max_age=1)
                            if jm.agent_state == 'started'])
         return n_allocated >= n_needed
 
+    @tracer.traced()
     def add_machines_to_juju_single(self):
-        self.juju_state.invalidate_status_cache()
         self.juju_m_idmap = {}
-        for jm in self.juju_state.machines():
+        for jm in self.juju_state.machines(max_age=0):
             response = self.juju.get_annotations(jm.machine_id,
                                                  'machine')
             ann = response['Annotations']
@@ -414,134 +479,187 @@ class Controller:
                                             machine.instance_id})
             self.juju_m_idmap[machine.instance_id] = m_id
 
-    def run_apt_go_fast(self, machine_id):
-        utils.remote_cp(machine_id,
-                        src=path.join(self.config.share_path,
-                                      "tools/apt-go-fast"),
-                        dst="/tmp/apt-go-fast",
-                        juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(machine_id,
-                         cmds="sudo sh /tmp/apt-go-fast",
-                         juju_home=self.config.juju_home(use_expansion=True))
-
+    @tracer.traced()
+    def run_apt_go_fast(self, machine_ids):
+        """ Runs tools/apt-go-fast on all of machine_ids at once """
+        sessions = []
+        for machine_id in machine_ids:
+            session = utils.RemoteSession(
+                machine_id,
+                juju_home=self.config.juju_home(use_expansion=True))
+            session.put(path.join(self.config.share_path,
+                                  "tools/apt-go-fast"),
+                        "/tmp/apt-go-fast")
+            session.run("sudo sh /tmp/apt-go-fast")
+            sessions.append(session)
+        report = utils.remote_fan_out(sessions)
+        # only a speed-up: the install carries on without it
+        for machine_id, reason in sorted(
+                utils.remote_fan_out_failures(report).items()):
+            log.warning("apt-go-fast failed on machine {}: "
+                        "{}".format(machine_id, reason))
+        return report
+
+    @tracer.traced()
     def configure_lxc_network(self, machine_id):
         # upload our lxc-host-only template and setup bridge
         log.info('Copying network specifications to machine')
         srcpath = path.join(self.config.tmpl_path, 'lxc-host-only')
         destpath = "/tmp/lxc-host-only"
-        utils.remote_cp(machine_id, src=srcpath, dst=destpath,
-                        juju_home=self.config.juju_home(use_expansion=True))
+        session = utils.RemoteSession(
+            machine_id, juju_home=self.config.juju_home(use_expansion=True))
+        session.put(srcpath, destpath)
         log.debug('Updating network configuration for machine')
-        utils.remote_run(machine_id,
-                         cmds="sudo chmod +x /tmp/lxc-host-only",
-                         juju_home=self.config.juju_home(use_expansion=True))
-        utils.remote_run(machine_id,
-                         cmds="sudo /tmp/lxc-host-only",
-                         juju_home=self.config.juju_home(use_expansion=True))
+        session.run("sudo chmod +x /tmp/lxc-host-only")
+        session.run("sudo /tmp/lxc-host-only")
+        session.execute()
 
+    @tracer.traced()
     def deploy_using_placement(self):
         """Deploy charms using machine placement from placement controller,
         waiting for any deferred charms.  Then enqueue all charms for
         further processing and return.
+
+        Charms are deployed by a DeployScheduler: each waits only for
+        the lower priority charms it is linked to, and up to
+        deploy_concurrency deploys run at once.
         """
 
         self.ui.status_info_message("Verifying service deployments")
         assigned_ccs = self.placement_controller.assigned_charm_classes()
         charm_classes = sorted(assigned_ccs,
                                key=attrgetter('deploy_priority'))
+        charm_classes = [c for c in charm_classes
+                         if c not in self.deployed_charm_classes]
+
+        def update_pending_display(pending):
+            self.ui.set_pending_deploys([c.display_name for c in pending])
+
+        parent = tracer.current_span()
+
+        def deploy(charm_class):
+            with tracer.span('deploy {}'.format(charm_class.charm_name),
+                             parent=parent) as span:
+                deferred = self._deploy_if_needed(charm_class)
+                span.set(deferred=deferred)
+                return deferred
+
+        scheduler = DeployScheduler(
+            charm_classes, deploy,
+            max_workers=self.config.getopt('deploy_concurrency'),
+            on_update=update_pending_display)
+        scheduler.run()
+        log.debug("deployed_charm_classes={}".format(
+            PrettyLog(self.deployed_charm_classes)))
+
+    def _deploy_if_needed(self, charm_class):
+        """Deploys charm_class unless juju already has the service, in
+        which case only the units still assigned are added.
+        Returns True if the deploy was deferred."""
+        self.ui.status_info_message(
+            "Checking if {c} is deployed".format(
+                c=charm_class.display_name))
 
-        def undeployed_charm_classes():
-            return [c for c in charm_classes
-                    if c not in self.deployed_charm_classes]
-
-        def update_pending_display():
-            pending_names = [c.display_name for c in
-                             undeployed_charm_classes()]
-            self.ui.set_pending_deploys(pending_names)
-
-        while len(undeployed_charm_classes()) > 0:
-            update_pending_display()
+        service_names = [s.service_name for s in
+                         self.juju_state.services]
 
-            for charm_class in undeployed_charm_classes():
+        if charm_class.charm_name in service_names:
+            with self.placement_lock:
+                asts = self.placement_controller.get_assignments(charm_class)
+            if charm_class.subordinate or \
+               sum(len(ml) for ml in asts.values()) == 0:
                 self.ui.status_info_message(
-                    "Checking if {c} is deployed".format(
+                    "{c} is already deployed, skipping".format(
                         c=charm_class.display_name))
-
-                service_names = [s.service_name for s in
-                                 self.juju_state.services]
-
-                if charm_class.charm_name in service_names:
-                    self.ui.status_info_message(
-                        "{c} is already deployed, skipping".format(
-                            c=charm_class.display_name))
-                    self.deployed_charm_classes.append(charm_class)
-                    continue
-
-                err = self.try_deploy(charm_class)
-                name = charm_class.display_name
-                if err:
-                    log.debug(
-                        "{} is waiting for another service, will"
-                        " re-try in a few seconds".format(name))
-                    break
-                else:
-                    log.debug("Issued deploy for {}".format(name))
-                    self.deployed_charm_classes.append(charm_class)
-
+            elif self.try_deploy(charm_class, service_exists=True):
+                return True
+            else:
                 self.juju_state.invalidate_status_cache()
-                update_pending_display()
-
-            num_remaining = len(undeployed_charm_classes())
-            if num_remaining > 0:
-                log.debug("{} charms pending deploy.".format(num_remaining))
-                log.debug("deployed_charm_classes={}".format(
-                    PrettyLog(self.deployed_charm_classes)))
-
-                time.sleep(5)
-            update_pending_display()
-
-    def try_deploy(self, charm_class):
-        "returns True if deploy is deferred and should be tried again."
+        else:
+            err = self.try_deploy(charm_class)
+            if err:
+                return True
+            log.debug("Issued deploy for {}".format(
+                charm_class.display_name))
+            self.juju_state.invalidate_status_cache()
+
+        with self.placement_lock:
+            self.deployed_charm_classes.append(charm_class)
+        return False
+
+    def try_deploy(self, charm_class, service_exists=False):
+        """returns True if deploy is deferred and should be tried again.
+
+        With service_exists, every assigned unit is added to the
+        service juju already has, eg. those that failed last time.
+        """
 
         charm = charm_class(juju=self.juju,
                             juju_state=self.juju_state,
                             ui=self.ui,
                             config=self.config)
 
-        asts = self.placement_controller.get_assignments(charm_class)
+        with self.placement_lock:
+            asts = self.placement_controller.get_assignments(charm_class)
         errs = []
-        first_deploy = True
+        placed = []
         for atype, ml in asts.items():
             for machine in ml:
                 mspec = self.get_machine_spec(machine, atype)
                 if mspec is None:
                     errs.append(machine)
-                    continue
-
-                if first_deploy:
-                    msg = "Deploying {c}".format(c=charm_class.display_name)
-                    if mspec != '':
-                        msg += " to machine {mspec}".format(mspec=mspec)
-                    self.ui.status_info_message(msg)
-                    deploy_err = charm.deploy(mspec)
-                    if deploy_err:
-                        errs.append(machine)
-                    else:
-                        first_deploy = False
                 else:
-                    # service already deployed, need to add-unit
-                    msg = ("Adding one unit of "
-                           "{c}".format(c=charm_class.display_name))
-                    if mspec != '':
-                        msg += " to machine {mspec}".format(mspec=mspec)
-                    self.ui.status_info_message(msg)
-                    deploy_err = charm.add_unit(machine_spec=mspec)
-                    if deploy_err:
-                        errs.append(machine)
-                if not deploy_err:
-                    self.placement_controller.mark_deployed(machine,
-                                                            charm_class,
-                                                            atype)
+                    placed.append((machine, atype, mspec))
+
+        def mark_deployed(machine, atype):
+            with self.placement_lock:
+                self.placement_controller.mark_deployed(machine,
+                                                        charm_class,
+                                                        atype)
+
+        if service_exists:
+            # eg. a resumed install, or units added although add_units
+            # failed: don't add a second unit where juju has one
+            placements = charm.unit_placements()
+            for machine, atype, mspec in list(placed):
+                if placements[mspec] > 0:
+                    placements[mspec] -= 1
+                    log.debug("{} already has a unit on {}".format(
+                        charm_class.charm_name, mspec))
+                    mark_deployed(machine, atype)
+                    placed.remove((machine, atype, mspec))
+
+        # deploy the service with one unit, then add all the other
+        # units in a single request
+        existing = []
+        while len(placed) > 0 and not service_exists:
+            machine, atype, mspec = placed.pop(0)
+            msg = "Deploying {c}".format(c=charm_class.display_name)
+            if mspec != '':
+                msg += " to machine {mspec}".format(mspec=mspec)
+            self.ui.status_info_message(msg)
+            with tracer.span('juju deploy', machine=mspec) as span:
+                err = charm.deploy(mspec)
+                span.set(failed=err)
+            if err:
+                errs.append(machine)
+            else:
+                mark_deployed(machine, atype)
+                existing.append(mspec)
+                break
+
+        if len(placed) > 0:
+            self.ui.status_info_message(
+                "Adding {n} units of {c}".format(
+                    n=len(placed), c=charm_class.display_name))
+            with tracer.span('add units', count=len(placed)):
+                failed = set(charm.add_units([mspec for _, _, mspec
+                                              in placed], existing))
+            for i, (machine, atype, _) in enumerate(placed):
+                if i in failed:
+                    errs.append(machine)
+                else:
+                    mark_deployed(machine, atype)
 
         had_err = len(errs) > 0
         if had_err and not self.config.getopt('headless'):
@@ -579,6 +697,7 @@ class Controller:
             log.error("unexpected atype: {}".format(atype))
             return None
 
+    @tracer.traced()
     def wait_for_deployed_services_ready(self):
         """ Blocks until all deployed services attached units
         are in a 'started' state
@@ -589,22 +708,21 @@ class Controller:
         self.ui.status_info_message(
             "Waiting for deployed services to be in a ready state.")
 
-        not_ready_len = 0
+        generation = None
         while not self.juju_state.all_agents_started():
-            not_ready = [(a, b) for a, b in self.juju_state.get_agent_states()
-                         if b != 'started']
-            if len(not_ready) == not_ready_len:
-                time.sleep(3)
-                continue
-
-            not_ready_len = len(not_ready)
-            log.info("Checking availability of {} ".format(
-                ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
-            time.sleep(3)
+            if generation != self.juju_state.events.generation:
+                generation = self.juju_state.events.generation
+                not_ready = [(a, b) for a, b in
+                             self.juju_state.get_agent_states()
+                             if b != 'started']
+                log.info("Checking availability of {} ".format(
+                    ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
+            self.juju_state.wait_for_events(generation, timeout=3)
 
         self.ui.status_info_message(
             "Processing relations and finalizing services")
 
+    @tracer.traced()
     def enqueue_deployed_charms(self):
         """Send all deployed charms to CharmQueue for relation setting and
         post-proc.
@@ -624,11 +742,9 @@ class Controller:
         # Exit cleanly if we've finished all deploys, relations,
         # post processing, and running in headless mode.
         if self.config.getopt('headless'):
-            while not self.config.getopt('deploy_complete'):
-                self.ui.status_info_message(
-                    "Waiting for services to be started.")
-                # FIXME: Is this needed?
-                # time.sleep(10)
+            self.ui.status_info_message(
+                "Waiting for services to be started.")
+            charm_q.wait_deploy_complete()
             self.ui.status_info_message(
                 "All services deployed, relations set, and started")
             self.loop.exit(0)
@@ -0,0 +1,193 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Concurrent deployment of charms, in dependency order
+
+A charm waits for the charms it is linked to, through depends, conflicts
+or a relation in related, that have a lower deploy_priority. Charms with
+nothing to wait for are deployed at once, several at a time.
+
+    scheduler = DeployScheduler(charm_classes, controller.try_deploy)
+    scheduler.run()
+    scheduler.stats()
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.deploy_scheduler')
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def _related_names(charm_class):
+    names = set()
+    for pair in charm_class.related:
+        for endpoint in pair:
+            names.add(endpoint.split(':')[0])
+    return names
+
+
+def deploy_graph(charm_classes):
+    """ Which charms each charm must wait for
+
+    :param charm_classes: the charm classes to deploy
+    :returns: {charm_class: set(charm_class)}
+    """
+    by_name = {cc.charm_name: cc for cc in charm_classes}
+    links = {cc: set() for cc in charm_classes}
+    for cc in charm_classes:
+        names = set(cc.depends) | set(cc.conflicts) | _related_names(cc)
+        for name in names:
+            other = by_name.get(name, None)
+            if other is None or other is cc:
+                continue
+            links[cc].add(other)
+            links[other].add(cc)
+
+    return {cc: set(other for other in links[cc]
+                    if other.deploy_priority < cc.deploy_priority)
+            for cc in charm_classes}
+
+
+class DeployScheduler:
+
+    """ Deploys charm classes through a bounded pool of threads
+
+    deploy(charm_class) is called once a charm's predecessors in
+    deploy_graph() are deployed. It returns True when the deploy was
+    deferred, e.g. because the machine is not up yet; that charm alone
+    is tried again after retry_delay seconds, doubling on each further
+    deferral up to max_retry_delay.
+
+    stats() reports, per charm, how long it waited for a worker once it
+    was ready, how long deploying took from the first attempt, and how
+    many attempts were made.
+    """
+
+    def __init__(self, charm_classes, deploy, max_workers=None,
+                 retry_delay=5, max_retry_delay=60, on_update=None):
+        """ :param charm_classes: charm classes to deploy
+            :param deploy: function(charm_class), returning True if the
+                           deploy was deferred
+            :param max_workers: most deploys under way at once
+            :param on_update: function([charm_class]) called with the
+                              charms still to deploy, whenever that changes
+        """
+        self.charm_classes = list(charm_classes)
+        self.deploy = deploy
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_update = on_update
+        self.waits_for = deploy_graph(self.charm_classes)
+        self._lock = threading.Lock()
+        self._stats = {cc: dict(ready_at=None, started_at=None,
+                                finished_at=None, attempts=0)
+                       for cc in self.charm_classes}
+
+    def pending(self):
+        """ Charm classes not deployed yet, in deploy_priority order """
+        with self._lock:
+            return [cc for cc in self.charm_classes
+                    if self._stats[cc]['finished_at'] is None]
+
+    def run(self):
+        """ Deploys every charm class, blocking until all are deployed """
+        done = set()
+        running = {}
+        retry_at = {}
+        self._update()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while len(done) < len(self.charm_classes):
+                now = time.time()
+                for cc in self.charm_classes:
+                    if cc in done or cc in running.values() or \
+                       not self.waits_for[cc] <= done:
+                        continue
+                    with self._lock:
+                        stats = self._stats[cc]
+                        if stats['ready_at'] is None:
+                            stats['ready_at'] = now
+                    if retry_at.get(cc, 0) > now:
+                        continue
+                    retry_at.pop(cc, None)
+                    running[pool.submit(self._attempt, cc)] = cc
+
+                timeout = None
+                if len(retry_at) > 0:
+                    timeout = max(0, min(retry_at.values()) - time.time())
+                finished, _ = wait(running, timeout=timeout,
+                                   return_when=FIRST_COMPLETED)
+                for future in finished:
+                    cc = running.pop(future)
+                    if future.result():
+                        with self._lock:
+                            attempts = self._stats[cc]['attempts']
+                        delay = min(self.retry_delay * 2 ** (attempts - 1),
+                                    self.max_retry_delay)
+                        retry_at[cc] = time.time() + delay
+                        log.debug("{} is waiting for another service, will "
+                                  "re-try in {} seconds".format(
+                                      cc.display_name, delay))
+                    else:
+                        done.add(cc)
+                        self._update()
+        log.info("Deploy timings: {}".format(self.stats()))
+
+    def _attempt(self, charm_class):
+        with self._lock:
+            stats = self._stats[charm_class]
+            if stats['started_at'] is None:
+                stats['started_at'] = time.time()
+            stats['attempts'] += 1
+        try:
+            deferred = self.deploy(charm_class)
+        except Exception:
+            log.exception("Error deploying {}".format(
+                charm_class.display_name))
+            deferred = True
+        if not deferred:
+            with self._lock:
+                stats['finished_at'] = time.time()
+        return deferred
+
+    def _update(self):
+        if self.on_update is not None:
+            self.on_update(self.pending())
+
+    def stats(self):
+        """ Per-charm timings
+
+        :returns: {charm_name: {'queue_wait': seconds, 'deploy_time':
+                  seconds, 'attempts': n}}, with None for times not
+                  known yet
+        """
+        report = {}
+        with self._lock:
+            for cc, s in self._stats.items():
+                queue_wait = deploy_time = None
+                if s['started_at'] is not None:
+                    queue_wait = round(s['started_at'] - s['ready_at'], 3)
+                    if s['finished_at'] is not None:
+                        deploy_time = round(s['finished_at'] -
+                                            s['started_at'], 3)
+                report[cc.charm_name] = dict(queue_wait=queue_wait,
+                                             deploy_time=deploy_time,
+                                             attempts=s['attempts'])
+        return report
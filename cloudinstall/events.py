@@ -0,0 +1,213 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Change events between consecutive juju status snapshots """
+
+from collections import namedtuple
+from enum import Enum
+import logging
+import threading
+
+log = logging.getLogger('cloudinstall.events')
+
+
+class EventType(Enum):
+    MACHINE_ADDED = 'machine added'
+    MACHINE_STATE_CHANGED = 'machine state changed'
+    MACHINE_STARTED = 'machine started'
+    MACHINE_REMOVED = 'machine removed'
+    SERVICE_ADDED = 'service added'
+    SERVICE_REMOVED = 'service removed'
+    UNIT_ADDED = 'unit added'
+    UNIT_STATE_CHANGED = 'unit agent-state changed'
+    UNIT_ERROR = 'unit error'
+    UNIT_REMOVED = 'unit removed'
+    RELATION_JOINED = 'relation joined'
+
+
+MACHINE_EVENTS = (EventType.MACHINE_ADDED,
+                  EventType.MACHINE_STATE_CHANGED,
+                  EventType.MACHINE_STARTED,
+                  EventType.MACHINE_REMOVED)
+
+SERVICE_EVENTS = (EventType.SERVICE_ADDED,
+                  EventType.SERVICE_REMOVED,
+                  EventType.UNIT_ADDED,
+                  EventType.UNIT_STATE_CHANGED,
+                  EventType.UNIT_ERROR,
+                  EventType.UNIT_REMOVED,
+                  EventType.RELATION_JOINED)
+
+
+# type: EventType
+# name: machine id, service name, unit name, or for RELATION_JOINED a
+#       (service, relation name, remote service) tuple
+# old, new: the Machine/Service/Unit before and after, None when it did
+#           not exist; both None for RELATION_JOINED
+StatusEvent = namedtuple('StatusEvent', ['type', 'name', 'old', 'new'])
+
+
+def _all_machines(snapshot):
+    machines = dict(snapshot.machines_by_id)
+    machines.update(snapshot.containers_by_id)
+    return machines
+
+
+def _relations(snapshot):
+    joined = set()
+    for svc in snapshot.services:
+        for r in svc.relations:
+            for charm in r.charms:
+                joined.add((svc.service_name, r.relation_name, charm))
+    return joined
+
+
+def diff_snapshots(old, new):
+    """ Events describing the changes from one snapshot to the next
+
+    :param old: previous :class:`~cloudinstall.juju.JujuStatusSnapshot`,
+                or None to report everything in new as added
+    :param new: current :class:`~cloudinstall.juju.JujuStatusSnapshot`
+    :returns: events, machines first, then services, units and relations
+    :rtype: list of :class:`StatusEvent`
+    """
+    events = []
+
+    old_machines = {} if old is None else _all_machines(old)
+    new_machines = _all_machines(new)
+    for mid, m in new_machines.items():
+        prev = old_machines.get(mid, None)
+        if prev is None:
+            events.append(StatusEvent(EventType.MACHINE_ADDED, mid, None, m))
+        elif prev.agent_state != m.agent_state or \
+                prev.agent_state_info != m.agent_state_info:
+            events.append(StatusEvent(EventType.MACHINE_STATE_CHANGED,
+                                      mid, prev, m))
+        else:
+            continue
+        if m.agent_state == 'started' and \
+           (prev is None or prev.agent_state != 'started'):
+            events.append(StatusEvent(EventType.MACHINE_STARTED,
+                                      mid, prev, m))
+    for mid in old_machines.keys() - new_machines.keys():
+        events.append(StatusEvent(EventType.MACHINE_REMOVED, mid,
+                                  old_machines[mid], None))
+
+    old_services = {} if old is None else old.services_by_name
+    for name, svc in new.services_by_name.items():
+        if name not in old_services:
+            events.append(StatusEvent(EventType.SERVICE_ADDED, name,
+                                      None, svc))
+    for name in old_services.keys() - new.services_by_name.keys():
+        events.append(StatusEvent(EventType.SERVICE_REMOVED, name,
+                                  old_services[name], None))
+
+    old_units = {} if old is None else old.units_by_name
+    for name, u in new.units_by_name.items():
+        prev = old_units.get(name, None)
+        if prev is None:
+            events.append(StatusEvent(EventType.UNIT_ADDED, name, None, u))
+        elif prev.agent_state != u.agent_state or \
+                prev.agent_state_info != u.agent_state_info:
+            events.append(StatusEvent(EventType.UNIT_STATE_CHANGED,
+                                      name, prev, u))
+        else:
+            continue
+        if u.agent_state == 'error':
+            events.append(StatusEvent(EventType.UNIT_ERROR, name, prev, u))
+    for name in old_units.keys() - new.units_by_name.keys():
+        events.append(StatusEvent(EventType.UNIT_REMOVED, name,
+                                  old_units[name], None))
+
+    old_relations = set() if old is None else _relations(old)
+    for rel in sorted(_relations(new) - old_relations):
+        events.append(StatusEvent(EventType.RELATION_JOINED, rel,
+                                  None, None))
+    return events
+
+
+class StatusEventStream:
+
+    """ Publishes the events between successive snapshots
+
+    Subscribers are called with each non-empty list of events, in the
+    publishing thread. Pollers can instead remember generation, which
+    only advances when something changed, and block in wait().
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self._snapshot = None
+        self._subscribers = []
+        self._changed = threading.Condition()
+
+    def subscribe(self, callback, types=None):
+        """ Calls callback(events) on every change
+
+        :param callback: called with a list of :class:`StatusEvent`
+        :param types: only pass on events of these EventTypes
+        :returns: callback, for unsubscribe()
+        """
+        with self._changed:
+            self._subscribers.append((callback, types))
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._changed:
+            self._subscribers = [(cb, t) for cb, t in self._subscribers
+                                 if cb is not callback]
+
+    def publish(self, snapshot):
+        """ Diffs snapshot against the last one published and notifies
+        subscribers and waiters of any changes
+
+        :returns: the events
+        :rtype: list
+        """
+        with self._changed:
+            events = diff_snapshots(self._snapshot, snapshot)
+            self._snapshot = snapshot
+            if len(events) == 0:
+                return events
+            self.generation += 1
+            subscribers = list(self._subscribers)
+            self._changed.notify_all()
+
+        for callback, types in subscribers:
+            if types is None:
+                matched = events
+            else:
+                matched = [e for e in events if e.type in types]
+            if len(matched) == 0:
+                continue
+            try:
+                callback(matched)
+            except Exception:
+                log.exception("Error in status event subscriber "
+                              "{}".format(callback))
+        return events
+
+    def wait(self, generation, timeout=None):
+        """ Blocks until there are changes newer than generation, or
+        timeout seconds have passed.
+
+        :returns: the current generation
+        :rtype: int
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.generation > generation,
+                                   timeout)
+            return self.generation
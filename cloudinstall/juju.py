@@ -18,9 +18,14 @@
 
 from collections import Counter
 import logging
+import threading
 import time
+from types import MappingProxyType
 
+from cloudinstall import utils
+from cloudinstall.events import StatusEventStream
 from cloudinstall.machine import Machine
+from cloudinstall.refresh import RefreshCoordinator
 from cloudinstall.service import Service
 
 from macumba import RequestTimeout
@@ -28,6 +33,69 @@ from macumba import RequestTimeout
 log = logging.getLogger('cloudinstall.juju')
 
 
+class JujuStatusSnapshot:
+
+    """ Indexed, read-only view of a single juju status document
+
+    Wraps every machine, container, service and unit once and indexes
+    them, so lookups are dict accesses instead of scans over freshly
+    built wrappers. The bootstrap node (machine '0') and its containers
+    are not indexed, matching JujuState.machines().
+    """
+
+    def __init__(self, status):
+        """ Builds a JujuStatusSnapshot
+
+        :param dict status: juju FullStatus document
+        """
+        self.status = status
+        machines = []
+        by_id = {}
+        by_instance_id = {}
+        containers = {}
+
+        def index_containers(m):
+            for c in m.containers:
+                containers[c.machine_id] = c
+                index_containers(c)
+
+        for machine_id, machine in (status.get('Machines', None)
+                                    or {}).items():
+            if '0' == machine_id:
+                continue
+            m = Machine(machine_id, machine)
+            machines.append(m)
+            by_id[machine_id] = m
+            if m.instance_id:
+                by_instance_id[m.instance_id] = m
+            index_containers(m)
+
+        services = []
+        services_by_name = {}
+        units = {}
+        for name, service in (status.get('Services', None) or {}).items():
+            svc = Service(name, service)
+            services.append(svc)
+            services_by_name[name] = svc
+            for u in svc.units:
+                units[u.unit_name] = u
+
+        self.machines = tuple(machines)
+        self.services = tuple(services)
+        self.machines_by_id = MappingProxyType(by_id)
+        self.machines_by_instance_id = MappingProxyType(by_instance_id)
+        self.containers_by_id = MappingProxyType(containers)
+        self.services_by_name = MappingProxyType(services_by_name)
+        self.units_by_name = MappingProxyType(units)
+
+    def machine_or_container(self, machine_id):
+        """ Machine or container with machine_id, or None """
+        m = self.machines_by_id.get(machine_id, None)
+        if m is None:
+            m = self.containers_by_id.get(machine_id, None)
+        return m
+
+
 class JujuState:
 
     """ Represents a global Juju state """
@@ -38,8 +106,14 @@ class JujuState:
         :param juju: Juju API connection
         """
         self.juju = juju
-        self.start_time = time.time()
-        self._juju_status = None
+        self.refresher = RefreshCoordinator(self._fetch_status,
+                                            ttl=20, retries=5,
+                                            retry_on=(RequestTimeout,),
+                                            name="juju status")
+        self._snapshot = None
+        self._snapshot_lock = threading.RLock()
+        self.events = StatusEventStream()
+        self.recorder = None
         self.valid_states = ['pending', 'started', 'down']
 
     def get_agent_states(self):
@@ -61,36 +135,33 @@ class JujuState:
         return all([state == "started" for _, state in
                     self.get_agent_states()])
 
-    def status(self):
-        """Returns juju status.
-        Caches value for 20 seconds.
+    def _fetch_status(self):
+        return self.juju.status()
 
-        Call invalidate_status_cache() to force next status call to
-        fetch from server.
+    def status(self, max_age=None):
+        """Returns juju status.
+        Caches value for 20 seconds, or max_age seconds if given.
 
-        If request times out (macumba default is 60 seconds), retries
-        5 times.
+        Concurrent callers share a single in-flight FullStatus request.
+        If it times out (macumba default is 60 seconds), it is retried
+        with jittered exponential backoff, 5 attempts in all.
 
+        :param max_age: seconds of staleness this caller accepts; 0
+                        waits for a request started after this call
         """
-        elapsed_time = time.time() - self.start_time
-        n_retries = 0
-        if not self._juju_status or elapsed_time > 20:
-            self._juju_status = None
-            while self._juju_status is None:
-                try:
-                    self._juju_status = self.juju.status()
-                except RequestTimeout:
-                    n_retries += 1
-                    if n_retries == 5:
-                        raise Exception("Connection failure with juju API")
-            self.start_time = time.time()
-        return self._juju_status
+        try:
+            return self.refresher.get(max_age)
+        except RequestTimeout:
+            raise Exception("Connection failure with juju API")
 
     def invalidate_status_cache(self):
         """Invalidates cache of status.  Use this to force fetching from
         server more often than every 20 seconds.
+
+        Prefer passing max_age to status(), machines() or snapshot(),
+        which does not force a refresh on every other caller.
         """
-        self._juju_status = None
+        self.refresher.invalidate()
 
     def machines_summary(self):
         """ Returns summary of known machines and their status
@@ -115,6 +186,43 @@ class JujuState:
                      if m['Id'] != '0'])
         return d
 
+    def snapshot(self, max_age=None):
+        """ Indexed view of the current status
+
+        A new snapshot is built only when status() returns a new
+        document, so repeated lookups between fetches share one. Each
+        new snapshot is published to self.events, and its status
+        document is written to self.recorder if there is one.
+
+        :param max_age: passed to status()
+        :rtype: :class:`JujuStatusSnapshot`
+        """
+        # Serialized so that snapshots are published in status order
+        with self._snapshot_lock:
+            status = self.status(max_age)
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.status is not status:
+                snapshot = JujuStatusSnapshot(status)
+                self._snapshot = snapshot
+                if self.recorder is not None:
+                    self.recorder.record('juju', status)
+                self.events.publish(snapshot)
+            return snapshot
+
+    def wait_for_events(self, generation, timeout):
+        """ Waits for status changes newer than events generation
+
+        Nothing refreshes a plain JujuState in the background, so this
+        sleeps for timeout and then takes a snapshot at most timeout
+        seconds old, publishing whatever changed.
+
+        :returns: the current events generation
+        :rtype: int
+        """
+        time.sleep(timeout)
+        self.snapshot(max_age=timeout)
+        return self.events.generation
+
     def machine(self, machine_id):
         """ Return single machine state
 
@@ -122,38 +230,33 @@ class JujuState:
         :returns: machine
         :rtype: :class:`~cloudinstall.machine.Machine`
         """
-        for m in self.machines():
-            if m.machine_id == machine_id:
-                return m
-        return Machine(-1, {})
+        m = self.snapshot().machines_by_id.get(machine_id, None)
+        if m is None:
+            return Machine(-1, {})
+        return m
+
+    def machine_by_instance_id(self, instance_id):
+        """ Return the machine with a given provider instance id
+
+        :param str instance_id: e.g. a MAAS node resource uri
+        :returns: machine or None
+        :rtype: :class:`~cloudinstall.machine.Machine`
+        """
+        return self.snapshot().machines_by_instance_id.get(instance_id, None)
 
-    def machines(self):
+    def machines(self, max_age=None):
         """ Machines property
 
+        :param max_age: passed to status()
         :returns: machines known to juju (except bootstrap)
         :rtype: list
         """
-        ret = self.status()
-        machines = []
-
-        for machine_id, machine in ret.get('Machines', {}).items():
-            if '0' == machine_id:
-                continue
-            machines.append(Machine(machine_id, machine))
-        return machines
+        return list(self.snapshot(max_age).machines)
 
     def machine_or_container(self, machine_id):
         """ returns machine or container matching the id
         """
-        for machine in self.machines():
-            if '0' == machine_id:
-                continue
-            if machine.machine_id == machine_id:
-                return machine
-            for container in machine.containers:
-                if container.machine_id == machine_id:
-                    return container
-        return None
+        return self.snapshot().machine_or_container(machine_id)
 
     def base_machine(self, machine_id):
         """ returns machine if given a numeric machine id,
@@ -182,10 +285,19 @@ class JujuState:
         :returns: a service entry or None
         :rtype: :class:`~cloudinstall.service.Service`
         """
-        for s in self.services:
-            if s.service_name == name:
-                return s
-        return Service(name, {})
+        s = self.snapshot().services_by_name.get(name, None)
+        if s is None:
+            return Service(name, {})
+        return s
+
+    def unit(self, unit_name):
+        """ Return a single unit entry
+
+        :param str unit_name: full unit name, e.g. 'keystone/0'
+        :returns: a unit entry or None
+        :rtype: :class:`~cloudinstall.service.Unit`
+        """
+        return self.snapshot().units_by_name.get(unit_name, None)
 
     @property
     def services(self):
@@ -194,16 +306,299 @@ class JujuState:
         :returns: Service() of all loaded services
         :rtype: list
         """
-        ret = self.status()
-        services = []
-
-        for name, service in ret.get('Services', {}).items():
-            services.append(Service(name, service))
-
-        return services
+        return list(self.snapshot().services)
 
     @property
     def networks(self):
         """ Juju netwoks property
         """
         return self.status()['Networks']
+
+
+def hardware_string(hc):
+    """ Renders AllWatcher HardwareCharacteristics in the FullStatus
+    'Hardware' format, e.g. 'arch=amd64 cpu-cores=1 mem=1740M'
+
+    :param dict hc: HardwareCharacteristics from a machine delta
+    :rtype: str
+    """
+    fields = [('Arch', 'arch', ''),
+              ('CpuCores', 'cpu-cores', ''),
+              ('CpuPower', 'cpu-power', ''),
+              ('Mem', 'mem', 'M'),
+              ('RootDisk', 'root-disk', 'M')]
+    parts = []
+    for key, label, suffix in fields:
+        val = (hc or {}).get(key, None)
+        if val is not None:
+            parts.append("{}={}{}".format(label, val, suffix))
+    return " ".join(parts)
+
+
+def _life(entity):
+    """ FullStatus only reports Life once an entity stops being alive """
+    life = entity.get('Life', '')
+    if life == 'alive':
+        return ''
+    return life
+
+
+class JujuWatcherState(JujuState):
+
+    """ JujuState kept current by the Juju AllWatcher
+
+    Subscribes with WatchAll and applies the incremental deltas
+    returned by each AllWatcher Next call to an in-memory model, so
+    that status() never has to re-fetch FullStatus. status() returns
+    a document in the FullStatus format built from that model, so
+    machines(), services and machine() work unchanged.
+
+    Until the first batch of deltas has been applied, or if the
+    watcher cannot be started, status() falls back to FullStatus.
+    """
+
+    def __init__(self, juju, sync_timeout=30, resubscribe_delay=5,
+                 next_timeout=300):
+        """ Builds a JujuWatcherState
+
+        :param juju: Juju API connection
+        :param sync_timeout: seconds status() waits for the initial
+                             deltas before falling back to FullStatus
+        :param resubscribe_delay: seconds to wait before re-subscribing
+                                  after the watcher fails
+        :param next_timeout: seconds to wait for an AllWatcher Next
+                             reply before giving up on the watcher and
+                             re-subscribing
+        """
+        super().__init__(juju)
+        self.sync_timeout = sync_timeout
+        self.resubscribe_delay = resubscribe_delay
+        self.next_timeout = next_timeout
+        self.watcher_id = None
+        self._watching = False
+        self._resync = True
+        self._sync_waited = False
+        self._synced = threading.Event()
+        self._model_lock = threading.RLock()
+        self._machines = {}
+        self._services = {}
+        self._units = {}
+        self._relations = {}
+        self._model_status = None
+
+    def start(self):
+        """ Subscribes to the AllWatcher and starts applying deltas in a
+        background thread
+        """
+        if self._watching:
+            return
+        self._watching = True
+        self._watch_async()
+
+    def stop(self):
+        """ Stops applying deltas and releases the server-side watcher
+
+        Waits at most sync_timeout seconds for the server to answer.
+        """
+        self._watching = False
+        watcher_id, self.watcher_id = self.watcher_id, None
+        if watcher_id is not None:
+            self._stop_watcher(watcher_id)
+
+    def _stop_watcher(self, watcher_id):
+        try:
+            # macumba can miss a reply that arrives before it has
+            # finished sending, so never wait for this one forever
+            self.juju.call(dict(Type="AllWatcher",
+                                Request="Stop",
+                                Id=watcher_id),
+                           timeout=self.sync_timeout)
+        except Exception:
+            log.exception("Error stopping AllWatcher {}".format(watcher_id))
+
+    @utils.async
+    def _watch_async(self):
+        self._watch()
+
+    def _watch(self):
+        while self._watching:
+            try:
+                if self.watcher_id is None:
+                    ret = self.juju.get_watcher()
+                    self.watcher_id = ret['AllWatcherId']
+                    self._resync = True
+                    log.debug("Subscribed to AllWatcher "
+                              "{}".format(self.watcher_id))
+                # Next blocks until there are changes, but a reply
+                # macumba misses would otherwise freeze the model
+                ret = self.juju.call(dict(Type="AllWatcher",
+                                          Request="Next",
+                                          Id=self.watcher_id),
+                                     timeout=self.next_timeout)
+            except RequestTimeout:
+                if not self._watching:
+                    return
+                watcher_id, self.watcher_id = self.watcher_id, None
+                if watcher_id is not None:
+                    log.warning("No AllWatcher deltas after {} seconds, "
+                                "re-subscribing".format(self.next_timeout))
+                    self._stop_watcher(watcher_id)
+                else:
+                    log.warning("Timed out subscribing to the AllWatcher, "
+                                "retrying in {} seconds".format(
+                                    self.resubscribe_delay))
+                    time.sleep(self.resubscribe_delay)
+                continue
+            except Exception:
+                if not self._watching:
+                    return
+                log.exception("AllWatcher failed, re-subscribing in "
+                              "{} seconds".format(self.resubscribe_delay))
+                self.watcher_id = None
+                time.sleep(self.resubscribe_delay)
+                continue
+            self.apply_deltas(ret.get('Deltas', None) or [],
+                              reset=self._resync)
+            self._resync = False
+
+    def apply_deltas(self, deltas, reset=False):
+        """ Applies a batch of AllWatcher deltas to the model
+
+        :param list deltas: [entity kind, 'change' or 'remove', entity]
+        :param bool reset: discard the model first; the first batch
+                           from a new watcher is the complete state
+        """
+        kinds = {'machine': (self._machines, 'Id'),
+                 'service': (self._services, 'Name'),
+                 'unit': (self._units, 'Name'),
+                 'relation': (self._relations, 'Key')}
+        with self._model_lock:
+            if reset:
+                for entities, _ in kinds.values():
+                    entities.clear()
+            for kind, op, entity in deltas:
+                if kind not in kinds:
+                    continue
+                entities, key = kinds[kind]
+                if op == 'remove':
+                    entities.pop(entity[key], None)
+                else:
+                    entities[entity[key]] = entity
+            self._model_status = None
+            self._synced.set()
+        self.snapshot()
+
+    def wait_for_events(self, generation, timeout):
+        """ Blocks until the watcher publishes changes newer than
+        generation, or timeout seconds have passed
+        """
+        if not self._synced.is_set():
+            return super().wait_for_events(generation, timeout)
+        return self.events.wait(generation, timeout)
+
+    def status(self, max_age=None):
+        """ Returns the watched model in the FullStatus format
+
+        max_age is ignored once the model has synced; it only applies
+        to the FullStatus fallback. The model is only as current as the
+        last batch of deltas applied: it lags juju until Next returns,
+        and keeps the old state while the watcher is re-subscribing.
+        """
+        if self._watching and not self._sync_waited:
+            self._sync_waited = True
+            if not self._synced.wait(self.sync_timeout):
+                log.warning("No AllWatcher deltas after {} seconds, "
+                            "using FullStatus".format(self.sync_timeout))
+        if not self._synced.is_set():
+            return super().status(max_age)
+        with self._model_lock:
+            if self._model_status is None:
+                self._model_status = self._build_status()
+            return self._model_status
+
+    def invalidate_status_cache(self):
+        """ Only the FullStatus fallback caches anything; the watched
+        model changes only when deltas arrive.
+        """
+        if not self._synced.is_set():
+            super().invalidate_status_cache()
+
+    def _machine_status(self, m):
+        addresses = m.get('Addresses', None) or []
+        public = [a['Value'] for a in addresses
+                  if a.get('Scope', '') == 'public']
+        dns_name = (public or [a['Value'] for a in addresses] or [''])[0]
+        return {'Id': m['Id'],
+                'InstanceId': m.get('InstanceId', ''),
+                'AgentState': m.get('Status', ''),
+                'AgentStateInfo': m.get('StatusInfo', ''),
+                'DNSName': dns_name,
+                'Series': m.get('Series', ''),
+                'Life': _life(m),
+                'Hardware': hardware_string(
+                    m.get('HardwareCharacteristics', None)),
+                'Jobs': m.get('Jobs', []),
+                'HasVote': m.get('HasVote', False),
+                'WantsVote': m.get('WantsVote', False),
+                'Containers': {}}
+
+    def _build_status(self):
+        """ Renders the model as a FullStatus document """
+        all_machines = {mid: self._machine_status(m)
+                        for mid, m in self._machines.items()}
+        machines = {}
+        # attach containers to their hosts, outermost first
+        for mid in sorted(all_machines, key=lambda i: i.count('/')):
+            if '/' not in mid:
+                machines[mid] = all_machines[mid]
+                continue
+            parent = all_machines.get(mid.rsplit('/', 2)[0], None)
+            if parent is None:
+                log.debug("No host machine for container {}".format(mid))
+                continue
+            parent['Containers'][mid] = all_machines[mid]
+
+        services = {}
+        for name, s in self._services.items():
+            services[name] = {'Charm': s.get('CharmURL', ''),
+                              'Exposed': s.get('Exposed', False),
+                              'Life': _life(s),
+                              'Relations': {},
+                              'SubordinateTo': [],
+                              'Networks': None,
+                              'Units': None if s.get('Subordinate') else {}}
+
+        for name, u in self._units.items():
+            svc = services.get(u.get('Service', ''), None)
+            # As in FullStatus, subordinate units do not appear in their
+            # service's Units.
+            if svc is None or svc['Units'] is None:
+                continue
+            svc['Units'][name] = {
+                'AgentState': u.get('Status', ''),
+                'AgentStateInfo': u.get('StatusInfo', ''),
+                'Charm': u.get('CharmURL', ''),
+                'Machine': u.get('MachineId', ''),
+                'PublicAddress': u.get('PublicAddress', ''),
+                'OpenedPorts': u.get('Ports', None)}
+
+        for r in self._relations.values():
+            endpoints = r.get('Endpoints', None) or []
+            for ep in endpoints:
+                svc = services.get(ep['ServiceName'], None)
+                if svc is None:
+                    continue
+                others = [o['ServiceName'] for o in endpoints if o is not ep]
+                if len(others) == 0:
+                    # peer relation
+                    others = [ep['ServiceName']]
+                rel = ep['Relation']
+                svc['Relations'].setdefault(rel['Name'], []).extend(others)
+                if rel.get('Scope', '') == 'container' and \
+                   svc['Units'] is None:
+                    svc['SubordinateTo'].extend(
+                        [o for o in others if o not in svc['SubordinateTo']])
+
+        return {'Machines': machines,
+                'Services': services,
+                'Networks': {}}
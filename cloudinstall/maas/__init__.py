@@ -16,8 +16,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from cloudinstall.machine import Machine
-from cloudinstall.utils import human_to_mb
+from cloudinstall.machine import Machine, int_or_none
+from cloudinstall.maas.constraints import compile_constraints
+from cloudinstall.maas.sync import MaasNodeSync
 from maasclient.auth import MaasAuth
 from maasclient import MaasClient
 from collections import Counter
@@ -26,6 +27,7 @@ import json
 import logging
 import os
 import time
+from types import MappingProxyType
 
 
 log = logging.getLogger('cloudinstall.maas')
@@ -44,41 +46,15 @@ def satisfies(machine, constraints):
 
     If successful the return will be (True, [])
 
+    To check many machines against the same constraints, match a
+    :class:`~cloudinstall.maas.constraints.MachineColumns` instead.
+
     :rtype: tuple
     :returns: (bool, [list-of-failed constraint keys])
 
     """
-    kmap = dict(mem='memory',
-                arch='architecture',
-                storage='storage',
-                cpu_cores='cpu_count')
-    kmap['root-disk'] = 'storage'
-
-    cons_checks = []
-
-    if constraints is None:
-        return (True, [])
-
-    for k, v in constraints.items():
-        if k == 'arch':
-            mval = machine.machine[kmap[k]]
-            if mval != '*' and mval != v:
-                cons_checks.append(k)
-        else:
-            mval = machine.machine[kmap[k]]
-
-            if mval == '*':
-                # '*' always satisfies.
-                continue
-
-            if not str(v).isdecimal():
-                v = human_to_mb(v)
-
-            if mval < v:
-                cons_checks.append(k)
-
-    rval = (len(cons_checks) == 0), cons_checks
-    return rval
+    cons_checks = compile_constraints(constraints).failed(machine)
+    return (len(cons_checks) == 0), cons_checks
 
 
 class MaasMachineStatus(Enum):
@@ -116,155 +92,51 @@ class MaasMachineStatus(Enum):
 
 
 class MaasMachine(Machine):
-    """ Single maas machine """
-
-    @property
-    def hostname(self):
-        """ Query hostname reported by MaaS
-
-        :returns: hostname
-        :rtype: str
-        """
-        return self.machine.get('hostname', '')
-
-    @property
-    def status(self):
-        """ Status of machine state
-
-        :returns: status enum
-        :rtype: MaasMachineStatus
-        """
-        return MaasMachineStatus(self.machine.get('status',
-                                                  MaasMachineStatus.UNKNOWN))
-
-    @property
-    def zone(self):
-        """ Zone information
-
-        :returns: zone information
-        :rtype: dict
-        """
-        return self.machine.get('zone', {})
-
-    @property
-    def cpu_cores(self):
-        """ Returns number of cpu-cores
-
-        :returns: number of cpus
-        :rtype: str
-        """
-        return self.machine.get('cpu_count', '0')
-
-    @property
-    def storage(self):
-        """ Return storage
-
-        :returns: storage size
-        :rtype: str
-        """
-        try:
-            _storage_in_gb = int(self.machine.get('storage')) / 1024
-        except ValueError:
-            return "N/A"
-        return "{size:.2f}G".format(size=_storage_in_gb)
+    """ Single maas machine
 
-    @property
-    def arch(self):
-        """ Return architecture
-
-        :returns: architecture type
-        :rtype: str
-        """
-        return self.machine.get('architecture')
+    As with :class:`~cloudinstall.machine.Machine`, the node is parsed
+    once; cpu_count, mem_mb and storage_mb hold its hardware as numbers.
+    """
 
-    @property
-    def mem(self):
-        """ Return memory
+    __slots__ = ('hostname', 'status', 'zone', 'power_type', 'system_id',
+                 'ip_addresses', 'macaddress_set', 'tag_names', 'tag',
+                 'owner')
 
-        :returns: memory size
-        :rtype: str
-        """
+    def __init__(self, machine_id, machine):
+        super().__init__(machine_id, machine)
+        self.hostname = machine.get('hostname', '')
         try:
-            _mem = int(self.machine.get('memory'))
+            self.status = MaasMachineStatus(
+                machine.get('status', MaasMachineStatus.UNKNOWN))
         except ValueError:
-            return "N/A"
-        if _mem > 1024:
-            _mem = _mem / 1024
-            return "{size}G".format(size=str(_mem))
+            log.debug("Unknown status for {}: {}".format(
+                self.hostname, machine.get('status')))
+            self.status = MaasMachineStatus.UNKNOWN
+        self.zone = machine.get('zone', {})
+        self.power_type = machine.get('power_type', 'None')
+        self.instance_id = machine.get('resource_uri', '')
+        self.system_id = machine.get('system_id', '')
+        self.ip_addresses = machine.get('ip_addresses', [])
+        self.macaddress_set = machine.get('macaddress_set', [])
+        self.tag_names = machine.get('tag_names', [])
+        self.tag = machine.get('tag', '')
+        self.owner = machine.get('owner', 'root')
+        self.arch = machine.get('architecture')
+
+        self._cpu_cores = machine.get('cpu_count', '0')
+        self.cpu_count = int_or_none(self._cpu_cores)
+
+        self.storage_mb = int_or_none(machine.get('storage'))
+        if self.storage_mb is not None:
+            self._storage = "{size:.2f}G".format(size=self.storage_mb / 1024)
+
+        self.mem_mb = int_or_none(machine.get('memory'))
+        if self.mem_mb is None:
+            self._mem = "N/A"
+        elif self.mem_mb > 1024:
+            self._mem = "{size}G".format(size=str(self.mem_mb / 1024))
         else:
-            return "{size}M".format(size=str(_mem))
-
-    @property
-    def power_type(self):
-        """ Machine power type
-
-        :returns: machines power type
-        :rtype: str
-        """
-        return self.machine.get('power_type', 'None')
-
-    @property
-    def instance_id(self):
-        """ Returns instance-id of a machine
-
-        :returns: instance-id of machine
-        :rtype: str
-        """
-        return self.machine.get('resource_uri', '')
-
-    @property
-    def system_id(self):
-        """ Returns system id of a maas machine
-
-        :returns: system id of machine
-        :rtype: str
-        """
-        return self.machine.get('system_id', '')
-
-    @property
-    def ip_addresses(self):
-        """ Ip addresses for machine
-
-        :returns: ip addresses
-        :rtype: list
-        """
-        return self.machine.get('ip_addresses', [])
-
-    @property
-    def macaddress_set(self):
-        """ Macaddress set of maas machine
-
-        :returns: list of dict(mac_address, resource_uri)
-        :rtype: list
-        """
-        return self.machine.get('macaddress_set', [])
-
-    @property
-    def tag_names(self):
-        """ Tag names for machine
-
-        :returns: tags associated with machine
-        :rtype: list
-        """
-        return self.machine.get('tag_names', [])
-
-    @property
-    def tag(self):
-        """ Machine tag
-
-        :returns: tag defined
-        :rtype: str
-        """
-        return self.machine.get('tag', '')
-
-    @property
-    def owner(self):
-        """ Machine owner
-
-        :returns: owner
-        :rtype: str
-        """
-        return self.machine.get('owner', 'root')
+            self._mem = "{size}M".format(size=str(self.mem_mb))
 
     def __repr__(self):
         return "<MaasMachine({dns_name},{state},{mem}," \
@@ -288,27 +160,116 @@ class MaasMachine(Machine):
                 "storage:{storage} cores:{cpus}").format(**d)
 
 
+class MaasNodesSnapshot:
+
+    """ Indexed, read-only view of a single MAAS node list
+
+    Builds each MaasMachine once and indexes them by resource_uri
+    (instance_id), system_id, hostname and status. The juju bootstrap
+    node is left out of the indexes, as in MaasState.machines(), but
+    counted in the summary.
+    """
+
+    def __init__(self, nodes):
+        """ Builds a MaasNodesSnapshot
+
+        :param list nodes: node dicts from the MAAS nodes API
+        """
+        self.nodes = nodes
+        machines = []
+        by_instance_id = {}
+        by_system_id = {}
+        by_hostname = {}
+        by_status = {}
+        summary = Counter()
+        for node in nodes or []:
+            m = MaasMachine(-1, node)
+            summary[m.status] += 1
+            if m.hostname == 'juju-bootstrap.maas':
+                continue
+            machines.append(m)
+            by_instance_id[m.instance_id] = m
+            by_system_id[m.system_id] = m
+            by_hostname[m.hostname] = m
+            by_status.setdefault(m.status, []).append(m)
+
+        self.machines = tuple(machines)
+        self.machines_by_instance_id = MappingProxyType(by_instance_id)
+        self.machines_by_system_id = MappingProxyType(by_system_id)
+        self.machines_by_hostname = MappingProxyType(by_hostname)
+        self.machines_by_status = MappingProxyType(
+            {status: tuple(ms) for status, ms in by_status.items()})
+        self.summary = summary
+
+
 class MaasState:
     """ Represents global MaaS state """
 
-    def __init__(self, maas_client):
+    def __init__(self, maas_client, sync=None):
+        """ Builds a MaasState
+
+        :param maas_client: MAAS API client
+        :param sync: optional :class:`~cloudinstall.maas.sync.MaasNodeSync`
+                     to refresh nodes incrementally instead of fetching
+                     the whole list each time
+        """
         self.maas_client = maas_client
+        self.sync = sync
         self._maas_client_nodes = None
+        self._snapshot = None
         self.start_time = time.time()
+        self.recorder = None
+        self._recorded_nodes = None
 
     def nodes(self):
         """ Cache MAAS nodes
+
+        Each fetch that changed the nodes is written to self.recorder
+        if there is one.
         """
         elapsed_time = time.time() - self.start_time
         if not self._maas_client_nodes or elapsed_time > 20:
-            self._maas_client_nodes = self.maas_client.nodes
+            if self.sync is not None:
+                self._maas_client_nodes = self.sync.nodes()
+            else:
+                self._maas_client_nodes = self.maas_client.nodes
             self.start_time = time.time()
+            # an unchanged sync list comes back as the same object,
+            # even after invalidate_nodes_cache()
+            if self.recorder is not None and \
+               self._maas_client_nodes is not self._recorded_nodes:
+                self._recorded_nodes = self._maas_client_nodes
+                self.recorder.record('maas', self._maas_client_nodes)
         return self._maas_client_nodes
 
+    def watch(self, system_ids):
+        """ Tells an incremental sync which nodes are being waited on, so
+        refreshes can poll just those. Does nothing without one.
+
+        :param system_ids: MAAS system ids
+        """
+        if self.sync is not None:
+            self.sync.watch(system_ids)
+
     def invalidate_nodes_cache(self):
         """Force reload on next access"""
         self._maas_client_nodes = None
 
+    def snapshot(self):
+        """ Indexed view of the current nodes
+
+        Rebuilt only when nodes() returns a new list, so MaasMachines
+        are built once per refresh.
+
+        :rtype: :class:`MaasNodesSnapshot`
+        """
+        nodes = self.nodes()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.nodes is not nodes:
+            snapshot = MaasNodesSnapshot(nodes)
+            self._snapshot = snapshot
+        return snapshot
+
     def machine(self, instance_id):
         """ Return single machine state
 
@@ -316,10 +277,21 @@ class MaasState:
         :returns: machine
         :rtype: cloudinstall.maas.MaasMachine
         """
-        for m in self.machines():
-            if m.instance_id == instance_id:
-                return m
-        return None
+        return self.snapshot().machines_by_instance_id.get(instance_id, None)
+
+    def machine_by_system_id(self, system_id):
+        """ Return the machine with a MAAS system id, or None
+
+        :rtype: cloudinstall.maas.MaasMachine
+        """
+        return self.snapshot().machines_by_system_id.get(system_id, None)
+
+    def machine_by_hostname(self, hostname):
+        """ Return the machine with a hostname, or None
+
+        :rtype: cloudinstall.maas.MaasMachine
+        """
+        return self.snapshot().machines_by_hostname.get(hostname, None)
 
     def machines(self, state=None):
         """Maas Machines
@@ -332,20 +304,18 @@ class MaasState:
         :rtype: list of MaasMachine
 
         """
-
-        all_machines = [MaasMachine(-1, m) for m in self.nodes()
-                        if m['hostname'] != 'juju-bootstrap.maas']
+        snapshot = self.snapshot()
         if state:
-            return [m for m in all_machines if m.status == state]
+            return list(snapshot.machines_by_status.get(state, ()))
         else:
-            return all_machines
+            return list(snapshot.machines)
 
     def machines_summary(self):
         """ Returns summary of known machines and their states.
         """
-        log.debug("in summary, self.nodes is {}".format(self.nodes()))
-        return Counter([MaasMachineStatus(m['status'])
-                        for m in self.nodes()])
+        summary = Counter(self.snapshot().summary)
+        log.debug("in summary, machines are {}".format(summary))
+        return summary
 
 
 def connect_to_maas(creds=None):
@@ -359,7 +329,7 @@ def connect_to_maas(creds=None):
         auth = MaasAuth()
         auth.get_api_key('root')
     maas = MaasClient(auth)
-    maas_state = MaasState(maas)
+    maas_state = MaasState(maas, sync=MaasNodeSync(maas))
     return maas, maas_state
 
 
@@ -380,5 +350,8 @@ class FakeMaasState:
     def invalidate_nodes_cache(self):
         "no op"
 
+    def watch(self, system_ids):
+        "no op"
+
     def machines_summary(self):
         return "no summary for fake state"
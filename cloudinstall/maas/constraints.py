@@ -0,0 +1,211 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Matching machine hardware against charm constraints
+
+Constraints are compiled once: sizes such as '2G' are converted to
+megabytes, and arch is kept as a string. A list of machines is turned
+into columns (memory, cores, storage and an arch code per machine) and
+each compiled constraint is checked against a whole column at a time.
+
+    columns = MachineColumns(maas_state.machines())
+    match = compile_constraints(charm_class.constraints).match(columns)
+    ready = match.satisfying()
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+import logging
+
+from cloudinstall.machine import size_to_mb
+from cloudinstall.utils import human_to_mb
+
+log = logging.getLogger('cloudinstall.maas.constraints')
+
+# constraint key -> MAAS node key
+CONSTRAINT_KEYS = {'mem': 'memory',
+                   'arch': 'architecture',
+                   'storage': 'storage',
+                   'root-disk': 'storage',
+                   'cpu_cores': 'cpu_count'}
+
+NUMERIC_KEYS = ('memory', 'storage', 'cpu_count')
+
+# A machine value of '*' satisfies any constraint, and a missing or
+# unreadable one satisfies none.
+WILDCARD = '*'
+_ANY = float('inf')
+_NONE = float('-inf')
+_ANY_ARCH = -1
+_UNKNOWN_ARCH = -2
+
+
+def _numeric_value(val):
+    if type(val) is int:
+        return val
+    if val == WILDCARD:
+        return _ANY
+    mb = size_to_mb(val)
+    if mb is None:
+        return _NONE
+    return mb
+
+
+class MachineColumns:
+
+    """ The hardware of a list of machines, one list per MAAS key
+
+    memory, storage and cpu_count are numbers, with +inf for '*' and
+    -inf when unknown. architecture is a list of small ints, looked up
+    through arch_codes, with -1 for '*'.
+    """
+
+    def __init__(self, machines):
+        """ Builds columns from MaasMachines (or anything with a MAAS
+        node dict as .machine)
+
+        :param machines: iterable of machines; the order is kept
+        """
+        self.machines = list(machines)
+        self.arch_codes = {}
+        self.columns = {key: [] for key in NUMERIC_KEYS}
+        arch = []
+        for m in self.machines:
+            node = m.machine
+            for key in NUMERIC_KEYS:
+                self.columns[key].append(_numeric_value(node.get(key, None)))
+            a = node.get('architecture', None)
+            if a == WILDCARD:
+                arch.append(_ANY_ARCH)
+            else:
+                arch.append(self.arch_codes.setdefault(a,
+                                                       len(self.arch_codes)))
+        self.columns['architecture'] = arch
+
+    def __len__(self):
+        return len(self.machines)
+
+
+class ConstraintMatch:
+
+    """ Result of matching one set of constraints against MachineColumns
+
+    mask[i] is True when machine i satisfies every constraint.
+    failures maps each constraint key to a list that is True where
+    that constraint failed.
+    """
+
+    def __init__(self, machines, mask, failures):
+        self.machines = machines
+        self.mask = mask
+        self.failures = failures
+
+    def failed(self, index):
+        """ Constraint keys machine index failed, in constraint order
+
+        :rtype: list
+        """
+        return [k for k, failed in self.failures.items() if failed[index]]
+
+    def satisfying(self):
+        """ The machines that satisfy every constraint, in order
+
+        :rtype: list
+        """
+        return [m for m, ok in zip(self.machines, self.mask) if ok]
+
+
+class CompiledConstraints:
+
+    """ A constraints dict, ready to check against machines
+
+    Use compile_constraints() rather than building these directly, so
+    that charms with the same constraints share one.
+
+    Checks are kept in the order of the constraints dict, which is the
+    order failures are reported in.
+    """
+
+    def __init__(self, items):
+        """ :param items: (key, value) pairs from a constraints dict
+        """
+        self.checks = []
+        for k, v in items:
+            key = CONSTRAINT_KEYS[k]
+            if key == 'architecture':
+                self.checks.append((k, key, v))
+            else:
+                self.checks.append((k, key, human_to_mb(str(v))))
+
+    def match(self, columns):
+        """ Checks every machine in columns, one constraint at a time
+
+        :param columns: :class:`MachineColumns`
+        :rtype: :class:`ConstraintMatch`
+        """
+        failures = OrderedDict()
+        for k, key, bound in self.checks:
+            col = columns.columns[key]
+            if key == 'architecture':
+                ok = {_ANY_ARCH,
+                      columns.arch_codes.get(bound, _UNKNOWN_ARCH)}
+                failed = [c not in ok for c in col]
+            else:
+                failed = [v < bound for v in col]
+            failures[k] = failed
+
+        if len(failures) == 0:
+            mask = [True] * len(columns)
+        else:
+            mask = [not any(f) for f in zip(*failures.values())]
+        return ConstraintMatch(columns.machines, mask, failures)
+
+    def failed(self, machine):
+        """ Constraint keys a single machine fails, in constraint order
+
+        Same result as matching a one-machine MachineColumns, without
+        building one.
+
+        :rtype: list
+        """
+        node = machine.machine
+        failed = []
+        for k, key, bound in self.checks:
+            val = node.get(key, None)
+            if key == 'architecture':
+                ok = val == WILDCARD or val == bound
+            else:
+                ok = not _numeric_value(val) < bound
+            if not ok:
+                failed.append(k)
+        return failed
+
+
+@lru_cache(maxsize=256)
+def _compile(items):
+    return CompiledConstraints(items)
+
+
+def compile_constraints(constraints):
+    """ Compiles a constraints dict, caching the result
+
+    :param dict constraints: e.g. {'mem': '2G', 'arch': 'amd64'}; None
+                             or empty matches every machine
+    :rtype: :class:`CompiledConstraints`
+    """
+    if not constraints:
+        return _compile(())
+    return _compile(tuple(constraints.items()))
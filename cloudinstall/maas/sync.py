@@ -0,0 +1,184 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Incremental synchronisation of the MAAS node list """
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+import requests
+from requests_oauthlib import OAuth1
+
+log = logging.getLogger('cloudinstall.maas.sync')
+
+
+def maas_get(auth, url, params=None, headers=None):
+    """ An authenticated GET against a MAAS endpoint, signed as
+    maasclient.MaasClient.get() signs it, but with extra headers
+
+    :param auth: :class:`maasclient.auth.MaasAuth`
+    :param url: endpoint, relative to auth.api_url, eg. '/nodes/'
+    :rtype: :class:`requests.Response`
+    """
+    oauth = OAuth1(auth.consumer_key,
+                   client_secret=auth.consumer_secret,
+                   resource_owner_key=auth.token_key,
+                   resource_owner_secret=auth.token_secret,
+                   signature_method='PLAINTEXT',
+                   signature_type='query')
+    return requests.get(url=auth.api_url + url, auth=oauth, params=params,
+                        headers=headers)
+
+
+class MaasNodeSync:
+
+    """ Keeps a copy of the MAAS node list current with as little
+    traffic as possible
+
+    While nodes are being waited on (see watch()), refreshes fetch
+    only those, with op=list&id=..., and merge them into the copy. A
+    full listing is still made every full_sync_interval seconds, to
+    pick up nodes that were added or removed. With nothing watched,
+    every refresh is a full listing.
+
+    Full listings are conditional: the server's ETag and Last-Modified
+    are sent back, so an unchanged list costs a 304.
+
+    A failed request is logged and the last node list is kept, as
+    maasclient returns [] rather than raising.
+
+    stats() reports what this saved compared to fetching the whole list
+    on every refresh.
+    """
+
+    def __init__(self, maas_client, full_sync_interval=60):
+        """ Builds a MaasNodeSync
+
+        :param maas_client: :class:`maasclient.MaasClient`
+        :param full_sync_interval: most seconds between full listings
+                                   while only watched nodes are polled
+        """
+        self.maas_client = maas_client
+        self.full_sync_interval = full_sync_interval
+        self.watched = set()
+        self._lock = threading.Lock()
+        self._by_id = OrderedDict()
+        self._nodes = None
+        self._etag = None
+        self._last_modified = None
+        self._last_full = 0
+        self._full_size = 0
+        self._stats = dict(requests=0, full=0, partial=0, not_modified=0,
+                           errors=0, bytes_received=0, bytes_saved=0)
+
+    def watch(self, system_ids):
+        """ Sets the nodes to poll between full listings
+
+        :param system_ids: MAAS system ids; empty to go back to full
+                           listings on every refresh
+        """
+        with self._lock:
+            self.watched = set(system_ids)
+
+    def nodes(self):
+        """ Brings the node list up to date and returns it
+
+        :returns: node dicts as from the MAAS nodes API. The same list
+                  is returned for as long as nothing has changed.
+        :rtype: list
+        """
+        with self._lock:
+            due = time.time() - self._last_full >= self.full_sync_interval
+            try:
+                if self._nodes is None or due or len(self.watched) == 0:
+                    self._full()
+                else:
+                    self._partial(sorted(self.watched))
+            except requests.RequestException as e:
+                self._stats['errors'] += 1
+                log.warning("MAAS node sync failed, keeping the last node "
+                            "list: {}".format(e))
+                if self._nodes is None:
+                    return []
+            log.debug("MAAS node sync: {}".format(self._stats))
+            return self._nodes
+
+    def stats(self):
+        """ Traffic counters
+
+        requests, and how many of them were full, partial and
+        not_modified (304) listings, and errors; full_listings_saved,
+        the requests that did not transfer the whole list;
+        bytes_received, and bytes_saved compared to a full listing on
+        every refresh.
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['full_listings_saved'] = stats['partial'] + \
+            stats['not_modified']
+        return stats
+
+    def _get(self, params, headers=None):
+        res = maas_get(self.maas_client.auth, '/nodes/', params, headers)
+        self._stats['requests'] += 1
+        self._stats['bytes_received'] += len(res.content)
+        res.raise_for_status()
+        return res
+
+    def _full(self):
+        headers = {}
+        if self._nodes is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        res = self._get(dict(op='list'), headers)
+        self._last_full = time.time()
+        if res.status_code == 304:
+            self._stats['not_modified'] += 1
+            self._stats['bytes_saved'] += self._full_size - len(res.content)
+            return
+        self._stats['full'] += 1
+        self._full_size = len(res.content)
+        self._etag = res.headers.get('ETag', None)
+        self._last_modified = res.headers.get('Last-Modified', None)
+        nodes = res.json()
+        by_id = OrderedDict((n['system_id'], n) for n in nodes)
+        if self._nodes is None or by_id != self._by_id:
+            self._nodes = nodes
+            self._by_id = by_id
+
+    def _partial(self, system_ids):
+        res = self._get(dict(op='list', id=system_ids))
+        self._stats['partial'] += 1
+        self._stats['bytes_saved'] += max(0,
+                                          self._full_size - len(res.content))
+        fetched = {n['system_id']: n for n in res.json()}
+        changed = False
+        for system_id in system_ids:
+            node = fetched.get(system_id, None)
+            if node is None:
+                # deleted, or never existed
+                changed |= self._by_id.pop(system_id, None) is not None
+            elif self._by_id.get(system_id, None) != node:
+                self._by_id[system_id] = node
+                changed = True
+        if changed:
+            self._nodes = list(self._by_id.values())
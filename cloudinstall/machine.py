@@ -16,22 +16,88 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from functools import lru_cache
 import logging
 
 
 log = logging.getLogger('cloudinstall.machine')
 
+_MB = dict(M=1, G=1024, T=1024 * 1024, P=1024 * 1024 * 1024)
+
+
+@lru_cache(maxsize=1024)
+def size_to_mb(size):
+    """ Parses a size such as '2048M', '1.5G' or 512 into megabytes
+
+    :returns: size in megabytes, or None if size is missing or invalid
+    :rtype: int
+    """
+    if size is None:
+        return None
+    try:
+        if isinstance(size, str) and size[-1:] in _MB:
+            return int(float(size[:-1]) * _MB[size[-1]])
+        return int(float(size))
+    except ValueError:
+        return None
+
+
+def int_or_none(val):
+    """ int(val), or None if val is missing or not a number """
+    if val is None:
+        return None
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=1024)
+def parse_hardware(hardware):
+    """ Splits a juju 'Hardware' string into a dict
+
+    Machines of the same size share both the parse and the resulting
+    strings, so the result must not be modified.
+
+    :param str hardware: e.g. 'arch=amd64 cpu-cores=1 mem=1740M'
+    :rtype: dict
+    """
+    if not hardware:
+        return {}
+    return dict(item.split('=', 1) for item in hardware.split(' ')
+                if '=' in item)
+
 
 class Machine:
 
-    """ Base machine class """
+    """ Base machine class
+
+    The status entry is parsed once, when the Machine is built. As well
+    as the display strings (cpu_cores, mem, storage) the hardware is
+    available as numbers: cpu_count, mem_mb and storage_mb, which are
+    None when unknown.
+    """
+
+    __slots__ = ('machine_id', 'machine', 'instance_id', 'arch',
+                 'cpu_count', 'mem_mb', 'storage_mb',
+                 '_cpu_cores', '_mem', '_storage', '_containers',
+                 'agent', 'agent_state', 'agent_state_info',
+                 'agent_version', 'dns_name', 'err', 'has_vote',
+                 'wants_vote')
 
     def __init__(self, machine_id, machine):
         self.machine_id = machine_id
         self.machine = machine
-        self._cpu_cores = self.hardware('cpu-cores')
-        self._storage = self.hardware('root-disk')
-        self._mem = self.hardware('memory')
+        self.instance_id = self.machine.get('InstanceId', None)
+        hw = parse_hardware(self.machine.get('Hardware', None))
+        self.arch = hw.get('arch', "N/A")
+        self._cpu_cores = hw.get('cpu-cores', "N/A")
+        self._mem = hw.get('mem', "N/A")
+        self.cpu_count = int_or_none(hw.get('cpu-cores', None))
+        self.mem_mb = size_to_mb(hw.get('mem', None))
+        self.storage_mb = size_to_mb(hw.get('root-disk', None))
+        self._storage = None
+        self._containers = None
         self.agent = self.machine.get('Agent', None)
         self.agent_state = self.machine.get('AgentState', None)
         self.agent_state_info = self.machine.get('AgentStateInfo', None)
@@ -41,15 +107,6 @@ class Machine:
         self.has_vote = self.machine.get('HasVote')
         self.wants_vote = self.machine.get('WantsVote')
 
-    @property
-    def instance_id(self):
-        """ Returns InstanceId
-
-        :returns: instance ID
-        :rtype: str
-        """
-        return self.machine.get('InstanceId', None)
-
     @property
     def cpu_cores(self):
         """ Return number of cpu-cores
@@ -63,15 +120,6 @@ class Machine:
     def cpu_cores(self, val):
         self._cpu_cores = val
 
-    @property
-    def arch(self):
-        """ Return architecture
-
-        :returns: architecture type
-        :rtype: str
-        """
-        return self.hardware('arch')
-
     @property
     def storage(self):
         """ Return storage
@@ -79,11 +127,11 @@ class Machine:
         :returns: storage size
         :rtype: str
         """
-        try:
-            self._storage = int(self._storage[:-1]) / 1024
-            return "{size}G".format(size=str(self._storage))
-        except:
+        if self._storage is not None:
+            return self._storage
+        if self.storage_mb is None:
             return "N/A"
+        return "{size}G".format(size=self.storage_mb / 1024)
 
     @storage.setter
     def storage(self, val):
@@ -110,24 +158,23 @@ class Machine:
         :returns: hardware of spec
         :rtype: str
         """
-        _machine = self.machine.get('Hardware', None)
-        if _machine:
-            _hardware_list = _machine.split(' ')
-            for item in _hardware_list:
-                k, v = item.split('=')
-                if k in spec:
-                    return v
-        return "N/A"
+        return parse_hardware(self.machine.get('Hardware', None)).get(
+            spec, "N/A")
 
     @property
     def containers(self):
         """ Return containers for machine
 
-        :rtype: generator
+        Built on first access and then shared.
+
+        :rtype: list
         """
-        _containers = self.machine.get('Containers', {}).items()
-        for container_id, container in _containers:
-            yield Machine(container_id, container)
+        if self._containers is None:
+            self._containers = [
+                Machine(container_id, container)
+                for container_id, container in
+                (self.machine.get('Containers', None) or {}).items()]
+        return self._containers
 
     def container(self, container_id):
         """ Inspect a container
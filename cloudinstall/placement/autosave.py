@@ -0,0 +1,171 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Write-behind saving of placements.yaml
+
+PlacementController.do_autosave() hands the current placements to an
+AutosaveWriter and returns. The writer waits for a burst of changes to
+settle, dumps only the latest, and replaces the file in one rename, so
+a crash cannot leave it half written.
+"""
+
+import atexit
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import yaml
+
+log = logging.getLogger('cloudinstall.placement.autosave')
+
+
+def write_atomic(path, data):
+    """ Replaces path with data, through a temporary file in the same
+    directory, so readers see either the old or the new contents
+
+    :param str path: path of file to write to
+    :param str data: contents to write
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class AutosaveWriter:
+
+    """ Saves data to a file, YAML unless told otherwise, from a
+    background thread
+
+    save() only records the data. The thread writes it delay seconds
+    after the first save() of a burst, so any number of changes in that
+    time cost one write, of the last data saved. A write whose output is
+    the same as the last one written is skipped.
+
+    flush() writes whatever is pending straight away, and is registered
+    to run at exit.
+    """
+
+    def __init__(self, filename, delay=0.5, dump=yaml.dump):
+        """ :param filename: file to write
+            :param delay: seconds to wait for further changes
+            :param dump: function(data, f) that writes data to a text
+                         file object
+        """
+        self.filename = filename
+        self.delay = delay
+        self.dump = dump
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._pending = None
+        self._due = None
+        self._seq = 0
+        self._written_seq = 0
+        self._digest = None
+        self._thread = None
+        self._closed = False
+        self.write_count = 0
+        self.skip_count = 0
+        atexit.register(self.flush)
+
+    def save(self, data):
+        """ Schedules data to be written
+
+        :param data: anything dump accepts. It must not be changed
+                     afterwards.
+        """
+        with self._cond:
+            self._seq += 1
+            if self._pending is None:
+                self._due = time.time() + self.delay
+            self._pending = (self._seq, data)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run,
+                                                name='placement-autosave',
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """ Writes pending data now, and waits for any write under way """
+        with self._cond:
+            pending = self._pending
+            self._pending = None
+        if pending is not None:
+            self._write(*pending)
+        else:
+            with self._write_lock:
+                pass
+
+    def close(self):
+        """ Flushes and stops the writer thread """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+        if self._thread is not None:
+            self._thread.join()
+        atexit.unregister(self.flush)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                wait = self._due - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                pending = self._pending
+                self._pending = None
+            self._write(*pending)
+
+    def _write(self, seq, data):
+        with self._write_lock:
+            # a flush() may have written newer data while this waited
+            if seq <= self._written_seq:
+                return
+            self._written_seq = seq
+            try:
+                buf = io.StringIO()
+                self.dump(data, buf)
+                text = buf.getvalue()
+                digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                if digest == self._digest:
+                    self.skip_count += 1
+                    return
+                write_atomic(self.filename, text)
+                self._digest = digest
+                self.write_count += 1
+            except Exception:
+                log.exception("Error saving placements to "
+                              "'{}'".format(self.filename))
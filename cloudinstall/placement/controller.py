@@ -13,15 +13,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict, Counter
-import copy
+from collections import Counter, defaultdict, OrderedDict
 from enum import Enum
 import logging
-import yaml
 from multiprocessing import cpu_count
 
-from cloudinstall.maas import (satisfies, MaasMachineStatus)
-from cloudinstall.utils import load_charms
+from cloudinstall.maas import MaasMachineStatus
+from cloudinstall.maas.constraints import (compile_constraints,
+                                           MachineColumns)
+from cloudinstall.placement.solver import (BEST_FIT, FIRST_FIT,
+                                           PlacementSolver, SOLVERS)
+from cloudinstall.charm_registry import charm_registry
+from cloudinstall.placement.autosave import AutosaveWriter
+from cloudinstall.placement.fileformat import (PlacementFormatError,
+                                               read_placements,
+                                               write_placements)
+from cloudinstall.placement.graph import CharmGraph
+from cloudinstall.placement.store import PlacementStore
 from cloudinstall.state import CharmState
 
 log = logging.getLogger('cloudinstall.placement')
@@ -106,6 +114,101 @@ class PlacementError(Exception):
     "Generic exception class for placement related errors"
 
 
+class PlacementIndex:
+
+    """Reverse indexes over an {instance_id: {atype: [charm_class]}} dict
+    of assignments or deployments.
+
+    by_charm is {charm_class: {instance_id: Counter(atype)}}, by_machine
+    is {instance_id: Counter(charm_class)} and counts is
+    Counter(charm_class). add() and remove() keep them up to date in
+    constant time; rebuild() makes them again from a whole dict.
+
+    on_change, if given, is called with each charm class that is added
+    or removed, and with None after a rebuild.
+    """
+
+    def __init__(self, placements=None, on_change=None):
+        self.on_change = on_change
+        self.rebuild(placements or {})
+
+    def _changed(self, cc):
+        if self.on_change is not None:
+            self.on_change(cc)
+
+    def rebuild(self, placements):
+        self.by_charm = defaultdict(dict)
+        self.by_machine = OrderedDict()
+        self.counts = Counter()
+        for iid, ad in placements.items():
+            for atype, al in ad.items():
+                for cc in al:
+                    self._add(iid, atype, cc)
+        self._changed(None)
+
+    def add(self, iid, atype, cc):
+        self._add(iid, atype, cc)
+        self._changed(cc)
+
+    def _add(self, iid, atype, cc):
+        self.by_charm[cc].setdefault(iid, Counter())[atype] += 1
+        self.by_machine.setdefault(iid, Counter())[cc] += 1
+        self.counts[cc] += 1
+
+    def remove(self, iid, atype, cc):
+        atypes = self.by_charm[cc][iid]
+        atypes[atype] -= 1
+        if atypes[atype] == 0:
+            del atypes[atype]
+        if len(atypes) == 0:
+            del self.by_charm[cc][iid]
+
+        charms = self.by_machine[iid]
+        charms[cc] -= 1
+        if charms[cc] == 0:
+            del charms[cc]
+        if len(charms) == 0:
+            del self.by_machine[iid]
+
+        self.counts[cc] -= 1
+        if self.counts[cc] == 0:
+            del self.counts[cc]
+        self._changed(cc)
+
+    def remove_machine(self, iid):
+        for cc in self.by_machine.pop(iid, {}):
+            self.counts[cc] -= sum(self.by_charm[cc].pop(iid).values())
+            if self.counts[cc] == 0:
+                del self.counts[cc]
+            self._changed(cc)
+
+    def charms(self):
+        """Charm classes placed at least once"""
+        return set(self.counts)
+
+    def copy(self, on_change=None):
+        """A copy that shares nothing with this index"""
+        new = PlacementIndex.__new__(PlacementIndex)
+        new.on_change = on_change
+        new.by_charm = defaultdict(dict)
+        for cc, machines in self.by_charm.items():
+            new.by_charm[cc] = {iid: Counter(atypes)
+                                for iid, atypes in machines.items()}
+        new.by_machine = OrderedDict((iid, Counter(charms))
+                                     for iid, charms in
+                                     self.by_machine.items())
+        new.counts = Counter(self.counts)
+        return new
+
+    def replace_machine(self, iid, placements):
+        """Replaces what is indexed for machine iid with placements, an
+        {atype: [charm_class]} dict"""
+        self.remove_machine(iid)
+        for atype, al in placements.items():
+            for cc in al:
+                self.add(iid, atype, cc)
+
+
 class PlacementController:
 
     """Keeps state of current machines and their assigned services.
@@ -125,10 +228,16 @@ class PlacementController:
         self.def_placeholder = PlaceholderMachine('_default',
                                                   'Juju Default')
         # assignments is {id: {atype: [charm class]}}
-        self.assignments = defaultdict(lambda: defaultdict(list))
-        self.deployments = defaultdict(lambda: defaultdict(list))
+        self.assignments = PlacementStore()
+        self.deployments = PlacementStore()
+        self._graph = None
+        self._graph_charms = None
+        self._charm_states = {}
+        self._assigned = PlacementIndex(on_change=self._charm_changed)
+        self._deployed = PlacementIndex(on_change=self._charm_changed)
+        self._machines_by_id = {}
         self.autosave_filename = None
-        self.reset_assigned_deployed()
+        self._autosave_writer = None
 
     def get_temp_copy(self):
         """Returns another PlacementController that can be used to track
@@ -136,47 +245,91 @@ class PlacementController:
         assignments in a dialog box.
 
         Pairs with update_from_controller() to 'commit' those temporary
-        assignments to the 'main' controller.
+        assignments to the 'main' controller. To cancel them, drop the
+        copy.
+
+        The copy's assignments and deployments are snapshots of this
+        controller's, and its indexes and charm states are copied, so
+        making one lists no machines and reloads no charms.
         """
         newpc = PlacementController(maas_state=self.maas_state,
                                     config=self.config)
-        newpc.assignments = copy.copy(self.assignments)
-        newpc.deployments = copy.copy(self.deployments)
+        newpc.assignments = self.assignments.snapshot()
+        newpc.deployments = self.deployments.snapshot()
+        newpc._assigned = self._assigned.copy(newpc._charm_changed)
+        newpc._deployed = self._deployed.copy(newpc._charm_changed)
         newpc._machines = self._machines
-        newpc.reset_assigned_deployed()
+        newpc._machines_by_id = dict(self._machines_by_id)
+        newpc._graph = self._graph
+        newpc._graph_charms = self._graph_charms
+        newpc._charm_states = dict(self._charm_states)
         return newpc
 
     def update_from_controller(self, other):
         """Updates internal structures based on other's.
-        For integrating temporarily tracked updates."""
+        For integrating temporarily tracked updates.
 
-        self.assignments = other.assignments
-        self.deployments = other.deployments
-        self.reset_assigned_deployed()
+        If other came from get_temp_copy() on this controller, only the
+        machines it changed are updated.
+        """
+        if other.assignments._base is not self.assignments or \
+           other.deployments._base is not self.deployments:
+            self.assignments = PlacementStore(other.assignments)
+            self.deployments = PlacementStore(other.deployments)
+            self.reset_assigned_deployed()
+            return
+
+        self._machines_by_id.update(other._machines_by_id)
+        for store, index in ((other.assignments, self._assigned),
+                             (other.deployments, self._deployed)):
+            for iid, placements in store.commit().items():
+                index.replace_machine(iid, placements)
+        self.do_autosave()
 
     def set_assignments_from_deployments(self):
         """Reset deployment state of all services. Useful after reading a file
         from a previous install.
         """
         self.assignments = self.deployments
-        self.deployments = defaultdict(lambda: defaultdict(list))
+        self.deployments = PlacementStore()
         self.reset_assigned_deployed()
 
     def __repr__(self):
         return "<PlacementController {}>".format(id(self))
 
     def set_autosave_filename(self, filename):
+        if self._autosave_writer is not None:
+            self._autosave_writer.close()
+            self._autosave_writer = None
         self.autosave_filename = filename
+        if filename:
+            self._autosave_writer = AutosaveWriter(filename,
+                                                   dump=write_placements)
 
     def do_autosave(self):
+        """Schedules a save to autosave_filename. The file is written in
+        the background, once a burst of changes has settled; see
+        flush_autosave().
+        """
         if not self.autosave_filename:
             return
-        with open(self.autosave_filename, 'w') as af:
-            self.save(af)
+        self._autosave_writer.save(self._flat_placements())
+
+    def flush_autosave(self):
+        """Writes any autosave still pending, and waits for it."""
+        if self._autosave_writer is not None:
+            self._autosave_writer.flush()
 
     def save(self, f):
         """f is a file-like object to save state to, to be re-read by
-        load(). No guarantees made about the contents of the file.
+        load(). No guarantees made about the contents of the file,
+        beyond those of cloudinstall.placement.fileformat.
+        """
+        write_placements(self._flat_placements(), f)
+
+    def _flat_placements(self):
+        """The placements as plain dicts and charm names, sharing nothing
+        with the controller's own structures.
         """
         flat_assignments = defaultdict(dict)
         for iid, ad in self.assignments.items():
@@ -198,27 +351,30 @@ class PlacementController:
         for iid in flat_assignments.keys():
             constraints = {}
             if self.maas_state is None:
-                machine = next((m for m in self.machines() if
-                                m.instance_id == iid), None)
+                machine = self._machine(iid)
                 if machine:
-                    constraints = machine.constraints
+                    constraints = dict(machine.constraints)
                     flat_assignments[iid]['constraints'] = constraints
 
-        yaml.dump(flat_assignments, f)
+        return dict(flat_assignments)
 
     def load(self, f):
-        """Load assignments from file object written to by save().
-        replaces current assignments.
+        """Load assignments from file object written to by save(), in
+        any placement file version. replaces current assignments.
         """
-        def find_charm_class(name):
-            for cc in self.charm_classes():
-                if cc.charm_name == name:
-                    return cc
-            log.warning("Could not find charm class "
-                        "matching saved charm name {}".format(name))
-            return None
+        charm_classes = {cc.charm_name: cc for cc in self.charm_classes()}
 
-        file_assignments = yaml.load(f)
+        def find_charm_class(name):
+            cc = charm_classes.get(name, None)
+            if cc is None:
+                log.warning("Could not find charm class "
+                            "matching saved charm name {}".format(name))
+            return cc
+
+        try:
+            file_assignments = read_placements(f)
+        except PlacementFormatError as e:
+            raise PlacementError(str(e))
         new_assignments = defaultdict(lambda: defaultdict(list))
         new_deployments = defaultdict(lambda: defaultdict(list))
         for iid, d in file_assignments.items():
@@ -245,13 +401,15 @@ class PlacementController:
                 at = AssignmentType.__members__[atypestr]
                 new_deployments[iid][at] = new_dl
 
-        self.assignments.clear()
-        self.assignments.update(new_assignments)
-        self.deployments.clear()
-        self.deployments.update(new_deployments)
+        self.assignments = PlacementStore(new_assignments)
+        self.deployments = PlacementStore(new_deployments)
         self.reset_assigned_deployed()
 
     def update_and_save(self):
+        """Rebuilds the indexes from assignments and deployments, and
+        saves. Needed after replacing either dict; changes made through
+        assign() and friends keep the indexes up to date themselves.
+        """
         self.reset_assigned_deployed()
         self.do_autosave()
 
@@ -284,20 +442,31 @@ class PlacementController:
 
         """
         ms = []
-        for m in self.machines(include_placeholders=include_placeholders):
-            if m.instance_id in self.assignments:
-                n = sum(len(cl) for _, cl in
-                        self.assignments[m.instance_id].items())
-                if n > 0:
-                    ms.append(m)
+        for iid in self._assigned.by_machine:
+            if not include_placeholders and self.is_placeholder(iid):
+                continue
+            m = self._machine(iid)
+            if m is not None:
+                ms.append(m)
         return ms
 
-    def charm_classes(self):
-        cl = [m.__charm_class__ for m in
-              load_charms(self.config.getopt('charm_plugin_dir'))
-              if not m.__charm_class__.disabled]
+    def _machine(self, iid):
+        """Machine for an instance id, from those passed to assign() or
+        last listed by machines(). machines() is listed again only if the
+        id is unknown.
+        """
+        m = self._machines_by_id.get(iid, None)
+        if m is None:
+            self._learn_machines()
+            m = self._machines_by_id.get(iid, None)
+        return m
 
-        return cl
+    def _learn_machines(self):
+        self._machines_by_id = {m.instance_id: m for m in self.machines()}
+
+    def charm_classes(self):
+        registry = charm_registry(self.config.getopt('charm_plugin_dir'))
+        return list(registry.enabled)
 
     def assigned_charm_classes(self):
         """Returns a deduplicated list of all charms that have a placement
@@ -313,35 +482,36 @@ class PlacementController:
 
     def assign(self, machine, charm_class, atype):
         if not charm_class.allow_multi_units:
-            for m, d in self.assignments.items():
-                for at, l in d.items():
-                    if charm_class in l:
-                        l.remove(charm_class)
-
-        self.assignments[machine.instance_id][atype].append(charm_class)
-        self.update_and_save()
+            placed = self._assigned.by_charm[charm_class]
+            for iid, atypes in list(placed.items()):
+                for at in list(atypes.elements()):
+                    self.assignments.remove(iid, at, charm_class)
+                    self._assigned.remove(iid, at, charm_class)
+
+        self._machines_by_id[machine.instance_id] = machine
+        self.assignments.add(machine.instance_id, atype, charm_class)
+        self._assigned.add(machine.instance_id, atype, charm_class)
+        self.do_autosave()
 
     def mark_deployed(self, machine, charm_class, atype):
-        self.deployments[machine.instance_id][atype].append(charm_class)
-        self.assignments[machine.instance_id][atype].remove(charm_class)
-        self.update_and_save()
+        self._machines_by_id[machine.instance_id] = machine
+        self.deployments.add(machine.instance_id, atype, charm_class)
+        self._deployed.add(machine.instance_id, atype, charm_class)
+        self.assignments.remove(machine.instance_id, atype, charm_class)
+        self._assigned.remove(machine.instance_id, atype, charm_class)
+        self.do_autosave()
 
-    def _get_machines_by_atype(self, a_dict, charm_class):
+    def _get_machines_by_atype(self, index, charm_class):
         "Helper for get_assignments and get_deployments"
-        all_machines = self.machines()
-
         machines_by_atype = defaultdict(list)
-        for m_id, d in a_dict.items():
-            m = next((m for m in all_machines
-                      if m.instance_id == m_id), None)
+        for m_id, atypes in index.by_charm.get(charm_class, {}).items():
+            m = self._machine(m_id)
             if not m:
                 log.debug("can't find machine for m_id '{}'".format(m_id))
                 continue
 
-            for atype, assignment_list in d.items():
-                for c in assignment_list:
-                    if c == charm_class:
-                        machines_by_atype[atype].append(m)
+            for atype in atypes.elements():
+                machines_by_atype[atype].append(m)
 
         return machines_by_atype
 
@@ -350,19 +520,17 @@ class PlacementController:
 
         returns a dict like {assignment_type : [machines]}
         """
-        return self._get_machines_by_atype(self.assignments,
-                                           charm_class)
+        return self._get_machines_by_atype(self._assigned, charm_class)
 
     def get_deployments(self, charm_class):
         """returns deployments for a given charm
 
         returns a dict like {assignment_type : [machines]}
         """
-        return self._get_machines_by_atype(self.deployments,
-                                           charm_class)
+        return self._get_machines_by_atype(self._deployed, charm_class)
 
     def clear_all_assignments(self):
-        self.assignments = defaultdict(lambda: defaultdict(list))
+        self.assignments = PlacementStore()
         self.update_and_save()
 
     def clear_assignments(self, m):
@@ -373,72 +541,94 @@ class PlacementController:
             return
 
         del self.assignments[m.instance_id]
-        self.update_and_save()
+        self._assigned.remove_machine(m.instance_id)
+        self.do_autosave()
 
     def remove_one_assignment(self, m, cc):
         ad = self.assignments[m.instance_id]
         for atype, assignment_list in ad.items():
             if cc in assignment_list:
-                assignment_list.remove(cc)
+                self.assignments.remove(m.instance_id, atype, cc)
+                self._assigned.remove(m.instance_id, atype, cc)
                 break
-        self.update_and_save()
+        self.do_autosave()
 
     def assignments_for_machine(self, m):
         """Returns all assignments for given machine
 
-        {assignment_type: [charm_class]}
+        {assignment_type: [charm_class]}, which must not be changed
         """
         return self.assignments[m.instance_id]
 
     def deployments_for_machine(self, m):
         """Returns deployments
-        {atype: [charm_class]}
+        {atype: [charm_class]}, which must not be changed
         """
         return self.deployments[m.instance_id]
 
     def is_assigned_to(self, charm_class, machine):
-        assignment_dict = self.assignments[machine.instance_id]
-        for atype, charm_classes in assignment_dict.items():
-            if charm_class in charm_classes:
-                return True
-        return False
+        return machine.instance_id in \
+            self._assigned.by_charm.get(charm_class, {})
 
     def is_deployed_to(self, charm_class, machine):
-        dd = self.deployments[machine.instance_id]
-        for atype, charm_classes in dd.items():
-            if charm_class in charm_classes:
-                return True
-        return False
+        return machine.instance_id in \
+            self._deployed.by_charm.get(charm_class, {})
 
     def set_all_assignments(self, assignments):
-        self.assignments = assignments
+        self.assignments = PlacementStore(assignments)
         self.update_and_save()
 
     def reset_assigned_deployed(self):
-        self.assigned_services = set()
-        self.deployed_services = set()
-        for cc in self.charm_classes():
-            ad = self.get_assignments(cc)
-            is_assigned = False
-            for atype, al in ad.items():
-                if len(al) > 0:
-                    is_assigned = True
-            if is_assigned:
-                self.assigned_services.add(cc)
+        """Rebuilds the assignment and deployment indexes from the
+        assignments and deployments dicts"""
+        self._assigned.rebuild(self.assignments)
+        self._deployed.rebuild(self.deployments)
+        self._learn_machines()
 
-            dd = self.get_deployments(cc)
-            is_deployed = False
-            for atype, dl in dd.items():
-                if len(dl) > 0:
-                    is_deployed = True
-            if is_deployed:
-                self.deployed_services.add(cc)
+    @property
+    def assigned_services(self):
+        """Charm classes with at least one assignment"""
+        return self._assigned.charms()
+
+    @property
+    def deployed_services(self):
+        """Charm classes with at least one deployment"""
+        return self._deployed.charms()
 
     def is_assigned(self, charm):
-        return charm in self.assigned_services
+        return self._assigned.counts[charm] > 0
 
     def is_deployed(self, charm):
-        return charm in self.deployed_services
+        return self._deployed.counts[charm] > 0
+
+    def charm_graph(self):
+        """The dependency and conflict graph of charm_classes(), built
+        again only when the charm registry reloads.
+
+        :rtype: :class:`~cloudinstall.placement.graph.CharmGraph`
+        """
+        registry = charm_registry(self.config.getopt('charm_plugin_dir'))
+        if self._graph is None or self._graph_charms is not registry.enabled:
+            self._graph = CharmGraph(registry.enabled)
+            self._graph_charms = registry.enabled
+            self._charm_states.clear()
+        return self._graph
+
+    def _charm_changed(self, charm_class):
+        """Forgets the cached states that an assignment or deployment
+        change to charm_class can affect, or all of them for None."""
+        if charm_class is None or self._graph is None:
+            self._charm_states.clear()
+            return
+        self._graph.ensure(charm_class)
+        for cc in self._graph.affects[charm_class]:
+            self._charm_states.pop(cc, None)
+
+    def get_charm_states(self):
+        """Returns {charm_class: (state, cons, deps)} for every charm in
+        charm_classes(), as get_charm_state() would.
+        """
+        return {cc: self.get_charm_state(cc) for cc in self.charm_classes()}
 
     def get_charm_state(self, charm):
         """Returns tuple of charm state:
@@ -459,35 +649,35 @@ class PlacementController:
 
         - OPTIONAL means that it is ok either way. deps and cons are unused
 
+        States are cached, and recomputed only after a change to the
+        assignments or deployments of a charm that can affect them.
         """
-        state = CharmState.OPTIONAL
-        conflicting = set()
-        depending = set()
-
-        def conflicts_with(other_charm):
-            return (charm.charm_name in other_charm.conflicts or
-                    other_charm.charm_name in charm.conflicts)
-
-        def depends(a_charm, b_charm):
-            return b_charm.charm_name in a_charm.depends
+        graph = self.charm_graph()
+        cached = self._charm_states.get(charm, None)
+        if cached is None:
+            cached = self._compute_charm_state(graph.ensure(charm), graph)
+            self._charm_states[charm] = cached
+        state, conflicting, depending = cached
+        return (state, list(conflicting), list(depending))
 
-        required_charms = [c for c in self.charm_classes()
-                           if c.is_core]
+    def _compute_charm_state(self, charm, graph):
+        def planned_or_deployed(other_charm):
+            return (other_charm in graph.core or
+                    self.is_assigned(other_charm) or
+                    self.is_deployed(other_charm))
 
-        planned_or_deployed = (self.assigned_charm_classes() +
-                               required_charms +
-                               self.deployed_charm_classes())
+        conflicting = [c for c in graph.conflicts[charm]
+                       if planned_or_deployed(c)]
+        depending = [c for c in graph.dependents[charm]
+                     if planned_or_deployed(c)]
 
-        for other_charm in planned_or_deployed:
-            if conflicts_with(other_charm):
-                state = CharmState.CONFLICTED
-                conflicting.add(other_charm)
-            if depends(other_charm, charm):
-                if state != CharmState.CONFLICTED:
-                    state = CharmState.REQUIRED
-                depending.add(other_charm)
+        state = CharmState.OPTIONAL
+        if len(conflicting) > 0:
+            state = CharmState.CONFLICTED
+        elif len(depending) > 0:
+            state = CharmState.REQUIRED
 
-        if charm in required_charms:
+        if charm in graph.core:
             state = CharmState.REQUIRED
 
         n_required = charm.required_num_units()
@@ -506,7 +696,7 @@ class PlacementController:
         elif state == CharmState.REQUIRED and n_units >= n_required:
             state = CharmState.OPTIONAL
 
-        return (state, list(conflicting), list(depending))
+        return (state, conflicting, depending)
 
     def unassigned_undeployed_services(self):
         all_charms = set(self.charm_classes())
@@ -528,12 +718,12 @@ class PlacementController:
     def assignment_machine_count_for_charm(self, cc):
         """Returns the total number of assignments of any type for a given
         charm."""
-        return sum([len(al) for al in self.get_assignments(cc).values()])
+        return self._assigned.counts[cc]
 
     def deployment_machine_count_for_charm(self, cc):
         """Returns the total number of deployments of any type for a given
         charm."""
-        return sum([len(al) for al in self.get_deployments(cc).values()])
+        return self._deployed.counts[cc]
 
     def autoassign_unassigned_services(self):
         """Attempt to find machines for all required unassigned services using
@@ -567,7 +757,8 @@ class PlacementController:
             return (False, msg + "\n" + m)
         return (True, "")
 
-    def gen_defaults(self, charm_classes=None, maas_machines=None):
+    def gen_defaults(self, charm_classes=None, maas_machines=None,
+                     solver=None):
         """Generates an assignments dictionary for the given charm classes and
         machines, based on constraints.
 
@@ -576,6 +767,10 @@ class PlacementController:
         Use set_all_assignments(gen_defaults()) to clear and reset the
         controller's state to these defaults.
 
+        solver is 'first-fit' or 'best-fit', see
+        :mod:`cloudinstall.placement.solver`. It defaults to the
+        placement_solver config option, and then to 'first-fit'.
+
         Should not be used for single installs, see gen_single.
         """
         if self.maas_state is None:
@@ -589,13 +784,14 @@ class PlacementController:
         if maas_machines is None:
             maas_machines = self.maas_state.machines(MaasMachineStatus.READY)
 
-        def satisfying_machine(constraints):
-            for machine in maas_machines:
-                if satisfies(machine, constraints)[0]:
-                    maas_machines.remove(machine)
-                    return machine
-
-            return None
+        if solver is None and self.config is not None:
+            solver = self.config.getopt('placement_solver')
+        if not solver:
+            solver = FIRST_FIT
+        if solver not in SOLVERS:
+            raise PlacementError("Unknown placement solver '{}', "
+                                 "expected one of {}".format(
+                                     solver, ", ".join(SOLVERS)))
 
         isolated_charms, controller_charms = [], []
         subordinate_charms = []
@@ -613,19 +809,21 @@ class PlacementController:
             else:
                 controller_charms.append(charm_class)
 
-        for charm_class in isolated_charms:
-            for n in range(charm_class.required_num_units()):
-                m = satisfying_machine(charm_class.constraints)
-                if m:
-                    l = assignments[m.instance_id][AssignmentType.BareMetal]
-                    l.append(charm_class)
+        if solver == BEST_FIT:
+            isolated, shared = PlacementSolver(maas_machines).solve(
+                isolated_charms, controller_charms)
+        else:
+            isolated, shared = self._first_fit(maas_machines,
+                                               isolated_charms,
+                                               controller_charms)
 
-        controller_machine = satisfying_machine({})
-        if controller_machine:
-            for charm_class in controller_charms:
-                ad = assignments[controller_machine.instance_id]
-                l = ad[DEFAULT_SHARED_ASSIGNMENT_TYPE]
-                l.append(charm_class)
+        for m, charm_class in isolated:
+            l = assignments[m.instance_id][AssignmentType.BareMetal]
+            l.append(charm_class)
+
+        for m, charm_class in shared:
+            l = assignments[m.instance_id][DEFAULT_SHARED_ASSIGNMENT_TYPE]
+            l.append(charm_class)
 
         for charm_class in subordinate_charms:
             ad = assignments[self.sub_placeholder.instance_id]
@@ -636,6 +834,38 @@ class PlacementController:
         log.debug(pprint.pformat(assignments))
         return assignments
 
+    def _first_fit(self, maas_machines, isolated_charms, controller_charms):
+        """Gives each isolated charm unit the first machine that satisfies
+        it, and all controller charms the next machine.
+
+        Returns ([(machine, charm_class)], [(machine, charm_class)]) as
+        PlacementSolver.solve() does.
+        """
+        columns = MachineColumns(maas_machines)
+        available = [True] * len(columns)
+
+        def satisfying_machine(constraints):
+            match = compile_constraints(constraints).match(columns)
+            for i, ok in enumerate(match.mask):
+                if ok and available[i]:
+                    available[i] = False
+                    return columns.machines[i]
+
+            return None
+
+        isolated = []
+        for charm_class in isolated_charms:
+            for n in range(charm_class.required_num_units()):
+                m = satisfying_machine(charm_class.constraints)
+                if m:
+                    isolated.append((m, charm_class))
+
+        controller_machine = satisfying_machine({})
+        if controller_machine is None:
+            return isolated, []
+        return isolated, [(controller_machine, charm_class)
+                          for charm_class in controller_charms]
+
     def gen_single(self):
         """Generates an assignment for the single installer."""
         assignments = defaultdict(lambda: defaultdict(list))
@@ -0,0 +1,125 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Reading and writing placement files
+
+Version 2 is a JSON document with a header, one line per machine and a
+table of charm names that the machines refer to by index:
+
+    {"format": "cloud-install-placements", "version": 2,
+     "machines": {
+      "node-1": {"assignments": {"LXC": [0, 1]}},
+      "node-2": {"deployments": {"KVM": [0]}, "constraints": {...}}},
+     "charms": ["nova-compute", "keystone"]}
+
+Files without a version are version 1, the YAML dump of the same
+{instance_id: {'assignments'|'deployments': {atype: [charm_name]}}}
+dict that read_placements() returns.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+
+import yaml
+
+log = logging.getLogger('cloudinstall.placement.fileformat')
+
+FORMAT_NAME = 'cloud-install-placements'
+FORMAT_VERSION = 2
+
+_PLACEMENT_KEYS = ('assignments', 'deployments')
+
+
+class PlacementFormatError(Exception):
+
+    "A placement file that cannot be read"
+
+
+def write_placements(placements, f):
+    """ Writes placements to f in the current format, a machine at a time
+
+    :param placements: {instance_id: {'assignments'|'deployments':
+                       {atype_name: [charm_name]}, 'constraints': {}}}
+    :param f: text file-like object
+    """
+    charm_ids = OrderedDict()
+
+    def charm_id(name):
+        return charm_ids.setdefault(name, len(charm_ids))
+
+    f.write('{{"format": "{}", "version": {},\n "machines": {{'.format(
+        FORMAT_NAME, FORMAT_VERSION))
+    sep = '\n  '
+    for iid, d in placements.items():
+        entry = {}
+        for key in _PLACEMENT_KEYS:
+            if key in d:
+                entry[key] = {atype: [charm_id(name) for name in names]
+                              for atype, names in d[key].items()}
+        if 'constraints' in d:
+            entry['constraints'] = d['constraints']
+        f.write(sep)
+        f.write(json.dumps(iid))
+        f.write(': ')
+        f.write(json.dumps(entry, sort_keys=True))
+        sep = ',\n  '
+    f.write('},\n "charms": ')
+    f.write(json.dumps(list(charm_ids)))
+    f.write('}\n')
+
+
+def read_placements(f):
+    """ Reads a placement file of any version
+
+    :param f: text file-like object
+    :returns: {instance_id: {'assignments'|'deployments':
+              {atype_name: [charm_name]}, 'constraints': {}}}
+    :raises PlacementFormatError: for a version newer than this reads
+    """
+    text = f.read()
+    if text.lstrip().startswith('{'):
+        try:
+            doc = json.loads(text)
+        except ValueError:
+            doc = None
+        if isinstance(doc, dict) and 'version' in doc:
+            return _read_v2(doc)
+    return yaml.load(text) or {}
+
+
+def _read_v2(doc):
+    version = doc['version']
+    if doc.get('format', None) != FORMAT_NAME or \
+       not isinstance(version, int):
+        raise PlacementFormatError("Not a placement file")
+    if version > FORMAT_VERSION:
+        raise PlacementFormatError(
+            "Placement file version {} is newer than the supported "
+            "version {}".format(version, FORMAT_VERSION))
+
+    names = doc.get('charms', [])
+    placements = {}
+    for iid, entry in doc.get('machines', {}).items():
+        d = {}
+        for key in _PLACEMENT_KEYS:
+            if key in entry:
+                d[key] = {atype: [names[i] for i in ids]
+                          for atype, ids in entry[key].items()}
+        if 'constraints' in entry:
+            d['constraints'] = entry['constraints']
+        placements[iid] = d
+    return placements
@@ -0,0 +1,81 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Dependency and conflict graph between charm classes """
+
+import logging
+
+log = logging.getLogger('cloudinstall.placement.graph')
+
+
+class CharmGraph:
+
+    """ Who conflicts with and depends on whom, from the charm classes'
+    conflicts, depends and is_core attributes
+
+    conflicts[a] holds every charm a conflicts with, in either
+    direction. dependents[a] holds the charms whose depends names a.
+    affects[a] holds the charms whose CharmState can change when a is
+    assigned, deployed or unassigned: a itself, the charms it conflicts
+    with, and the charms it depends on.
+
+    core holds the is_core charms among those the graph was built with.
+    Other charm classes are added on first use, but never as core.
+    """
+
+    def __init__(self, charm_classes):
+        self.charm_classes = list(charm_classes)
+        self.core = set(cc for cc in self.charm_classes if cc.is_core)
+        self.conflicts = {}
+        self.dependents = {}
+        self.affects = {}
+        for cc in self.charm_classes:
+            self._add(cc)
+
+    def _add(self, charm):
+        if charm not in self.charm_classes:
+            self.charm_classes.append(charm)
+        conflicts = set(other for other in self.charm_classes
+                        if (charm.charm_name in other.conflicts or
+                            other.charm_name in charm.conflicts))
+        dependents = set(other for other in self.charm_classes
+                         if charm.charm_name in other.depends)
+        depends_on = set(other for other in self.charm_classes
+                         if other.charm_name in charm.depends)
+        self.conflicts[charm] = conflicts
+        self.dependents[charm] = dependents
+        self.affects[charm] = set([charm]) | conflicts | depends_on
+
+        # and the edges back from charms already in the graph
+        for other in conflicts:
+            if other in self.conflicts:
+                self.conflicts[other].add(charm)
+                self.affects[other].add(charm)
+        for other in depends_on:
+            if other in self.dependents:
+                self.dependents[other].add(charm)
+        for other in dependents:
+            if other in self.affects:
+                self.affects[other].add(charm)
+
+    def ensure(self, charm):
+        """ Adds charm to the graph if it is not there yet
+
+        :returns: charm
+        """
+        if charm not in self.conflicts:
+            self._add(charm)
+        return charm
@@ -0,0 +1,224 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Best-fit placement of charms onto MAAS machines
+
+Used by PlacementController.gen_defaults() when the config option
+placement_solver is 'best-fit'. The default, 'first-fit', takes the
+first machine that satisfies each charm and puts every controller
+service on one machine.
+"""
+
+import heapq
+import logging
+
+from cloudinstall.maas.constraints import (compile_constraints,
+                                           MachineColumns, NUMERIC_KEYS)
+
+log = logging.getLogger('cloudinstall.placement.solver')
+
+# What a controller service in a container is taken to need when its
+# charm has no mem or cpu_cores constraint
+CONTAINER_MEM_MB = 1024
+CONTAINER_CPU_COUNT = 1
+
+FIRST_FIT = 'first-fit'
+BEST_FIT = 'best-fit'
+SOLVERS = (FIRST_FIT, BEST_FIT)
+
+
+class PlacementSolver:
+
+    """ Places isolated charms on the smallest machines that satisfy
+    them, and controller services on the machines with the most CPU and
+    memory headroom
+
+    Isolated charm units are placed best-fit-decreasing: the units
+    asking for the most hardware choose first, and each takes the
+    smallest available machine that satisfies it. Machine size is the
+    sum of its memory, storage and cores, each scaled by the largest in
+    the inventory.
+
+    Controller services are then spread over the remaining machines,
+    one at a time, onto whichever has the most CPU and memory left.
+    Each service uses up its mem and cpu_cores constraints, or
+    CONTAINER_MEM_MB and CONTAINER_CPU_COUNT.
+
+    A machine with '*' hardware is taken to be larger than any other.
+    """
+
+    def __init__(self, machines):
+        """ :param machines: machines to place on, usually READY MAAS
+                             machines
+        """
+        self.columns = MachineColumns(machines)
+        cols = self.columns.columns
+        self.scale = {}
+        for key in NUMERIC_KEYS:
+            known = [v for v in cols[key] if abs(v) != float('inf')]
+            self.scale[key] = max(known + [1]) or 1
+        self.size = [sum(cols[key][i] / self.scale[key]
+                         for key in NUMERIC_KEYS)
+                     for i in range(len(self.columns))]
+        self.by_size = sorted(range(len(self.columns)),
+                              key=self.size.__getitem__)
+        self.available = [True] * len(self.columns)
+        self.report = None
+        self._masks = {}
+
+    def solve(self, isolated_charms, controller_charms):
+        """ Places charms; each machine is used for isolated charms or
+        controller services, not both
+
+        :param isolated_charms: charm classes needing their own machine,
+                                required_num_units() units each
+        :param controller_charms: charm classes to place in containers,
+                                  one unit each
+        :returns: ([(machine, charm_class)] for isolated units,
+                   [(machine, charm_class)] for controller services).
+                   Charms that could not be placed are left out and
+                   listed in self.report['unplaced'].
+        """
+        unplaced = []
+        isolated = self._place_isolated(isolated_charms, unplaced)
+        shared, headroom = self._place_shared(controller_charms, unplaced)
+        self.report = self._make_report(isolated, shared, headroom,
+                                        unplaced)
+        log.info("Placement: {}".format(self.report))
+        machines = self.columns.machines
+        return ([(machines[i], cc) for i, cc in isolated],
+                [(machines[i], cc) for i, cc in shared])
+
+    def _mask(self, charm_class):
+        if charm_class not in self._masks:
+            compiled = compile_constraints(charm_class.constraints)
+            self._masks[charm_class] = compiled.match(self.columns).mask
+        return self._masks[charm_class]
+
+    def _demand(self, charm_class):
+        """ Size of the constraints, on the same scale as machine size """
+        compiled = compile_constraints(charm_class.constraints)
+        return sum(bound / self.scale[key]
+                   for _, key, bound in compiled.checks
+                   if key in self.scale)
+
+    def _bounds(self, charm_class):
+        bounds = dict(memory=CONTAINER_MEM_MB, cpu_count=CONTAINER_CPU_COUNT)
+        compiled = compile_constraints(charm_class.constraints)
+        for _, key, bound in compiled.checks:
+            if key in bounds:
+                bounds[key] = bound
+        return bounds
+
+    def _place_isolated(self, charm_classes, unplaced):
+        units = [cc for cc in charm_classes
+                 for _ in range(cc.required_num_units())]
+        units.sort(key=self._demand, reverse=True)
+
+        # per charm: satisfying machines smallest first, and how far
+        # through them earlier units of the charm have got
+        candidates = {}
+        placed = []
+        for cc in units:
+            if cc not in candidates:
+                mask = self._mask(cc)
+                candidates[cc] = [[i for i in self.by_size if mask[i]], 0]
+            machines, pos = candidates[cc]
+            while pos < len(machines) and not self.available[machines[pos]]:
+                pos += 1
+            candidates[cc][1] = pos
+            if pos == len(machines):
+                unplaced.append(cc)
+                continue
+            i = machines[pos]
+            self.available[i] = False
+            placed.append((i, cc))
+        return placed
+
+    def _place_shared(self, charm_classes, unplaced):
+        cols = self.columns.columns
+        hosts = [i for i in self.by_size if self.available[i]]
+        left = {i: {key: min(cols[key][i], self.scale[key])
+                    for key in ('memory', 'cpu_count')}
+                for i in hosts}
+
+        def score(i):
+            return sum(left[i][key] / self.scale[key] for key in left[i])
+
+        heap = [(-score(i), i) for i in hosts]
+        heapq.heapify(heap)
+
+        placed = []
+        used = set()
+        for cc in sorted(charm_classes, key=self._demand, reverse=True):
+            mask = self._mask(cc)
+            bounds = self._bounds(cc)
+            skipped = []
+            while heap:
+                entry = heapq.heappop(heap)
+                i = entry[1]
+                if mask[i] and all(left[i][key] >= bounds[key]
+                                   for key in bounds):
+                    break
+                skipped.append(entry)
+            else:
+                i = None
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            if i is None:
+                unplaced.append(cc)
+                continue
+            for key in bounds:
+                left[i][key] -= bounds[key]
+            heapq.heappush(heap, (-score(i), i))
+            placed.append((i, cc))
+            used.add(i)
+
+        for i in used:
+            self.available[i] = False
+        return placed, {i: left[i] for i in used}
+
+    def _make_report(self, isolated, shared, headroom, unplaced):
+        """ How well the hardware was packed
+
+        utilisation: for machines given to isolated charms, the share of
+        their memory, storage and cores that the charms' constraints ask
+        for. headroom: the least memory and cores left on any machine
+        hosting controller services.
+        """
+        cols = self.columns.columns
+        used = {key: 0 for key in NUMERIC_KEYS}
+        capacity = {key: 0 for key in NUMERIC_KEYS}
+        for i, cc in isolated:
+            compiled = compile_constraints(cc.constraints)
+            bounds = {key: bound for _, key, bound in compiled.checks}
+            for key in NUMERIC_KEYS:
+                if abs(cols[key][i]) == float('inf'):
+                    continue
+                capacity[key] += cols[key][i]
+                used[key] += bounds.get(key, 0)
+        utilisation = {key: round(used[key] / capacity[key], 3)
+                       for key in NUMERIC_KEYS if capacity[key] > 0}
+        min_headroom = {key: min(h[key] for h in headroom.values())
+                        for key in ('memory', 'cpu_count')} \
+            if headroom else {}
+        return dict(machines=len(self.columns),
+                    isolated_machines=len(isolated),
+                    controller_hosts=len(headroom),
+                    unused_machines=sum(self.available),
+                    utilisation=utilisation,
+                    headroom=min_headroom,
+                    unplaced=[cc.charm_name for cc in unplaced])
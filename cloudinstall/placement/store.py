@@ -0,0 +1,191 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Copy-on-write store of placements
+
+A PlacementStore maps instance ids to {atype: [charm_class]}, as the
+assignments and deployments of a PlacementController. Snapshots share
+everything with the store they are taken from, and copy only what either
+side goes on to change:
+
+    snap = store.snapshot()
+    snap.add(iid, AssignmentType.LXC, CharmKeystone)
+    snap.diff()      # {iid: {LXC: [CharmKeystone]}}
+    snap.commit()    # or snap.rollback()
+"""
+
+from collections.abc import MutableMapping
+import logging
+
+log = logging.getLogger('cloudinstall.placement.store')
+
+
+class MachinePlacements(dict):
+
+    """ {atype: [charm_class]} for one machine
+
+    An atype with nothing placed reads as an empty list. These are
+    shared between a store and its snapshots: never change one in place.
+    """
+
+    def __missing__(self, atype):
+        return []
+
+
+def _entry(placements):
+    entry = MachinePlacements()
+    for atype, charm_classes in placements.items():
+        if len(charm_classes) > 0:
+            entry[atype] = list(charm_classes)
+    return entry
+
+
+class PlacementStore(MutableMapping):
+
+    """ {instance_id: {atype: [charm_class]}} with O(1) snapshots
+
+    Machine entries are never changed in place: add() and remove() make
+    a new entry for the one machine they touch. A store that has been
+    snapshotted copies its top-level dict before its next change, so the
+    snapshot keeps seeing the old one.
+
+    Reading an unknown instance id gives an empty entry, as the
+    defaultdicts this replaces did, without adding it. Machines with
+    nothing placed are dropped.
+    """
+
+    def __init__(self, placements=None):
+        self._data = {}
+        self._shared = False
+        self._base = None
+        self._origin = None
+        self._changed = set()
+        if placements:
+            for iid, ad in placements.items():
+                self[iid] = ad
+
+    def __getitem__(self, iid):
+        entry = self._data.get(iid, None)
+        if entry is None:
+            return MachinePlacements()
+        return entry
+
+    def __setitem__(self, iid, placements):
+        self._set(iid, _entry(placements))
+
+    def __delitem__(self, iid):
+        if iid not in self._data:
+            raise KeyError(iid)
+        self._set(iid, None)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, iid):
+        return iid in self._data
+
+    def __repr__(self):
+        return "<PlacementStore {}>".format(self._data)
+
+    def _set(self, iid, entry):
+        if self._shared:
+            self._data = dict(self._data)
+            self._shared = False
+        if entry is None or len(entry) == 0:
+            self._data.pop(iid, None)
+        else:
+            self._data[iid] = entry
+        self._changed.add(iid)
+
+    def add(self, iid, atype, charm_class):
+        """ Places charm_class on machine iid """
+        entry = MachinePlacements(self[iid])
+        entry[atype] = entry[atype] + [charm_class]
+        self._set(iid, entry)
+
+    def remove(self, iid, atype, charm_class):
+        """ Removes one placement of charm_class from machine iid
+
+        :raises ValueError: if there is none
+        """
+        entry = MachinePlacements(self[iid])
+        charm_classes = list(entry[atype])
+        charm_classes.remove(charm_class)
+        if len(charm_classes) > 0:
+            entry[atype] = charm_classes
+        else:
+            entry.pop(atype, None)
+        self._set(iid, entry)
+
+    def snapshot(self):
+        """ A store with the same placements, sharing all of them
+
+        Changes to either are not seen by the other. The snapshot's
+        changes can be applied back here with its commit().
+
+        :rtype: :class:`PlacementStore`
+        """
+        self._shared = True
+        snap = PlacementStore()
+        snap._data = self._data
+        snap._shared = True
+        snap._base = self
+        snap._origin = self._data
+        return snap
+
+    def diff(self):
+        """ Machines changed since this snapshot was taken
+
+        :returns: {instance_id: {atype: [charm_class]}}, with an empty
+                  dict for a machine that no longer has anything placed
+        """
+        if self._origin is None:
+            return {}
+        changes = {}
+        for iid in self._changed:
+            entry = self._data.get(iid, None)
+            if entry is not self._origin.get(iid, None):
+                changes[iid] = entry or MachinePlacements()
+        return changes
+
+    def commit(self):
+        """ Applies diff() to the store this is a snapshot of, and starts
+        a new diff from here
+
+        :returns: the diff applied
+        """
+        changes = self.diff()
+        for iid, entry in changes.items():
+            self._base._set(iid, entry)
+        self._mark()
+        return changes
+
+    def rollback(self):
+        """ Drops every change made since the snapshot was taken, or
+        last committed """
+        if self._origin is None:
+            return
+        self._data = self._origin
+        self._shared = True
+        self._changed = set()
+
+    def _mark(self):
+        self._origin = self._data
+        self._shared = True
+        self._changed = set()
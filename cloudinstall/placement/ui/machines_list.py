@@ -16,7 +16,8 @@
 import logging
 from urwid import (AttrMap, Divider, Padding, Pile, Text, WidgetWrap)
 
-from cloudinstall.maas import satisfies
+from cloudinstall.maas.constraints import (compile_constraints,
+                                           MachineColumns)
 
 from cloudinstall.placement.ui.filter_box import FilterBox
 from cloudinstall.placement.ui.machine_widget import MachineWidget
@@ -113,8 +114,10 @@ class MachinesList(WidgetWrap):
                                for cc in al])
             return s
 
-        for m in machines:
-            if not satisfies(m, self.constraints)[0]:
+        match = compile_constraints(self.constraints).match(
+            MachineColumns(machines))
+        for m, ok in zip(machines, match.mask):
+            if not ok:
                 self.remove_machine(m)
                 n_satisfying_machines -= 1
                 continue
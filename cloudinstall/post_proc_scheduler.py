@@ -0,0 +1,178 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Running charms' post_proc() once they are ready, several at a time
+
+    scheduler = PostProcScheduler(charms)
+    scheduler.run()              # or start(), then wait_complete()
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from cloudinstall import tracer
+
+log = logging.getLogger('cloudinstall.post_proc_scheduler')
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class PostProcScheduler:
+
+    """ Runs post_proc() of charm instances through a bounded pool of
+    threads
+
+    A charm's post_proc() is started once its post_proc_ready() returns
+    True; that is checked from the cached juju status whenever a
+    post_proc finishes, and at least every poll_interval seconds.
+    post_proc() returning True, or raising, means it should be run again:
+    after retry_delay seconds, doubling for that charm up to
+    max_retry_delay.
+
+    The complete condition is notified once every charm is done, see
+    wait_complete().
+    """
+
+    def __init__(self, charms, max_workers=None, retry_delay=5,
+                 max_retry_delay=60, poll_interval=2, on_error=None):
+        """ :param charms: charm instances
+            :param on_error: function(charm, exception) called when a
+                             post_proc raises
+        """
+        self.charms = list(charms)
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.on_error = on_error
+        self.complete = threading.Condition()
+        self.attempts = {charm: 0 for charm in self.charms}
+        self._done = set()
+        self._running = set()
+        self._finished = 0
+        self._retry_at = {}
+        self._stop = False
+        self._thread = None
+        self._span = tracer.NULL_SPAN
+
+    def is_complete(self):
+        with self.complete:
+            return len(self._done) == len(self.charms)
+
+    def pending(self):
+        """ Charms whose post_proc has not succeeded yet """
+        with self.complete:
+            return [c for c in self.charms if c not in self._done]
+
+    def wait_complete(self, timeout=None):
+        """ Blocks until every post_proc has succeeded
+
+        :returns: True if they have, False on timeout or stop()
+        """
+        with self.complete:
+            self.complete.wait_for(
+                lambda: self._stop or len(self._done) == len(self.charms),
+                timeout)
+            return len(self._done) == len(self.charms)
+
+    def start(self):
+        """ Runs the scheduler in a background thread """
+        self._thread = threading.Thread(target=self.run,
+                                        name='post-proc-scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops starting post_procs; those under way are finished """
+        with self.complete:
+            self._stop = True
+            self.complete.notify_all()
+
+    def run(self):
+        """ Runs every charm's post_proc, blocking until all succeed or
+        stop() is called """
+        with tracer.span('post processing', charms=len(self.charms)) as span:
+            self._span = span
+            self._run()
+        log.debug("Post processing done: {} attempts".format(
+            {c.charm_name: n for c, n in self.attempts.items()}))
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                with self.complete:
+                    if self._stop or len(self._done) == len(self.charms):
+                        self.complete.notify_all()
+                        break
+                    now = time.time()
+                    finished = self._finished
+                    candidates = [c for c in self.charms
+                                  if c not in self._done and
+                                  c not in self._running and
+                                  self._retry_at.get(c, 0) <= now]
+
+                # may refresh the juju status, so not under the lock
+                ready = [c for c in candidates if self._is_ready(c)]
+
+                with self.complete:
+                    for charm in ready:
+                        self._retry_at.pop(charm, None)
+                        self._running.add(charm)
+                        pool.submit(self._attempt, charm)
+                    if len(ready) > 0 or self._finished != finished:
+                        continue
+                    timeout = self.poll_interval
+                    if len(self._retry_at) > 0:
+                        timeout = min(timeout, max(
+                            0, min(self._retry_at.values()) - time.time()))
+                    self.complete.wait(timeout)
+
+    def _is_ready(self, charm):
+        try:
+            return charm.post_proc_ready()
+        except Exception:
+            log.exception("Error checking whether {} is ready for post "
+                          "processing".format(charm.charm_name))
+            return False
+
+    def _attempt(self, charm):
+        with self.complete:
+            self.attempts[charm] += 1
+            attempts = self.attempts[charm]
+        with tracer.span('post_proc {}'.format(charm.charm_name),
+                         parent=self._span, attempt=attempts) as span:
+            try:
+                err = charm.post_proc()
+            except Exception as e:
+                log.exception("Exception in post processing {}, "
+                              "re-trying.".format(charm.charm_name))
+                if self.on_error is not None:
+                    self.on_error(charm, e)
+                err = True
+            span.set(retry=bool(err))
+
+        with self.complete:
+            self._running.discard(charm)
+            if err:
+                delay = min(self.retry_delay * 2 ** (attempts - 1),
+                            self.max_retry_delay)
+                self._retry_at[charm] = time.time() + delay
+            else:
+                self._done.add(charm)
+            self._finished += 1
+            self.complete.notify_all()
@@ -0,0 +1,185 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Single-flight refresh of cached API documents """
+
+from collections import deque
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.refresh')
+
+
+def backoff_delays(retries, base=0.5, cap=30):
+    """ Jittered exponential backoff delays
+
+    Yields retries - 1 delays: one before each retry after the first
+    attempt. Each is uniform in [0, min(cap, base * 2 ** n)] ("full
+    jitter"), so callers that failed together do not retry together.
+
+    :param int retries: total number of attempts
+    :param float base: upper bound of the first delay, in seconds
+    :param float cap: largest upper bound, in seconds
+    """
+    for n in range(retries - 1):
+        yield random.uniform(0, min(cap, base * 2 ** n))
+
+
+class _Flight:
+
+    """ A fetch in progress, shared by every caller that waits on it """
+
+    def __init__(self):
+        self.started = time.time()
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class RefreshCoordinator:
+
+    """ Caches the result of fetch() and coalesces concurrent refreshes
+
+    Callers say how stale a result they will accept with max_age. When
+    the cached value is too old, the first caller fetches and any other
+    caller arriving meanwhile waits for, and shares, that same fetch
+    rather than issuing its own.
+
+    Freshness is measured from when a fetch started, since the document
+    can only reflect the server's state as of then.
+    """
+
+    def __init__(self, fetch, ttl=20, retries=5, retry_on=(),
+                 backoff_base=0.5, backoff_cap=30, name="refresh"):
+        """ Builds a RefreshCoordinator
+
+        :param fetch: callable returning a fresh value
+        :param ttl: default max_age, in seconds
+        :param int retries: attempts before giving up on errors in
+                            retry_on; the last error is re-raised
+        :param tuple retry_on: exception types worth retrying
+        :param backoff_base: see :func:`backoff_delays`
+        :param backoff_cap: see :func:`backoff_delays`
+        :param str name: used in log messages
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.retries = retries
+        self.retry_on = retry_on
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.name = name
+        self.latencies = deque(maxlen=100)
+        self.fetch_count = 0
+        self._lock = threading.Lock()
+        self._value = None
+        self._value_started = None
+        self._not_before = 0
+        self._flight = None
+
+    def get(self, max_age=None):
+        """ Returns a value fetched no more than max_age seconds ago
+
+        :param max_age: seconds of staleness the caller accepts,
+                        defaults to ttl. 0 always waits for a fetch
+                        started after this call.
+        """
+        if max_age is None:
+            max_age = self.ttl
+        requested = time.time()
+        while True:
+            with self._lock:
+                oldest = max(requested - max_age, self._not_before)
+                if self._value_started is not None and \
+                   self._value_started >= oldest:
+                    return self._value
+                flight = self._flight
+                leader = flight is None
+                if leader:
+                    flight = self._flight = _Flight()
+            if leader:
+                return self._run(flight)
+            flight.done.wait()
+            if flight.started >= oldest:
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+            # that fetch started too long ago to share; try again
+
+    def _run(self, flight):
+        try:
+            flight.value = self._fetch_with_retries()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    self._value = flight.value
+                    self._value_started = flight.started
+                self._flight = None
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self):
+        """ Makes every value and fetch started before now stale """
+        with self._lock:
+            self._not_before = time.time()
+
+    def _fetch_with_retries(self):
+        delays = backoff_delays(self.retries, self.backoff_base,
+                                self.backoff_cap)
+        while True:
+            start = time.time()
+            try:
+                value = self.fetch()
+            except self.retry_on as e:
+                self._record(time.time() - start)
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                log.debug("{} failed ({}), retrying in {:.2f}s".format(
+                    self.name, e, delay))
+                time.sleep(delay)
+                continue
+            latency = time.time() - start
+            self._record(latency)
+            log.debug("{} took {:.3f}s".format(self.name, latency))
+            return value
+
+    def _record(self, latency):
+        with self._lock:
+            self.fetch_count += 1
+            self.latencies.append(latency)
+
+    def stats(self):
+        """ Latency summary of recent fetches
+
+        :returns: count, and the last, mean and max latency in seconds
+                  over the most recent fetches
+        :rtype: dict
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+            count = self.fetch_count
+        if len(latencies) == 0:
+            return dict(count=count, last=None, mean=None, max=None)
+        return dict(count=count,
+                    last=latencies[-1],
+                    mean=sum(latencies) / len(latencies),
+                    max=max(latencies))
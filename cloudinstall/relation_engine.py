@@ -0,0 +1,205 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Adding the relations between deployed charms
+
+Relations already in the juju status are left alone; the rest are added
+several at a time, each retried on its own until juju accepts it:
+
+    engine = RelationEngine(juju, juju_state)
+    futures = engine.start([('mysql:shared-db', 'glance:shared-db')])
+    engine.wait()
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import threading
+
+from macumba import MacumbaError
+
+from cloudinstall import tracer
+
+log = logging.getLogger('cloudinstall.relation_engine')
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def _endpoint(endpoint):
+    """ ('service', 'relation name' or None) of 'service:relation' """
+    if ':' in endpoint:
+        return tuple(endpoint.split(':', 1))
+    return endpoint, None
+
+
+def is_related(juju_state, relation_a, relation_b):
+    """ Is the relation between two endpoints in the juju status?
+
+    :param juju_state: :class:`~cloudinstall.juju.JujuState`
+    :param str relation_a: eg. 'mysql:shared-db'
+    :param str relation_b: eg. 'glance:shared-db'
+    :rtype: bool
+    """
+    for this, other in ((relation_a, relation_b), (relation_b, relation_a)):
+        svc_name, rel_name = _endpoint(this)
+        other_name, _ = _endpoint(other)
+        service = juju_state.service(svc_name)
+        if rel_name is None:
+            relations = service.relations
+        else:
+            relations = [service.relation(rel_name)]
+        for r in relations:
+            if other_name in r.charms:
+                return True
+    return False
+
+
+class RelationEngine:
+
+    """ Adds relations through a bounded pool of threads
+
+    A relation that juju refuses with a ServerError or that can't be
+    sent is tried again after retry_delay seconds, doubling up to
+    max_retry_delay, up to max_attempts times in all. Before each retry
+    the juju status is checked in case it was added after all. Any
+    other error fails the relation at once.
+
+    start() returns a future per relation, resolved with the number of
+    attempts it took (0 if it was already there) or with the error it
+    finally failed with. done is set once all have resolved.
+    """
+
+    def __init__(self, juju, juju_state, max_workers=None, retry_delay=5,
+                 max_retry_delay=60, max_attempts=10):
+        self.juju = juju
+        self.juju_state = juju_state
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.done = threading.Event()
+        self.futures = {}
+        self._stop = threading.Event()
+        self._pool = None
+        self._span = tracer.NULL_SPAN
+
+    def missing(self, relations):
+        """ The relations not in the juju status, without duplicates """
+        missing = []
+        for relation in relations:
+            if relation in missing or \
+               (relation[1], relation[0]) in missing:
+                continue
+            if not is_related(self.juju_state, *relation):
+                missing.append(relation)
+        return missing
+
+    def start(self, relations):
+        """ Starts adding the missing relations and returns at once
+
+        :param relations: [('service:relation', 'service:relation')]
+        :returns: {relation: Future}
+        """
+        to_add = self.missing(relations)
+        log.debug("Adding relations: {}".format(to_add))
+        self._span = tracer.span('add relations', count=len(to_add))
+        self.futures = {}
+        if len(to_add) > 0:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            for relation in to_add:
+                self.futures[relation] = self._pool.submit(self._add,
+                                                           *relation)
+        for relation in relations:
+            if relation in self.futures:
+                continue
+            f = self.futures.get((relation[1], relation[0]), None)
+            if f is None:
+                f = Future()
+                f.set_result(0)
+            self.futures[relation] = f
+
+        if len(to_add) == 0:
+            self._span.finish()
+            self.done.set()
+            return self.futures
+
+        remaining = [len(to_add)]
+        lock = threading.Lock()
+
+        def finished(future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self._pool.shutdown(wait=False)
+                    self._span.finish()
+                    self.done.set()
+
+        for relation in to_add:
+            self.futures[relation].add_done_callback(finished)
+        return self.futures
+
+    def wait(self, timeout=None):
+        """ Waits for every relation to be added or fail
+
+        :returns: {relation: exception} for those that failed
+        """
+        self.done.wait(timeout)
+        return {relation: f.exception() for relation, f in
+                self.futures.items()
+                if f.done() and f.exception() is not None}
+
+    def gave_up(self, relation_a, relation_b):
+        """ Has adding the relation failed for good? """
+        f = self.futures.get((relation_a, relation_b),
+                             self.futures.get((relation_b, relation_a), None))
+        return f is not None and f.done() and f.exception() is not None
+
+    def stop(self):
+        """ Gives up the retries still waiting """
+        self._stop.set()
+
+    def _add(self, relation_a, relation_b):
+        with tracer.span('add relation {} {}'.format(relation_a, relation_b),
+                         parent=self._span) as span:
+            attempts = self._add_with_retries(relation_a, relation_b)
+            span.set(attempts=attempts)
+            return attempts
+
+    def _add_with_retries(self, relation_a, relation_b):
+        attempts = 0
+        delay = self.retry_delay
+        while True:
+            attempts += 1
+            try:
+                self.juju.add_relation(relation_a, relation_b)
+                log.debug("Added relation {} {}".format(relation_a,
+                                                        relation_b))
+                return attempts
+            except MacumbaError as e:
+                if 'already exists' in str(e):
+                    return attempts
+                if attempts >= self.max_attempts:
+                    log.error("Giving up on add_relation({}, {}): "
+                              "{}".format(relation_a, relation_b, e))
+                    raise
+                log.debug("add_relation({}, {}) failed: {}, re-trying in "
+                          "{} seconds".format(relation_a, relation_b, e,
+                                              delay))
+            if self._stop.wait(delay):
+                raise MacumbaError("Stopped adding relation "
+                                   "{} {}".format(relation_a, relation_b))
+            delay = min(delay * 2, self.max_retry_delay)
+            if is_related(self.juju_state, relation_a, relation_b):
+                return attempts
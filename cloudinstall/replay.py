@@ -0,0 +1,210 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Record Juju and MAAS state during an install, and play it back
+
+A recording is a gzip file of JSON lines, one per status document:
+
+    {"t": <unix time>, "source": "juju" or "maas", "data": <document>}
+
+Each record is appended as its own gzip member, so a recording that
+was cut short by a crash is still readable up to the last record.
+
+Set UCI_RECORD=<file> to record juju FullStatus and MAAS nodes while
+running, and UCI_REPLAY=<file> to run against a recording instead of
+live APIs. UCI_REPLAY_SPEED sets the playback rate: 1 is real time
+(the default), 10 is ten times faster, and 0 steps to the next record
+on every fetch.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.replay')
+
+
+class Recorder:
+
+    """ Appends timestamped status documents to a recording """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, source, data):
+        """ Appends a document
+
+        :param str source: 'juju' or 'maas'
+        :param data: a JSON-serializable status document
+        """
+        line = json.dumps(dict(t=time.time(), source=source, data=data))
+        with self._lock:
+            with gzip.open(self.path, 'ab') as f:
+                f.write(line.encode('utf-8') + b'\n')
+
+
+def read_recording(path, source=None):
+    """ Iterates over the records in a recording, oldest first
+
+    A truncated final record, as left by an interrupted recorder, is
+    skipped with a warning.
+
+    :param str source: only return records from this source
+    :returns: (time, source, data) tuples
+    """
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                try:
+                    rec = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    log.warning("Skipping unreadable record in "
+                                "{}".format(path))
+                    continue
+                if source is None or rec['source'] == source:
+                    yield rec['t'], rec['source'], rec['data']
+        except EOFError:
+            log.warning("Recording {} is truncated".format(path))
+
+
+class ReplayClock:
+
+    """ Maps wall-clock time since the replay started onto recording time
+
+    With speed 0 there is no clock: every fetch steps to the next record.
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.started = None
+
+    def elapsed(self):
+        """ Recording seconds played so far """
+        if self.started is None:
+            self.started = time.time()
+        return (time.time() - self.started) * self.speed
+
+
+class ReplaySource:
+
+    """ Plays back the records of one source against a ReplayClock """
+
+    def __init__(self, path, source, clock):
+        self.path = path
+        self.source = source
+        self.clock = clock
+        self._records = read_recording(path, source)
+        self._lock = threading.Lock()
+        self._first_t = None
+        self._current = None
+        self._next = next(self._records, None)
+        if self._next is None:
+            raise Exception("No {} records in {}".format(source, path))
+        self._first_t = self._next[0]
+
+    def current(self):
+        """ The document the recorded install saw at this point of the
+        replay: the latest one at or before the clock, and the first one
+        until then.
+        """
+        with self._lock:
+            if self.clock.speed <= 0:
+                self._advance()
+            else:
+                now = self._first_t + self.clock.elapsed()
+                while self._next is not None and self._next[0] <= now:
+                    self._advance()
+            return self._current[2]
+
+    def _advance(self):
+        if self._next is not None:
+            self._current = self._next
+            self._next = next(self._records, None)
+
+    @property
+    def finished(self):
+        """ True once the last record has been played """
+        return self._next is None
+
+
+class ReplayJujuClient:
+
+    """ Stands in for a macumba JujuClient, answering status() from a
+    recording. Calls that would change the environment are logged and
+    ignored.
+    """
+
+    def __init__(self, path, clock):
+        self.source = ReplaySource(path, 'juju', clock)
+
+    def login(self):
+        pass
+
+    def status(self):
+        return self.source.current()
+
+    def get_annotations(self, *args, **kwargs):
+        return {'Annotations': {}}
+
+    def __getattr__(self, name):
+        def ignored(*args, **kwargs):
+            log.debug("replay: ignoring juju {}{}".format(name, args))
+            return {}
+        return ignored
+
+
+class ReplayMaasClient:
+
+    """ Stands in for a MaasClient, answering nodes from a recording.
+    Calls that would change MAAS are logged and ignored.
+    """
+
+    def __init__(self, path, clock):
+        self.source = ReplaySource(path, 'maas', clock)
+
+    @property
+    def nodes(self):
+        return self.source.current()
+
+    def __getattr__(self, name):
+        def ignored(*args, **kwargs):
+            log.debug("replay: ignoring maas {}".format(name))
+            return {}
+        return ignored
+
+
+def recorder_from_env():
+    """ Recorder for $UCI_RECORD, or None if it is not set """
+    path = os.getenv("UCI_RECORD")
+    if not path:
+        return None
+    log.info("Recording juju and maas state to {}".format(path))
+    return Recorder(path)
+
+
+def replay_from_env():
+    """ (path, ReplayClock) for $UCI_REPLAY, or None if it is not set """
+    path = os.getenv("UCI_REPLAY")
+    if not path:
+        return None
+    speed = float(os.getenv("UCI_REPLAY_SPEED", "1"))
+    log.info("Replaying juju and maas state from {} at speed "
+             "{}".format(path, speed))
+    return path, ReplayClock(speed)
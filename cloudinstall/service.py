@@ -30,48 +30,23 @@ class JujuUnitNotFoundException(Exception):
 
 class Unit:
 
-    """ Unit class """
+    """ Unit class
+
+    agent_state, machine_id, public_address and agent_state_info
+    (usually the error message if the unit failed to deploy) are read
+    from the status entry once, when the Unit is built.
+    """
+
+    __slots__ = ('unit_name', 'unit', 'agent_state', 'machine_id',
+                 'public_address', 'agent_state_info')
 
     def __init__(self, unit_name, unit):
         self.unit_name = unit_name
         self.unit = unit
-
-    @property
-    def agent_state(self):
-        """ Unit's agent state
-
-        :returns: agent state
-        :rtype: str
-        """
-        return self.unit.get('AgentState', 'unknown')
-
-    @property
-    def machine_id(self):
-        """ Associate machine for unit
-
-        :returns: machine id
-        :rtype: str
-        """
-        return self.unit.get('Machine', '-1')
-
-    @property
-    def public_address(self):
-        """ Public address of unit
-
-        :returns: address of unit
-        :rtype: str
-        """
-        return self.unit.get('PublicAddress', None)
-
-    @property
-    def agent_state_info(self):
-        """ Gets unit state info
-
-        Usually prints a error message if unit failed to deploy
-        :returns: error
-        :rtype: str
-        """
-        return self.unit.get('AgentStateInfo', None)
+        self.agent_state = unit.get('AgentState', 'unknown')
+        self.machine_id = unit.get('Machine', '-1')
+        self.public_address = unit.get('PublicAddress', None)
+        self.agent_state_info = unit.get('AgentStateInfo', None)
 
     @property
     def is_compute(self):
@@ -120,6 +95,8 @@ class Relation:
 
     """ Relation class """
 
+    __slots__ = ('relation_name', 'charms')
+
     def __init__(self, relation_name, charms):
         self.relation_name = relation_name
         self.charms = charms
@@ -135,7 +112,14 @@ class Relation:
 
 class Service:
 
-    """ Service class """
+    """ Service class
+
+    Units and relations are wrapped on first access and then shared,
+    so a Service from a status snapshot builds them at most once.
+    """
+
+    __slots__ = ('service_name', 'service', 'charm', 'exposed',
+                 'networks', 'life', '_units', '_relations')
 
     def __init__(self, service_name, service):
         self.service_name = service_name
@@ -144,6 +128,8 @@ class Service:
         self.exposed = self.service.get('Exposed')
         self.networks = self.service.get('Networks')
         self.life = self.service.get('Life')
+        self._units = None
+        self._relations = None
 
     def unit(self, name):
         """ Single unit entry
@@ -166,17 +152,16 @@ class Service:
     def units(self):
         """ Service units
 
-        :returns: iterator of associated units for service
+        The list is shared between calls and must not be modified.
+
+        :returns: list of associated units for service
         :rtype: Unit()
         """
-        units_list = []
-        units_dict = self.service.get('Units', {})
-        if units_dict is None:
-            return units_list
-
-        for unit_name, units in units_dict.items():
-            units_list.append(Unit(unit_name, units))
-        return units_list
+        if self._units is None:
+            units_dict = self.service.get('Units', {}) or {}
+            self._units = [Unit(unit_name, unit)
+                           for unit_name, unit in units_dict.items()]
+        return self._units
 
     def relation(self, name):
         """ Single relation entry
@@ -194,12 +179,17 @@ class Service:
     def relations(self):
         """ Service relations
 
-        :returns: iterator of relations for service
+        The list is shared between calls and must not be modified.
+
+        :returns: list of relations for service
         :rtype: Relation()
         """
-        relations = self.service.get('Relations', {})
-        for relation_name, relation in relations.items():
-            yield Relation(relation_name, relation)
+        if self._relations is None:
+            relations = self.service.get('Relations', {}) or {}
+            self._relations = [Relation(relation_name, relation)
+                               for relation_name, relation in
+                               relations.items()]
+        return self._relations
 
     def __repr__(self):
         return "<Service: {name} " \
@@ -19,7 +19,7 @@ import os
 import time
 import yaml
 
-from cloudinstall import utils
+from cloudinstall import tracer, utils
 from cloudinstall.config import Config
 
 log = logging.getLogger('cloudinstall.task')
@@ -56,6 +56,8 @@ class Tasker:
         self.stopped = False
         self.alarm = None
         self.task_info_func = None
+        self.task_span = tracer.NULL_SPAN
+        tracer.tracer_from_env()
 
     def register_tasks(self, tasks):
         self.tasks = [(n, None, None) for n in tasks]
@@ -86,6 +88,7 @@ class Tasker:
                                                 self.tasks_started_debug))
 
         self.tasks[self.current_task_index] = (expectedname, time.time(), None)
+        self.task_span = tracer.span(expectedname, cat='task')
         self.stopped = False
         if self.alarm is None:
             self.update_progress()
@@ -114,6 +117,7 @@ class Tasker:
             return
         n, s, _ = self.tasks[self.current_task_index]
         self.tasks[self.current_task_index] = (n, s, time.time())
+        self.task_span.finish()
         self.current_task_index += 1
         self.stopped = True
         self.write_timings()
@@ -0,0 +1,359 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Timeline of a deployment as nested spans
+
+Set UCI_TRACE=<file> to record how long each phase of an install takes.
+The spans are written to that file as Chrome trace events, which
+chrome://tracing and other trace viewers load, and a summary of the
+critical path, the spans that the end of the install waited on, is
+written next to it as <file>.critical-path:
+
+    with tracer.span('deploy', charm='keystone'):
+        ...
+
+    @tracer.traced('wait for machines')
+    def wait(self):
+        ...
+
+A span opened in a thread is the parent of the spans opened inside it
+on that thread; work handed to another thread passes parent=
+current_span() along. Without UCI_TRACE the functions here return a
+shared span that does nothing.
+"""
+
+import atexit
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('cloudinstall.tracer')
+
+# spans of this category are the ones the critical path is made of;
+# others (eg. the installer's task list) overlap them and are only
+# shown in the timeline
+DEFAULT_CATEGORY = 'deploy'
+
+
+class Span:
+
+    """ A named, timed piece of work on one thread """
+
+    def __init__(self, tracer, span_id, name, parent, cat, attrs):
+        self.tracer = tracer
+        self.span_id = span_id
+        self.name = name
+        self.parent = parent
+        self.cat = cat
+        self.attrs = attrs
+        self.tid = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+
+    def __repr__(self):
+        return "<Span {} {}>".format(self.span_id, self.name)
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.time()
+        return end - self.start
+
+    def set(self, **attrs):
+        """ Adds attributes, eg. the outcome of the work """
+        self.attrs.update(attrs)
+
+    def finish(self):
+        """ Ends the span, if it has not ended yet """
+        self.tracer._finish(self)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.attrs['error'] = repr(exc)
+        self.tracer._pop(self)
+        self.finish()
+        return False
+
+
+class _NullSpan:
+
+    """ Stands in for a Span while tracing is disabled """
+
+    span_id = None
+    attrs = {}
+
+    def set(self, **attrs):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+
+    """ Collects spans from every thread """
+
+    def __init__(self, path=None):
+        """ :param str path: file the trace is written to by write() """
+        self.path = path
+        self.spans = []
+        self.epoch = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 1
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _push(self, span):
+        self._stack().append(span)
+
+    def _pop(self, span):
+        stack = self._stack()
+        if len(stack) > 0 and stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            stack.remove(span)
+
+    def _finish(self, span):
+        with self._lock:
+            if span.end is None:
+                span.end = time.time()
+
+    def current_span(self):
+        """ Innermost span open on this thread, or None """
+        stack = self._stack()
+        if len(stack) == 0:
+            return None
+        return stack[-1]
+
+    def span(self, name, parent=None, cat=DEFAULT_CATEGORY, **attrs):
+        """ A new span, started now. Use it as a context manager, or call
+        finish() on it if it ends somewhere else.
+
+        :param parent: span this one is part of, by default the
+                       innermost one open on this thread
+        """
+        if parent is None or parent is NULL_SPAN:
+            parent = self.current_span()
+        with self._lock:
+            span_id = self._next_id
+            self._next_id += 1
+            span = Span(self, span_id, name, parent, cat, attrs)
+            self.spans.append(span)
+        return span
+
+    def _snapshot(self):
+        now = time.time()
+        with self._lock:
+            return [(s, s.end if s.end is not None else now)
+                    for s in self.spans]
+
+    def chrome_trace(self):
+        """ The spans as a Chrome trace-event document
+
+        Spans still open end now and have an 'unfinished' argument.
+
+        :rtype: dict
+        """
+        def us(t):
+            return int((t - self.epoch) * 1e6)
+
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for span, end in self._snapshot():
+            threads[span.tid] = span.thread_name
+            args = {k: str(v) for k, v in span.attrs.items()}
+            args['id'] = span.span_id
+            if span.parent is not None:
+                args['parent'] = span.parent.span_id
+            if span.end is None:
+                args['unfinished'] = True
+            events.append(dict(name=span.name, cat=span.cat, ph='X',
+                               ts=us(span.start),
+                               dur=us(end) - us(span.start),
+                               pid=pid, tid=span.tid, args=args))
+        for tid, thread_name in threads.items():
+            events.append(dict(name='thread_name', ph='M', pid=pid,
+                               tid=tid, args=dict(name=thread_name)))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def critical_path(self, cat=DEFAULT_CATEGORY):
+        """ What the end of the trace waited on, in order
+
+        Walking back from the end of a span, the child that ended last
+        before that point is on the path, and so on back from when that
+        child started. Time on the path not covered by a child is the
+        span's own. Spans with no parent share an implicit root whose
+        own time is untraced.
+
+        :returns: [(path, seconds)], path being the span names from the
+                  root down, with consecutive time of one span merged
+        :rtype: list
+        """
+        spans = [(s, end) for s, end in self._snapshot() if s.cat == cat]
+        if len(spans) == 0:
+            return []
+        ends = {s: end for s, end in spans}
+        children = {}
+        for s, _ in spans:
+            parent = s.parent if s.parent in ends else None
+            children.setdefault(parent, []).append(s)
+
+        segments = []
+
+        def walk(span, path, start, end):
+            t = end
+            kids = list(children.get(span, []))
+            while True:
+                kids = [c for c in kids if c.start < t]
+                if len(kids) == 0:
+                    break
+                child = max(kids, key=lambda c: min(ends[c], t))
+                kids.remove(child)
+                child_end = min(ends[child], t)
+                if t > child_end:
+                    segments.append((path, t - child_end))
+                child_start = max(child.start, start)
+                walk(child, path + (child.name,), child_start, child_end)
+                t = child_start
+            if t > start:
+                segments.append((path, t - start))
+
+        walk(None, (), min(s.start for s, _ in spans),
+             max(end for _, end in spans))
+
+        merged = []
+        for path, seconds in reversed(segments):
+            if len(merged) > 0 and merged[-1][0] == path:
+                merged[-1] = (path, merged[-1][1] + seconds)
+            else:
+                merged.append((path, seconds))
+        return merged
+
+    def critical_path_summary(self, cat=DEFAULT_CATEGORY):
+        """ critical_path() as text, a line per step """
+        path = self.critical_path(cat)
+        total = sum(seconds for _, seconds in path)
+        lines = ["Critical path: {:.1f} sec".format(total)]
+        for names, seconds in path:
+            lines.append("{:9.2f} sec {:5.1f}%  {}".format(
+                seconds, 100 * seconds / total if total > 0 else 0,
+                " > ".join(names) or "(untraced)"))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        """ Writes the Chrome trace to path, and the critical path
+        summary to path + '.critical-path' """
+        path = path or self.path
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        summary = self.critical_path_summary()
+        with open(path + '.critical-path', 'w') as f:
+            f.write(summary)
+        log.info("Wrote deployment trace to {}\n{}".format(path, summary))
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """ The Tracer in use, or None when tracing is disabled """
+    return _tracer
+
+
+def set_tracer(tracer):
+    """ Uses tracer from now on; None disables tracing """
+    global _tracer
+    _tracer = tracer
+
+
+def tracer_from_env():
+    """ Enables tracing to $UCI_TRACE, once, and returns the Tracer, or
+    None if it is not set. The trace is written at exit.
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer is not None:
+            return _tracer
+        path = os.getenv("UCI_TRACE")
+        if not path:
+            return None
+        log.info("Tracing deployment to {}".format(path))
+        _tracer = Tracer(path)
+        atexit.register(_write_at_exit, _tracer)
+        return _tracer
+
+
+def _write_at_exit(tracer):
+    try:
+        tracer.write()
+    except Exception:
+        log.exception("Could not write trace to {}".format(tracer.path))
+
+
+def span(name, parent=None, cat=DEFAULT_CATEGORY, **attrs):
+    """ Tracer.span() of the tracer in use, NULL_SPAN if there is none """
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, parent, cat, **attrs)
+
+
+def current_span():
+    """ Innermost span open on this thread, NULL_SPAN if there is none """
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.current_span() or NULL_SPAN
+
+
+def traced(name=None, **attrs):
+    """ Decorator running the function inside a span, by default named
+    after it """
+    def decorator(f):
+        span_name = name or f.__name__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return f(*args, **kwargs)
+            with _tracer.span(span_name, **attrs):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
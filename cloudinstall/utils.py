@@ -18,6 +18,7 @@
 
 from subprocess import (Popen, PIPE, call, check_output,
                         check_call, DEVNULL, CalledProcessError)
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from collections import deque
 try:
@@ -26,7 +27,9 @@ except ImportError:
     Mapping = dict
 
 from jinja2 import Environment, FileSystemLoader
+import base64
 import codecs
+import io
 import os
 import re
 import string
@@ -47,11 +50,15 @@ import errno
 import shlex
 import shutil
 import subprocess
+import tarfile
+import tempfile
 import json
 import yaml
 import pty
 import requests
 
+from cloudinstall import tracer
+
 log = logging.getLogger('cloudinstall.utils')
 
 # String with number of minutes, or None.
@@ -171,7 +178,8 @@ def load_ext_charms(plug_path, charm_modules):
         raise Exception(
             "Non-existent plugin path '{}' specified.".format(plug_path))
     try:
-        sys.path.insert(0, plug_path)
+        if plug_path not in sys.path:
+            sys.path.insert(0, plug_path)
         import charms
     except ImportError as e:
         raise Exception("Problem importing external charms: {}".format(e))
@@ -442,27 +450,228 @@ def poll_until_true(cmd, predicate, frequency, timeout=600,
             return False
 
 
+class RemoteSession:
+
+    """ Files to copy to and commands to run on one machine, sent over
+    a single juju ssh connection
+
+    The files travel as one base64 tar stream inside a script, which
+    unpacks them as the ssh user, as juju scp would have, and then runs
+    each command with sudo -H over the same ssh connection. A command's
+    output includes its stderr.
+
+    The script is piped to the remote bash, so juju ssh runs without a
+    pty; with one, the script would be echoed back and every output
+    line would end in a carriage return.
+
+    .. code::
+
+        session = utils.RemoteSession('1', juju_home)
+        session.put('lxc-host-only', '/tmp/lxc-host-only')
+        session.run('sudo /tmp/lxc-host-only')
+        for result in session.execute():
+            result['status'], result['output']
+    """
+
+    def __init__(self, machine_id, juju_home, stop_on_error=False):
+        """ :param stop_on_error: skip the commands after one that fails;
+                                  they are reported with status None
+        """
+        self.machine_id = machine_id
+        self.juju_home = juju_home
+        self.stop_on_error = stop_on_error
+        self.files = []
+        self.cmds = []
+
+    def put(self, src, dst):
+        """ Copies local file src to dst on the machine, keeping its mode
+        """
+        self.files.append((src, dst))
+
+    def run(self, cmds):
+        """ Runs cmds, a command or a list of commands joined with && """
+        if type(cmds) is list:
+            cmds = " && ".join(cmds)
+        self.cmds.append(cmds)
+
+    def script(self, marker):
+        """ The shell script execute() sends """
+        workdir = '/tmp/cloud-install-{}'.format(marker)
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for src, dst in self.files:
+                info = tar.gettarinfo(src, arcname=dst.lstrip('/'))
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                with open(src, 'rb') as f:
+                    tar.addfile(info, f)
+            for i, cmd in enumerate(self.cmds):
+                data = cmd.encode('utf-8')
+                info = tarfile.TarInfo('{}/{}.sh'.format(workdir[1:], i))
+                info.size = len(data)
+                info.mode = 0o600
+                tar.addfile(info, io.BytesIO(data))
+        payload = base64.encodebytes(buf.getvalue()).decode('ascii')
+
+        lines = ["base64 -d <<'{m}' | tar -C / --no-same-owner -xzf - || "
+                 "exit 1".format(m=marker),
+                 payload + marker,
+                 "rc=0"]
+        for i in range(len(self.cmds)):
+            run = ("echo {m} begin {i}; sudo -H bash {d}/{i}.sh 2>&1; "
+                   "rc=$?; echo; echo {m} end {i} $rc").format(
+                m=marker, i=i, d=workdir)
+            if self.stop_on_error and i > 0:
+                run = "[ $rc -eq 0 ] && {{ {}; }}".format(run)
+            lines.append(run)
+        lines.append("rm -rf {}".format(workdir))
+        return "\n".join(lines) + "\n"
+
+    def execute(self):
+        """ Copies the files and runs the commands
+
+        :returns: a dict per command, in order, with status (None if it
+                  did not run), output and err as get_command_output()
+                  returns them. A command cut off by the connection
+                  closing has juju ssh's exit status, or -1 if that was
+                  0. With no commands, the result of copying.
+        :rtype: list
+        """
+        marker = 'CLOUD_INSTALL_{}'.format(
+            ''.join(random.choice(string.ascii_uppercase + string.digits)
+                    for _ in range(12)))
+        log.debug("Remote session on machine {m}: copying {f}, "
+                  "running {c}".format(m=self.machine_id, f=self.files,
+                                       c=self.cmds))
+        span = tracer.span('juju ssh', machine=self.machine_id,
+                           files=len(self.files), commands=len(self.cmds))
+        with span, tempfile.NamedTemporaryFile('w', prefix='cloud-install-',
+                                               suffix='.sh') as f:
+            f.write(self.script(marker))
+            f.flush()
+            ret = get_command_output(
+                "{juju_home} juju ssh --pty=false {m} bash -s "
+                "< {script}".format(
+                    juju_home=self.juju_home, m=self.machine_id,
+                    script=f.name))
+        results = self._parse(marker, ret)
+        log.debug("Remote session result: {r}".format(r=results))
+        return results
+
+    def _parse(self, marker, ret):
+        ret = dict(ret, output=ret['output'].replace('\r\n', '\n'))
+        results = [dict(status=None, output="", err="") for _ in self.cmds]
+        if len(self.cmds) == 0:
+            return [ret]
+        current = None
+        output = []
+        for line in ret['output'].splitlines(keepends=True):
+            words = line.split()
+            if len(words) >= 3 and words[0] == marker:
+                if words[1] == 'begin':
+                    current = int(words[2])
+                    output = []
+                elif words[1] == 'end' and current is not None:
+                    # drop the newline echoed before the end marker
+                    text = ''.join(output)[:-1]
+                    results[current] = dict(status=int(words[3]),
+                                            output=text, err="")
+                    current = None
+                continue
+            if current is not None:
+                output.append(line)
+        if current is not None:
+            # no end marker: the session ended while this command ran
+            results[current] = dict(status=ret['status'] or -1,
+                                    output=''.join(output), err=ret['err'])
+        if ret['status'] != 0 and results[0]['status'] is None:
+            # the connection or the copy failed, so nothing ran
+            for r in results:
+                r.update(status=ret['status'], output=ret['output'],
+                         err=ret['err'])
+        return results
+
+
+def remote_fan_out(sessions, max_workers=8):
+    """ Executes RemoteSessions for several machines at once
+
+    Each session is one juju ssh process, with at most max_workers
+    running at a time. A session that fails or raises does not hold up
+    the others.
+
+    :param sessions: RemoteSessions, one per machine
+    :returns: {machine_id: {'results': what execute() returned, or
+              None if it raised, 'error': the exception or None,
+              'elapsed': seconds}}
+    :rtype: dict
+    """
+    def execute(session):
+        start = time.time()
+        with tracer.span('machine {}'.format(session.machine_id),
+                         parent=parent) as span:
+            try:
+                results, error = session.execute(), None
+            except Exception as e:
+                log.exception("Remote session on machine {} "
+                              "failed".format(session.machine_id))
+                results, error = None, e
+                span.set(error=repr(e))
+        return dict(results=results, error=error,
+                    elapsed=round(time.time() - start, 3))
+
+    report = {}
+    if len(sessions) == 0:
+        return report
+    parent = tracer.current_span()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(s.machine_id, pool.submit(execute, s))
+                   for s in sessions]
+        for machine_id, future in futures:
+            report[machine_id] = future.result()
+    log.debug("Remote fan-out timings: {}".format(
+        {m: r['elapsed'] for m, r in report.items()}))
+    return report
+
+
+def remote_fan_out_failures(report):
+    """ Machines in a remote_fan_out() report whose session raised or had
+    a command that failed or did not run
+
+    :returns: {machine_id: what went wrong, with the command's output}
+    :rtype: dict
+    """
+    failures = {}
+    for machine_id, r in report.items():
+        if r['error'] is not None:
+            failures[machine_id] = repr(r['error'])
+            continue
+        for i, result in enumerate(r['results']):
+            if result['status'] != 0:
+                failures[machine_id] = "command {} exited {}: {}".format(
+                    i, result['status'],
+                    (result['err'] or result['output']).strip())
+                break
+    return failures
+
+
 def remote_cp(machine_id, src, dst, juju_home):
     log.debug("Remote copying {src} to {dst} on machine {m}".format(
         src=src,
         dst=dst,
         m=machine_id))
-    ret = get_command_output(
-        "{juju_home} juju scp {src} {m}:{dst}".format(
-            juju_home=juju_home, src=src, dst=dst, m=machine_id))
+    session = RemoteSession(machine_id, juju_home)
+    session.put(src, dst)
+    ret = session.execute()[0]
     log.debug("Remote copy result: {r}".format(r=ret))
+    return ret
 
 
 def remote_run(machine_id, cmds, juju_home):
-    if type(cmds) is list:
-        cmds = " && ".join(cmds)
     log.debug("Remote running ({cmds}) on machine {m}".format(
         m=machine_id, cmds=cmds))
-    ret = get_command_output(
-        "{juju_home} juju run "
-        "--machine {m} '{cmds}'".format(juju_home=juju_home,
-                                        m=machine_id,
-                                        cmds=cmds))
+    session = RemoteSession(machine_id, juju_home)
+    session.run(cmds)
+    ret = session.execute()[0]
     log.debug("Remote run result: {r}".format(r=ret))
     return ret
 
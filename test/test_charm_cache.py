@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# tests charm_cache.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from cloudinstall.charm_cache import CharmCache, CharmCacheError
+
+URL = 'https://example.com/charm/tarball/stable'
+BRANCH = 'lp:charms/trusty/ntp'
+
+
+def make_tarball(top, contents):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        data = contents.encode('utf-8')
+        info = tarfile.TarInfo(os.path.join(top, 'metadata.yaml'))
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def response(status_code, content=b'', etag=None):
+    r = MagicMock(name='response')
+    r.status_code = status_code
+    r.content = content
+    r.headers = {'ETag': etag} if etag else {}
+    return r
+
+
+class FakeBzr:
+
+    """ bzr revision-info and export against an in-memory branch """
+
+    def __init__(self, revid):
+        self.revid = revid
+        self.exports = 0
+        self.reachable = True
+
+    def __call__(self, cmd, **kwargs):
+        if not self.reachable:
+            raise subprocess.CalledProcessError(3, cmd, b'Connection error')
+        if cmd[1] == 'revision-info':
+            return '4 {}\n'.format(self.revid).encode('utf-8')
+        assert cmd[1] == 'export'
+        self.exports += 1
+        os.makedirs(cmd[4])
+        with open(os.path.join(cmd[4], 'revision'), 'w') as f:
+            f.write(cmd[3])
+        return b''
+
+
+class CharmCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.dest = os.path.join(self.tempdir, 'local-charms', 'ntp')
+        self.cache = CharmCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read_dest(self, fname):
+        with open(os.path.join(self.dest, fname)) as f:
+            return f.read()
+
+    @patch('cloudinstall.charm_cache.subprocess.check_output')
+    def test_bzr_unchanged_revision_not_exported_again(self, mock_check):
+        bzr = mock_check.side_effect = FakeBzr('rev-a')
+        self.cache.install(self.cache.bzr_branch(BRANCH), self.dest)
+        self.cache.install(self.cache.bzr_branch(BRANCH), self.dest)
+        self.assertEqual(bzr.exports, 1)
+        self.assertEqual(self.read_dest('revision'), 'revid:rev-a')
+
+        bzr.revid = 'rev-b'
+        self.cache.install(self.cache.bzr_branch(BRANCH), self.dest)
+        self.assertEqual(bzr.exports, 2)
+        self.assertEqual(self.read_dest('revision'), 'revid:rev-b')
+
+    @patch('cloudinstall.charm_cache.subprocess.check_output')
+    def test_bzr_unreachable_uses_cache(self, mock_check):
+        bzr = mock_check.side_effect = FakeBzr('rev-a')
+        self.cache.bzr_branch(BRANCH)
+        bzr.reachable = False
+        tree = self.cache.bzr_branch(BRANCH)
+        self.assertEqual(os.listdir(tree), ['revision'])
+
+    @patch('cloudinstall.charm_cache.subprocess.check_output')
+    def test_offline_uses_populated_cache_dir(self, mock_check):
+        mock_check.side_effect = FakeBzr('rev-a')
+        self.cache.bzr_branch(BRANCH)
+        mock_check.reset_mock()
+
+        offline = CharmCache(self.cache_dir, offline=True)
+        offline.install(offline.bzr_branch(BRANCH), self.dest)
+        self.assertEqual(self.read_dest('revision'), 'revid:rev-a')
+        self.assertFalse(mock_check.called)
+
+    def test_offline_not_cached_raises(self):
+        self.cache.offline = True
+        self.assertRaises(CharmCacheError, self.cache.tarball, URL)
+
+    @patch('cloudinstall.charm_cache.requests.get')
+    def test_tarball_etag(self, mock_get):
+        mock_get.return_value = response(
+            200, make_tarball('charm-abc123', 'name: one'), etag='"e1"')
+        self.cache.install(self.cache.tarball(URL), self.dest)
+        self.assertEqual(self.read_dest('metadata.yaml'), 'name: one')
+
+        mock_get.return_value = response(304)
+        self.cache.install(self.cache.tarball(URL), self.dest)
+        _, kwargs = mock_get.call_args
+        self.assertEqual(kwargs['headers'], {'If-None-Match': '"e1"'})
+        self.assertEqual(self.cache.fetch_count, 1)
+
+        mock_get.return_value = response(
+            200, make_tarball('charm-def456', 'name: two'), etag='"e2"')
+        self.cache.install(self.cache.tarball(URL), self.dest)
+        self.assertEqual(self.read_dest('metadata.yaml'), 'name: two')
+        self.assertEqual(self.cache.fetch_count, 2)
+
+    @patch('cloudinstall.charm_cache.requests.get')
+    def test_tarball_download_error_uses_cache(self, mock_get):
+        mock_get.return_value = response(
+            200, make_tarball('charm-abc123', 'name: one'), etag='"e1"')
+        self.cache.tarball(URL)
+        mock_get.side_effect = requests.ConnectionError()
+        self.cache.install(self.cache.tarball(URL), self.dest)
+        self.assertEqual(self.read_dest('metadata.yaml'), 'name: one')
+
+    @patch('cloudinstall.charm_cache.requests.get')
+    def test_tarball_unsafe_path(self, mock_get):
+        mock_get.return_value = response(
+            200, make_tarball('../escape', 'name: one'))
+        self.assertRaises(CharmCacheError, self.cache.tarball, URL)
+        self.assertEqual(os.listdir(self.cache.objects_dir), [])
+
+    def test_install_unchanged_keeps_dest(self):
+        tree = os.path.join(self.cache.objects_dir, 'abc')
+        os.makedirs(tree)
+        self.cache.install(tree, self.dest)
+        with open(os.path.join(self.dest, 'local-change'), 'w') as f:
+            f.write('x')
+        self.cache.install(tree, self.dest)
+        self.assertTrue(os.path.exists(os.path.join(self.dest,
+                                                    'local-change')))
+
+    @patch('cloudinstall.charm_cache.requests.get')
+    def test_prune_least_recently_used(self, mock_get):
+        self.cache.max_bytes = 15
+        trees = []
+        for i, name in enumerate(['name: one', 'name: two', 'name: six']):
+            mock_get.return_value = response(
+                200, make_tarball('charm', name), etag=str(i))
+            trees.append(self.cache.tarball('{}/{}'.format(URL, i)))
+            self.assertTrue(os.path.isdir(trees[-1]))
+            self.cache.install(trees[-1], self.dest)
+        self.assertEqual([os.path.isdir(t) for t in trees],
+                         [False, False, True])
+
+    @patch('cloudinstall.charm_cache.requests.get')
+    def test_prune_skips_trees_not_installed(self, mock_get):
+        self.cache.max_bytes = 15
+        trees = []
+        for i, name in enumerate(['name: one', 'name: two']):
+            mock_get.return_value = response(
+                200, make_tarball('charm', name), etag=str(i))
+            trees.append(self.cache.tarball('{}/{}'.format(URL, i)))
+        self.assertEqual([os.path.isdir(t) for t in trees], [True, True])
+        self.cache.release(trees[0])
+        self.cache.prune()
+        self.assertEqual([os.path.isdir(t) for t in trees], [False, True])
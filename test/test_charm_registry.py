@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# tests charm_registry.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cloudinstall import utils
+from cloudinstall.charm_registry import charm_registry, CharmRegistry
+from cloudinstall.charms.ceph import CharmCeph
+from cloudinstall.charms.keystone import CharmKeystone
+
+log = logging.getLogger('cloudinstall.test_charm_registry')
+
+PLUGIN_PATH = os.path.join(os.path.dirname(__file__), 'files/charm_plugins')
+
+
+class CharmRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.release_file = tempfile.mkstemp()
+        os.write(fd, b'icehouse')
+        os.close(fd)
+        patcher = patch('cloudinstall.charm_registry.release_path')
+        self.addCleanup(patcher.stop)
+        patcher.start().return_value = self.release_file
+
+    def tearDown(self):
+        os.unlink(self.release_file)
+
+    def test_indexes(self):
+        registry = CharmRegistry().refresh()
+        self.assertIs(registry.get('keystone'), CharmKeystone)
+        self.assertIsNone(registry.get('no-such-charm'))
+        self.assertIn(CharmKeystone, registry.core)
+        self.assertIn(CharmCeph, registry.isolated)
+        self.assertNotIn(CharmCeph, registry.core)
+        self.assertTrue(all(cc.subordinate for cc in registry.subordinate))
+        self.assertFalse(any(cc.disabled for cc in registry.enabled))
+
+    @patch('cloudinstall.charm_registry.utils.load_charms',
+           wraps=utils.load_charms)
+    def test_loads_once(self, mock_load_charms):
+        registry = CharmRegistry(check_interval=0)
+        for _ in range(5):
+            registry.get('keystone')
+        self.assertEqual(mock_load_charms.call_count, 1)
+
+    @patch('cloudinstall.charm_registry.utils.load_charms',
+           wraps=utils.load_charms)
+    def test_reloads_when_release_file_changes(self, mock_load_charms):
+        registry = CharmRegistry(check_interval=0)
+        registry.refresh()
+        st = os.stat(self.release_file)
+        os.utime(self.release_file, (st.st_atime, st.st_mtime + 10))
+        registry.refresh()
+        self.assertEqual(mock_load_charms.call_count, 2)
+
+        registry.invalidate()
+        registry.refresh()
+        self.assertEqual(mock_load_charms.call_count, 3)
+
+    def test_plugin_charms(self):
+        registry = CharmRegistry(PLUGIN_PATH).refresh()
+        self.assertEqual(registry.get('bitlbee').name(), 'bitlbee')
+        self.assertNotEqual(registry.get('openstack-dashboard').__module__,
+                            'cloudinstall.charms.horizon')
+
+    def test_shared(self):
+        self.assertIs(charm_registry(), charm_registry(None))
+        self.assertIs(charm_registry(''), charm_registry())
+        self.assertIsNot(charm_registry(PLUGIN_PATH), charm_registry())
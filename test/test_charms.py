@@ -20,12 +20,15 @@ import logging
 import os
 from importlib import import_module
 import pkgutil
+import tempfile
 import unittest
 from unittest.mock import ANY, MagicMock, patch
 
+from macumba import MacumbaError, ServerError
+
 import cloudinstall.utils as utils
 import cloudinstall.charms
-from cloudinstall.charms import CharmBase, CharmQueue
+from cloudinstall.charms import CharmBase, CharmConfigCache, CharmQueue
 from cloudinstall.charms.neutron_openvswitch import CharmNeutronOpenvswitch
 from cloudinstall.charms.compute import CharmNovaCompute
 from cloudinstall.charms.controller import CharmNovaCloudController
@@ -33,6 +36,7 @@ from cloudinstall.charms.glance import CharmGlance
 from cloudinstall.charms.swift import CharmSwift
 from cloudinstall.charms.mysql import CharmMysql
 from cloudinstall.charms.ntp import CharmNtp
+from cloudinstall.service import Relation, Unit
 
 log = logging.getLogger('cloudinstall.test_charms')
 
@@ -71,6 +75,121 @@ class TestCharmBase(unittest.TestCase):
                                                        0, ANY, None,
                                                        None)
 
+    @patch('cloudinstall.charms.get_charm_config_section')
+    def test_deploy_sends_own_section(self, mock_section):
+        self.mock_config.getopt.return_value = False
+        mock_section.return_value = 'fake:\n  opt: 1\n'
+        self.charm.charm_name = 'fake'
+        self.charm.deploy('fake mspec')
+        mock_section.assert_called_once_with('fake')
+        self.mock_jujuclient.deploy.assert_called_with('fake', 'fake',
+                                                       1, 'fake:\n  opt: 1\n',
+                                                       ANY, 'fake mspec')
+
+    def test_add_units_one_request(self):
+        self.charm.charm_name = 'fake'
+        self.assertEqual(self.charm.add_units(['1', 'lxc:2', '', 'kvm:3']),
+                         [])
+        self.mock_jujuclient.call.assert_called_once_with(dict(
+            Type="Client", Request="AddServiceUnits",
+            Params=dict(ServiceName='fake', NumUnits=4,
+                        Placement=[dict(Scope='#', Directive='1'),
+                                   dict(Scope='lxc', Directive='2'),
+                                   dict(Scope='kvm', Directive='3')])))
+
+    def full_status(self, *machine_ids):
+        units = {'fake/{}'.format(i): {'Machine': m}
+                 for i, m in enumerate(machine_ids)}
+        return {'Services': {'fake': {'Units': units}}}
+
+    def test_add_units_partial_failure(self):
+        self.charm.charm_name = 'fake'
+        self.mock_jujuclient.status.return_value = self.full_status('1', '2')
+        self.mock_jujuclient.call.side_effect = ServerError(
+            'no such machine', dict(Error='no such machine'))
+        # the unplaced unit goes last, so it fails along with '3'
+        self.assertEqual(self.charm.add_units(['', '2', '3'],
+                                              existing=['1']), [0, 2])
+
+    def test_add_units_counted_from_full_status(self):
+        """ the watched model lags the API: it is not consulted """
+        self.charm.charm_name = 'fake'
+        stale = self.mock_juju_state.service.return_value
+        stale.units = []
+        self.mock_jujuclient.status.return_value = self.full_status(
+            '1', '2/lxc/0', '2/lxc/1')
+        self.mock_jujuclient.call.side_effect = ServerError('boom', {})
+        self.assertEqual(self.charm.add_units(['lxc:2', 'lxc:2', 'lxc:2',
+                                               '1']), [2, 3])
+        self.assertFalse(self.mock_juju_state.snapshot.called)
+        self.assertFalse(self.mock_juju_state.service.called)
+
+    def test_add_units_success_reads_no_status(self):
+        self.charm.charm_name = 'fake'
+        self.assertEqual(self.charm.add_units(['1', '2']), [])
+        self.assertFalse(self.mock_jujuclient.status.called)
+
+    def test_add_units_connection_error(self):
+        self.charm.charm_name = 'fake'
+        self.mock_jujuclient.status.return_value = self.full_status('1')
+        self.mock_jujuclient.call.side_effect = MacumbaError()
+        self.assertEqual(self.charm.add_units(['1', '2']), [1])
+        self.mock_jujuclient.status.side_effect = MacumbaError()
+        self.assertEqual(self.charm.add_units(['1', '2']), [0, 1])
+
+
+class CharmConfigCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, 'charmconf.yaml')
+        self.cache = CharmConfigCache(self.filename)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write_config(self, text, mtime):
+        with open(self.filename, 'w') as f:
+            f.write(text)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_no_file(self):
+        self.assertEqual(self.cache.get(), ({}, None))
+        self.assertEqual(self.cache.section('keystone'), "")
+        self.assertEqual(self.cache.section_file('keystone'), None)
+
+    def test_parsed_once(self):
+        self.write_config("keystone: {admin-password: pass}\n", 1000)
+        config, raw = self.cache.get()
+        self.assertEqual(config, {'keystone': {'admin-password': 'pass'}})
+        self.cache.get()
+        self.cache.section('keystone')
+        self.assertEqual(self.cache.load_count, 1)
+
+    def test_reparsed_after_change(self):
+        self.write_config("keystone: {admin-password: pass}\n", 1000)
+        self.cache.section('keystone')
+        self.write_config("keystone: {admin-password: other}\n", 2000)
+        self.assertEqual(self.cache.section('keystone'),
+                         "keystone:\n  admin-password: other\n")
+        self.assertEqual(self.cache.load_count, 2)
+
+    def test_section_only_has_charm(self):
+        self.write_config("keystone: {admin-password: pass}\n"
+                          "mysql: {dataset-size: 512M}\n", 1000)
+        self.assertEqual(self.cache.section('mysql'),
+                         "mysql:\n  dataset-size: 512M\n")
+        self.assertEqual(self.cache.section('ntp'), "")
+
+    def test_section_file(self):
+        self.write_config("mysql: {dataset-size: 512M}\n", 1000)
+        fname = self.cache.section_file('mysql')
+        with open(fname) as f:
+            self.assertEqual(f.read(), "mysql:\n  dataset-size: 512M\n")
+        mtime = os.stat(fname).st_mtime_ns
+        self.assertEqual(self.cache.section_file('mysql'), fname)
+        self.assertEqual(os.stat(fname).st_mtime_ns, mtime)
+
 
 class PrepCharmTest(unittest.TestCase):
 
@@ -179,6 +298,46 @@ class TestCharmQueuePostProc(unittest.TestCase):
         for c in charms:
             self.assertTrue(isinstance(c, CharmBase))
 
+    def test_post_proc_ready_waits_for_started_unit(self):
+        charm = CharmSwift(juju=self.mock_jujuclient,
+                           juju_state=self.mock_juju_state,
+                           ui=self.mock_ui, config=self.mock_config)
+        svc = self.mock_juju_state.service.return_value
+        svc.units = []
+        self.assertFalse(CharmBase.post_proc_ready(charm))
+        svc.units = [Unit('swift-storage/0', {'AgentState': 'started'})]
+        svc.relation.return_value = Relation('swift-storage',
+                                             ['swift-proxy'])
+        self.assertTrue(CharmBase.post_proc_ready(charm))
+        svc.relation.return_value = Relation('swift-storage', [])
+        self.assertFalse(CharmBase.post_proc_ready(charm))
+
+    def test_post_proc_ready_after_relation_failed(self):
+        charm = CharmSwift(juju=self.mock_jujuclient,
+                           juju_state=self.mock_juju_state,
+                           ui=self.mock_ui, config=self.mock_config)
+        svc = self.mock_juju_state.service.return_value
+        svc.units = [Unit('swift-storage/0', {'AgentState': 'started'})]
+        svc.relation.return_value = Relation('swift-storage', [])
+        charm.relation_engine = MagicMock(name='relation_engine')
+        charm.relation_engine.gave_up.return_value = False
+        self.assertFalse(CharmBase.post_proc_ready(charm))
+        charm.relation_engine.gave_up.return_value = True
+        self.assertTrue(CharmBase.post_proc_ready(charm))
+
+    @patch('cloudinstall.charms.PostProcScheduler')
+    def test_watch_post_proc_skips_charms_without_post_proc(
+            self, mock_scheduler):
+        self.charm.deployed_charms = [CharmNovaCloudController, CharmMysql]
+        mock_scheduler.return_value.is_complete.return_value = True
+        self.charm.watch_post_proc()
+        charms, = mock_scheduler.call_args[0]
+        self.assertEqual([c.charm_name for c in charms],
+                         ['nova-cloud-controller'])
+        self.assertTrue(self.charm.wait_deploy_complete(timeout=0))
+        self.mock_config.setopt.assert_called_once_with('deploy_complete',
+                                                        True)
+
 
 class TestCharmPlugin(unittest.TestCase):
 
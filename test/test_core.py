@@ -15,17 +15,30 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import Counter
 import logging
+import os
+from tempfile import TemporaryDirectory
 import unittest
 from unittest.mock import MagicMock, patch
 
 from cloudinstall.config import Config
 from cloudinstall.core import Controller
 from cloudinstall.juju import JujuState
+from cloudinstall.placement.controller import AssignmentType
 
 log = logging.getLogger('cloudinstall.test_core')
 
 
+def temp_config(testcase):
+    """ A Config that saves to a temporary file instead of
+    ~/.cloud-install/config.yaml, where it would outlive the test
+    """
+    tempdir = TemporaryDirectory()
+    testcase.addCleanup(tempdir.cleanup)
+    return Config({}, cfg_file=os.path.join(tempdir.name, 'config.yaml'))
+
+
 class WaitForDeployedServicesReadyCoreTestCase(unittest.TestCase):
 
     """ Tests core.wait_for_deployed_services_ready to make sure waiting
@@ -72,3 +85,148 @@ class WaitForDeployedServicesReadyCoreTestCase(unittest.TestCase):
             self.dc.wait_for_deployed_services_ready()
         print(mock_sleep.mock_calls)
         self.assertEqual(len(mock_sleep.mock_calls), 2)
+
+
+class TryDeployTestCase(unittest.TestCase):
+
+    """ Tests that core.try_deploy adds units in one batch and keeps
+    machines whose units failed assigned
+    """
+
+    def setUp(self):
+        self.conf = temp_config(self)
+        self.conf.setopt('headless', True)
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.placement_controller = MagicMock(name='pc')
+        self.machines = [MagicMock(name='m{}'.format(i)) for i in range(4)]
+        self.dc.placement_controller.get_assignments.return_value = {
+            AssignmentType.LXC: self.machines}
+        self.dc.get_machine_spec = MagicMock(
+            side_effect=lambda m, atype: 'lxc:{}'.format(
+                self.machines.index(m)))
+        self.charm = MagicMock(name='charm')
+        self.charm.deploy.return_value = False
+        self.charm.unit_placements.return_value = Counter()
+        self.charm_class = MagicMock(name='charm_class',
+                                     return_value=self.charm)
+
+    def marked(self):
+        return [c[0][0] for c in
+                self.dc.placement_controller.mark_deployed.call_args_list]
+
+    def test_one_deploy_one_add_units(self):
+        self.charm.add_units.return_value = []
+        self.assertFalse(self.dc.try_deploy(self.charm_class))
+        self.charm.deploy.assert_called_once_with('lxc:0')
+        self.charm.add_units.assert_called_once_with(['lxc:1', 'lxc:2',
+                                                      'lxc:3'], ['lxc:0'])
+        self.assertEqual(self.marked(), self.machines)
+
+    def test_failed_units_stay_assigned(self):
+        self.charm.add_units.return_value = [1, 2]
+        self.assertTrue(self.dc.try_deploy(self.charm_class))
+        self.assertEqual(self.marked(), self.machines[:2])
+
+    def test_existing_service_gets_missing_units(self):
+        self.dc.juju_state = MagicMock(name='juju_state')
+        service = MagicMock(name='service')
+        service.service_name = 'fake'
+        self.dc.juju_state.services = [service]
+        self.charm_class.charm_name = 'fake'
+        self.charm_class.subordinate = False
+        self.charm.add_units.return_value = []
+        self.assertFalse(self.dc._deploy_if_needed(self.charm_class))
+        self.assertFalse(self.charm.deploy.called)
+        self.charm.add_units.assert_called_once_with(['lxc:0', 'lxc:1',
+                                                      'lxc:2', 'lxc:3'], [])
+        self.assertEqual(self.dc.deployed_charm_classes, [self.charm_class])
+
+    def test_existing_service_skips_machines_with_units(self):
+        self.charm.unit_placements.return_value = Counter({'lxc:1': 1,
+                                                           'lxc:3': 1})
+        self.charm.add_units.return_value = []
+        self.assertFalse(self.dc.try_deploy(self.charm_class,
+                                            service_exists=True))
+        self.charm.add_units.assert_called_once_with(['lxc:0', 'lxc:2'], [])
+        self.assertEqual(self.marked(), [self.machines[1], self.machines[3],
+                                         self.machines[0], self.machines[2]])
+
+    def test_deploy_retried_on_next_machine(self):
+        self.charm.deploy.side_effect = [True, False]
+        self.charm.add_units.return_value = []
+        self.assertTrue(self.dc.try_deploy(self.charm_class))
+        self.charm.add_units.assert_called_once_with(['lxc:2', 'lxc:3'],
+                                                     ['lxc:1'])
+        self.assertEqual(self.marked(), self.machines[1:])
+
+
+class UpdateNodeStatesTestCase(unittest.TestCase):
+
+    """ Tests that the services view is rebuilt for every new juju status,
+    whether or not it raised an event
+    """
+
+    def setUp(self):
+        self.conf = temp_config(self)
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.juju_state = MagicMock(name='juju_state')
+        self.dc.juju_state.services = []
+        self.dc.update_nodes = MagicMock(name='update_nodes')
+
+    def test_rebuilt_on_new_snapshot(self):
+        first, second = MagicMock(name='first'), MagicMock(name='second')
+        self.dc.juju_state.snapshot.side_effect = [first, first, second]
+        for _ in range(3):
+            self.dc.update_node_states()
+        self.assertEqual(self.dc.update_nodes.call_count, 2)
+
+
+class RemoteFanOutCoreTestCase(unittest.TestCase):
+
+    """ Tests that per-machine setup goes out in one fan-out """
+
+    def setUp(self):
+        self.conf = temp_config(self)
+        self.conf.setopt('headless', True)
+        self.dc = Controller(ui=MagicMock(name='ui'), config=self.conf,
+                             loop=MagicMock(name='loop'))
+        self.dc.juju_state = MagicMock(name='juju_state')
+        machines = []
+        for i in range(3):
+            m = MagicMock(name='machine{}'.format(i))
+            m.machine_id = str(i)
+            m.machine = {'InstanceId': 'node-{}'.format(i)}
+            machines.append(m)
+        self.dc.juju_state.machines.return_value = machines
+
+    @patch('cloudinstall.utils.remote_fan_out')
+    def test_set_unique_hostnames(self, mock_fan_out):
+        self.dc.set_unique_hostnames()
+        sessions, = mock_fan_out.call_args[0]
+        self.assertEqual([s.machine_id for s in sessions], ['0', '1', '2'])
+        self.assertEqual(sessions[1].cmds,
+                         ["echo node-1 | sudo tee /etc/hostname && "
+                          "sudo hostname node-1"])
+
+    @patch('cloudinstall.utils.remote_fan_out')
+    def test_set_unique_hostnames_failure_raises(self, mock_fan_out):
+        ok = dict(results=[dict(status=0, output='', err='')], error=None)
+        mock_fan_out.return_value = {
+            '0': ok, '2': ok,
+            '1': dict(results=[dict(status=1, output='tee: denied\n',
+                                    err='')], error=None)}
+        with self.assertLogs('cloudinstall.core', 'ERROR') as logs:
+            with self.assertRaises(Exception):
+                self.dc.set_unique_hostnames()
+        self.assertIn('machine 1 failed: command 0 exited 1: tee: denied',
+                      logs.output[0])
+
+    @patch('cloudinstall.utils.remote_fan_out')
+    def test_run_apt_go_fast_failure_logged(self, mock_fan_out):
+        mock_fan_out.return_value = {
+            '1': dict(results=None, error=OSError('no juju'))}
+        with self.assertLogs('cloudinstall.core', 'WARNING') as logs:
+            self.dc.run_apt_go_fast(['1'])
+        self.assertIn("machine 1: OSError('no juju'", logs.output[0])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# tests deploy_scheduler.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+from cloudinstall.charms.compute import CharmNovaCompute
+from cloudinstall.charms.horizon import CharmHorizon
+from cloudinstall.charms.keystone import CharmKeystone
+from cloudinstall.charms.mongodb import CharmMongo
+from cloudinstall.charms.mysql import CharmMysql
+from cloudinstall.charms.ntp import CharmNtp
+from cloudinstall.charms.rabbitmq import CharmRabbitMQ
+from cloudinstall.charms.swift import CharmSwift
+from cloudinstall.charms.swift_proxy import CharmSwiftProxy
+from cloudinstall.deploy_scheduler import DeployScheduler, deploy_graph
+
+
+class DeployGraphTestCase(unittest.TestCase):
+
+    def test_waits_only_for_linked_lower_priority(self):
+        graph = deploy_graph([CharmMysql, CharmNtp, CharmMongo,
+                              CharmRabbitMQ, CharmKeystone, CharmHorizon,
+                              CharmNovaCompute])
+        self.assertEqual(graph[CharmNtp], set())
+        self.assertEqual(graph[CharmMongo], set())
+        self.assertEqual(graph[CharmRabbitMQ], set())
+        self.assertEqual(graph[CharmKeystone], {CharmMysql})
+        self.assertEqual(graph[CharmHorizon], {CharmKeystone})
+        self.assertEqual(graph[CharmNovaCompute],
+                         {CharmMysql, CharmNtp, CharmRabbitMQ})
+
+    def test_mutual_depends_same_priority(self):
+        graph = deploy_graph([CharmSwift, CharmSwiftProxy])
+        self.assertEqual(graph[CharmSwift], set())
+        self.assertEqual(graph[CharmSwiftProxy], set())
+
+
+class DeploySchedulerTestCase(unittest.TestCase):
+
+    def test_independent_charms_deploy_concurrently(self):
+        charms = [CharmNtp, CharmMongo, CharmRabbitMQ]
+        barrier = threading.Barrier(len(charms), timeout=5)
+
+        def deploy(cc):
+            barrier.wait()
+            return False
+
+        scheduler = DeployScheduler(charms, deploy, max_workers=3)
+        scheduler.run()
+        self.assertEqual(scheduler.pending(), [])
+
+    def test_dependents_wait(self):
+        order = []
+        lock = threading.Lock()
+
+        def deploy(cc):
+            with lock:
+                order.append(cc)
+            return False
+
+        DeployScheduler([CharmMysql, CharmKeystone, CharmHorizon],
+                        deploy).run()
+        self.assertEqual(order, [CharmMysql, CharmKeystone, CharmHorizon])
+
+    def test_deferred_retried_alone_with_backoff(self):
+        attempts = []
+        lock = threading.Lock()
+
+        def deploy(cc):
+            with lock:
+                attempts.append(cc)
+            return cc is CharmMysql and attempts.count(CharmMysql) < 3
+
+        updates = []
+        scheduler = DeployScheduler([CharmMysql, CharmNtp, CharmKeystone],
+                                    deploy, retry_delay=0.01,
+                                    on_update=updates.append)
+        scheduler.run()
+        self.assertEqual(attempts.count(CharmMysql), 3)
+        self.assertEqual(attempts.count(CharmNtp), 1)
+        self.assertEqual(attempts.count(CharmKeystone), 1)
+        self.assertLess(attempts.index(CharmNtp), attempts.index(
+            CharmKeystone))
+        self.assertEqual(attempts[-1], CharmKeystone)
+        self.assertEqual(updates[0], [CharmMysql, CharmNtp, CharmKeystone])
+        self.assertEqual(updates[-1], [])
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['mysql']['attempts'], 3)
+        # two retries: 0.01s then 0.02s
+        self.assertGreaterEqual(stats['mysql']['deploy_time'], 0.03)
+        self.assertGreaterEqual(stats['keystone']['queue_wait'], 0)
+
+    def test_exception_is_deferral(self):
+        calls = []
+
+        def deploy(cc):
+            calls.append(cc)
+            if len(calls) == 1:
+                raise Exception("boom")
+            return False
+
+        scheduler = DeployScheduler([CharmNtp], deploy, retry_delay=0.01)
+        scheduler.run()
+        self.assertEqual(calls, [CharmNtp, CharmNtp])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# tests events.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from cloudinstall.events import (diff_snapshots, EventType,
+                                 StatusEventStream)
+from cloudinstall.juju import JujuState, JujuStatusSnapshot
+
+log = logging.getLogger('cloudinstall.test_events')
+
+
+def make_status(machines, units, relations=None):
+    """ FullStatus with one machine per (id, state) and a keystone service
+    with one unit per (name, state)
+    """
+    return {'Machines': {mid: {'Id': mid, 'AgentState': state,
+                               'Containers': {}}
+                         for mid, state in machines},
+            'Services': {'keystone': {
+                'Units': {name: {'AgentState': state}
+                          for name, state in units},
+                'Relations': relations or {}}}}
+
+
+class DiffSnapshotsTestCase(unittest.TestCase):
+
+    def diff(self, old, new):
+        old = None if old is None else JujuStatusSnapshot(old)
+        return [(e.type, e.name)
+                for e in diff_snapshots(old, JujuStatusSnapshot(new))]
+
+    def test_everything_added_from_nothing(self):
+        status = make_status([('1', 'started')], [('keystone/0', 'pending')],
+                             {'identity-service': ['glance']})
+        self.assertEqual(self.diff(None, status), [
+            (EventType.MACHINE_ADDED, '1'),
+            (EventType.MACHINE_STARTED, '1'),
+            (EventType.SERVICE_ADDED, 'keystone'),
+            (EventType.UNIT_ADDED, 'keystone/0'),
+            (EventType.RELATION_JOINED,
+             ('keystone', 'identity-service', 'glance'))])
+
+    def test_no_changes(self):
+        status = make_status([('1', 'started')], [('keystone/0', 'pending')])
+        self.assertEqual(self.diff(status, dict(status)), [])
+
+    def test_state_changes(self):
+        old = make_status([('1', 'pending'), ('2', 'pending')],
+                          [('keystone/0', 'pending'),
+                           ('keystone/1', 'pending')])
+        new = make_status([('1', 'started'), ('3', 'pending')],
+                          [('keystone/0', 'started'),
+                           ('keystone/1', 'error')],
+                          {'identity-service': ['glance']})
+        self.assertEqual(self.diff(old, new), [
+            (EventType.MACHINE_STATE_CHANGED, '1'),
+            (EventType.MACHINE_STARTED, '1'),
+            (EventType.MACHINE_ADDED, '3'),
+            (EventType.MACHINE_REMOVED, '2'),
+            (EventType.UNIT_STATE_CHANGED, 'keystone/0'),
+            (EventType.UNIT_STATE_CHANGED, 'keystone/1'),
+            (EventType.UNIT_ERROR, 'keystone/1'),
+            (EventType.RELATION_JOINED,
+             ('keystone', 'identity-service', 'glance'))])
+
+
+class StatusEventStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = StatusEventStream()
+        self.pending = JujuStatusSnapshot(
+            make_status([('1', 'pending')], [('keystone/0', 'pending')]))
+        self.started = JujuStatusSnapshot(
+            make_status([('1', 'started')], [('keystone/0', 'error')]))
+
+    def test_generation_only_advances_on_change(self):
+        self.stream.publish(self.pending)
+        self.assertEqual(self.stream.generation, 1)
+        self.assertEqual(self.stream.publish(self.pending), [])
+        self.assertEqual(self.stream.generation, 1)
+        self.stream.publish(self.started)
+        self.assertEqual(self.stream.generation, 2)
+
+    def test_subscribers_filter_by_type(self):
+        everything = MagicMock()
+        errors = MagicMock()
+        self.stream.subscribe(everything)
+        self.stream.subscribe(errors, [EventType.UNIT_ERROR])
+        self.stream.publish(self.pending)
+        self.assertEqual(errors.call_count, 0)
+        self.stream.publish(self.started)
+        self.assertEqual(everything.call_count, 2)
+        (events,), _ = errors.call_args
+        self.assertEqual([e.name for e in events], ['keystone/0'])
+
+        self.stream.unsubscribe(everything)
+        self.stream.publish(self.pending)
+        self.assertEqual(everything.call_count, 2)
+
+    def test_failing_subscriber_does_not_stop_others(self):
+        other = MagicMock()
+        self.stream.subscribe(MagicMock(side_effect=ValueError))
+        self.stream.subscribe(other)
+        self.stream.publish(self.pending)
+        self.assertEqual(other.call_count, 1)
+
+    def test_wait(self):
+        self.assertEqual(self.stream.wait(0, timeout=0.01), 0)
+        t = threading.Timer(0.05, self.stream.publish, [self.pending])
+        t.start()
+        self.assertEqual(self.stream.wait(0, timeout=5), 1)
+        t.join()
+
+
+class JujuStateEventsTestCase(unittest.TestCase):
+
+    def test_new_status_is_published(self):
+        juju = MagicMock()
+        juju.status.return_value = make_status([('1', 'pending')], [])
+        js = JujuState(juju)
+        js.machines()
+        js.machines()
+        self.assertEqual(js.events.generation, 1)
+
+        juju.status.return_value = make_status([('1', 'started')], [])
+        js.machines(max_age=0)
+        self.assertEqual(js.events.generation, 2)
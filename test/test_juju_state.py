@@ -17,10 +17,10 @@
 
 import logging
 import unittest
-from unittest.mock import MagicMock, PropertyMock
+from unittest.mock import MagicMock, PropertyMock, patch
 
 from cloudinstall.config import Config
-from cloudinstall.juju import JujuState
+from cloudinstall.juju import JujuState, JujuStatusSnapshot
 from cloudinstall.service import Service
 
 log = logging.getLogger('cloudinstall.test_core')
@@ -58,20 +58,95 @@ class JujuStateTestCase(unittest.TestCase):
     def test_services_ready(self):
         """ Verifies all ready services  """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_ready)
-        type(juju_state).services = services
-
-        not_ready = [(a, b) for a, b in juju_state.get_agent_states()
-                     if b != 'started']
+        with patch.object(JujuState, 'services', new_callable=PropertyMock,
+                          return_value=self.services_ready):
+            not_ready = [(a, b) for a, b in juju_state.get_agent_states()
+                         if b != 'started']
 
         self.assertEqual(len(not_ready), 0)
 
     def test_some_services_ready(self):
         """ Verifies some ready services == not_ready list """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_some_ready)
-        type(juju_state).services = services
-        not_ready = [(a, b) for a, b in juju_state.get_agent_states()
-                     if b != 'started']
-        self.assertEqual(len(not_ready), 2)
-        self.assertFalse(juju_state.all_agents_started())
+        with patch.object(JujuState, 'services', new_callable=PropertyMock,
+                          return_value=self.services_some_ready):
+            not_ready = [(a, b) for a, b in juju_state.get_agent_states()
+                         if b != 'started']
+            self.assertEqual(len(not_ready), 2)
+            self.assertFalse(juju_state.all_agents_started())
+
+
+class JujuStatusSnapshotTestCase(unittest.TestCase):
+
+    """ Tests indexed lookups in JujuState """
+
+    def setUp(self):
+        self.status = {
+            'Machines': {
+                '0': {'InstanceId': 'bootstrap',
+                      'Containers': {'0/lxc/0': {'InstanceId': 'c0'}}},
+                '1': {'InstanceId': 'node-1', 'AgentState': 'started',
+                      'Hardware': 'arch=amd64 cpu-cores=2 mem=2048M',
+                      'Containers': {'1/lxc/0': {'InstanceId': 'c1'}}},
+                '2': {'InstanceId': 'node-2', 'AgentState': 'pending'}},
+            'Services': {
+                'keystone': {'Units': {'keystone/0': {'Machine': '1/lxc/0'}}},
+                'ntp': {'Units': None}}}
+        self.mock_juju = MagicMock()
+        self.mock_juju.status.return_value = self.status
+        self.juju_state = JujuState(juju=self.mock_juju)
+
+    def test_indexes(self):
+        snap = JujuStatusSnapshot(self.status)
+        self.assertEqual(sorted(snap.machines_by_id), ['1', '2'])
+        self.assertEqual(snap.machines_by_instance_id['node-2'].machine_id,
+                         '2')
+        self.assertEqual(list(snap.containers_by_id), ['1/lxc/0'])
+        self.assertEqual(sorted(snap.services_by_name), ['keystone', 'ntp'])
+        self.assertEqual(list(snap.units_by_name), ['keystone/0'])
+
+    def test_indexes_are_read_only(self):
+        snap = JujuStatusSnapshot(self.status)
+        with self.assertRaises(TypeError):
+            snap.machines_by_id['3'] = None
+
+    def test_lookups(self):
+        js = self.juju_state
+        self.assertEqual(js.machine('1').arch, 'amd64')
+        self.assertEqual(js.machine('0').machine_id, -1)
+        self.assertEqual(js.machine_by_instance_id('node-1').machine_id, '1')
+        self.assertEqual(js.machine_or_container('1/lxc/0').instance_id,
+                         'c1')
+        self.assertIsNone(js.machine_or_container('0/lxc/0'))
+        self.assertEqual(js.base_machine('1/lxc/0').machine_id, '1')
+        self.assertEqual(js.unit('keystone/0').machine_id, '1/lxc/0')
+        self.assertEqual(js.service('missing').units, [])
+        self.assertEqual(len(js.machines()), 2)
+
+    def test_models_parsed_once(self):
+        m = self.juju_state.machine('1')
+        self.assertEqual((m.cpu_count, m.mem_mb, m.storage_mb),
+                         (2, 2048, None))
+        self.assertEqual(m.mem, '2048M')
+        self.assertEqual(m.storage, 'N/A')
+        self.assertEqual(m.storage, 'N/A')
+        self.assertIs(m.containers, m.containers)
+        with self.assertRaises(AttributeError):
+            m.not_a_field = 1
+
+        svc = self.juju_state.service('keystone')
+        self.assertIs(svc.units, svc.units)
+        self.assertIs(svc.units[0],
+                      self.juju_state.unit('keystone/0'))
+        self.assertEqual(self.juju_state.service('ntp').units, [])
+
+    def test_snapshot_reused_until_refetch(self):
+        js = self.juju_state
+        snap = js.snapshot()
+        js.machine('1')
+        js.service('keystone')
+        self.assertIs(js.snapshot(), snap)
+
+        js.invalidate_status_cache()
+        self.mock_juju.status.return_value = dict(self.status)
+        self.assertIsNot(js.snapshot(), snap)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+#
+# tests juju.py JujuWatcherState
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from base64 import b64encode
+from hashlib import sha1
+import json
+import logging
+from queue import Queue
+import socketserver
+import struct
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from macumba import JujuClient, RequestTimeout
+
+from cloudinstall.events import EventType
+from cloudinstall.juju import JujuWatcherState, hardware_string
+
+log = logging.getLogger('cloudinstall.test_juju_watcher')
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+REPLY_DELAY = 0.05
+
+
+class FakeJujuHandler(socketserver.StreamRequestHandler):
+
+    """ Just enough of RFC 6455 and the Juju API to serve a macumba
+    client: answers Login and WatchAll, and replays the server's queued
+    delta batches, one per AllWatcher Next call.
+    """
+
+    def handle(self):
+        headers = {}
+        self.rfile.readline()
+        for line in iter(self.rfile.readline, b'\r\n'):
+            k, v = line.decode('ascii').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        accept = b64encode(sha1(headers['sec-websocket-key'].encode('ascii') +
+                                WS_GUID).digest()).decode('ascii')
+        response = ["HTTP/1.1 101 Switching Protocols",
+                    "Upgrade: websocket",
+                    "Connection: Upgrade",
+                    "Sec-WebSocket-Accept: {}".format(accept)]
+        if 'sec-websocket-protocol' in headers:
+            protocol = headers['sec-websocket-protocol'].split(',')[0]
+            response.append("Sec-WebSocket-Protocol: {}".format(protocol))
+        self.wfile.write(("\r\n".join(response) + "\r\n\r\n").encode('ascii'))
+        self.send_lock = threading.Lock()
+
+        while True:
+            opcode, payload = self.read_frame()
+            if opcode is None or opcode == 0x8:
+                return
+            if opcode == 0x9:
+                self.send_frame(payload, opcode=0xA)
+            elif opcode == 0x1:
+                self.dispatch(json.loads(payload.decode('utf-8')))
+
+    def read_frame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2:
+            return None, None
+        opcode = head[0] & 0x0f
+        length = head[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if head[1] & 0x80 else b'\0\0\0\0'
+        data = self.rfile.read(length)
+        return opcode, bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+    def send_frame(self, payload, opcode=0x1):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.send_lock:
+            self.wfile.write(head + payload)
+
+    def reply(self, request_id, response=None, error=None):
+        msg = dict(RequestId=request_id)
+        if error:
+            msg['Error'] = error
+        else:
+            msg['Response'] = response or {}
+        # macumba overwrites a reply that arrives before its do_send()
+        # has returned, and then waits for it forever
+        time.sleep(REPLY_DELAY)
+        self.send_frame(json.dumps(msg).encode('utf-8'))
+
+    def dispatch(self, msg):
+        rtype = msg.get('Type', msg.get('type'))
+        request = msg.get('Request', msg.get('request'))
+        rid = msg['RequestId']
+        self.server.requests.append((rtype, request))
+        if (rtype, request) == ('Admin', 'RedirectInfo'):
+            self.reply(rid, error='not redirected')
+        elif (rtype, request) == ('Client', 'WatchAll'):
+            self.reply(rid, dict(AllWatcherId='1'))
+        elif (rtype, request) == ('AllWatcher', 'Next'):
+            # Next blocks until there are changes, like the real thing
+            def next_batch():
+                deltas = self.server.batches.get()
+                if deltas is not None:
+                    self.reply(rid, dict(Deltas=deltas))
+            threading.Thread(target=next_batch, daemon=True).start()
+        elif (rtype, request) == ('Client', 'FullStatus'):
+            self.reply(rid, dict(Machines={}, Services={}))
+        else:
+            self.reply(rid)
+
+
+class FakeJujuServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeJujuHandler)
+        self.batches = Queue()
+        self.requests = []
+
+    @property
+    def url(self):
+        return "ws://127.0.0.1:{}/".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.batches.put(None)
+        self.shutdown()
+        self.server_close()
+
+
+def machine_delta(mid, status='started', **kwargs):
+    d = dict(Id=mid, InstanceId='inst-{}'.format(mid), Status=status,
+             StatusInfo='', Life='alive', Jobs=['JobHostUnits'],
+             HardwareCharacteristics=dict(Arch='amd64', CpuCores=2,
+                                          Mem=2048, RootDisk=8192),
+             Addresses=[dict(Value='10.0.0.{}'.format(len(mid)),
+                             Scope='public')])
+    d.update(kwargs)
+    return ['machine', 'change', d]
+
+
+def service_delta(name, **kwargs):
+    d = dict(Name=name, CharmURL='cs:trusty/{}-1'.format(name),
+             Exposed=False, Life='alive')
+    d.update(kwargs)
+    return ['service', 'change', d]
+
+
+def unit_delta(name, machine_id, status='pending', **kwargs):
+    d = dict(Name=name, Service=name.split('/')[0], MachineId=machine_id,
+             Status=status, StatusInfo='', PublicAddress='10.0.0.1')
+    d.update(kwargs)
+    return ['unit', 'change', d]
+
+
+def relation_delta(svc_a, name_a, svc_b, name_b, scope='global'):
+    eps = [dict(ServiceName=svc_a, Relation=dict(Name=name_a, Scope=scope)),
+           dict(ServiceName=svc_b, Relation=dict(Name=name_b, Scope=scope))]
+    key = "{}:{} {}:{}".format(svc_a, name_a, svc_b, name_b)
+    return ['relation', 'change', dict(Key=key, Endpoints=eps)]
+
+
+INITIAL_DELTAS = [machine_delta('0'),
+                  machine_delta('1'),
+                  machine_delta('1/lxc/0', HardwareCharacteristics={}),
+                  service_delta('mysql'),
+                  service_delta('keystone'),
+                  unit_delta('mysql/0', '1'),
+                  unit_delta('keystone/0', '1/lxc/0'),
+                  relation_delta('keystone', 'shared-db',
+                                 'mysql', 'shared-db')]
+
+
+class JujuWatcherStateDeltaTestCase(unittest.TestCase):
+
+    """ Tests applying deltas to the watched model """
+
+    def setUp(self):
+        self.juju_state = JujuWatcherState(juju=MagicMock())
+        self.juju_state.apply_deltas(INITIAL_DELTAS, reset=True)
+
+    def test_hardware_string(self):
+        hc = dict(Arch='amd64', CpuCores=2, Mem=2048, RootDisk=8192)
+        self.assertEqual(hardware_string(hc),
+                         "arch=amd64 cpu-cores=2 mem=2048M root-disk=8192M")
+        self.assertEqual(hardware_string(None), "")
+
+    def test_machines_exclude_bootstrap(self):
+        self.assertEqual([m.machine_id for m in self.juju_state.machines()],
+                         ['1'])
+
+    def test_machine_hardware(self):
+        m = self.juju_state.machine('1')
+        self.assertEqual(m.instance_id, 'inst-1')
+        self.assertEqual(m.arch, 'amd64')
+        self.assertEqual(m.cpu_cores, '2')
+        self.assertEqual(m.agent_state, 'started')
+
+    def test_containers_are_nested(self):
+        m = self.juju_state.machine('1')
+        self.assertEqual([c.machine_id for c in m.containers], ['1/lxc/0'])
+        c = self.juju_state.machine_or_container('1/lxc/0')
+        self.assertEqual(c.instance_id, 'inst-1/lxc/0')
+        self.assertEqual(self.juju_state.base_machine('1/lxc/0').machine_id,
+                         '1')
+
+    def test_services_units_relations(self):
+        svc = self.juju_state.service('keystone')
+        self.assertEqual([u.unit_name for u in svc.units], ['keystone/0'])
+        self.assertEqual(svc.units[0].machine_id, '1/lxc/0')
+        self.assertTrue(svc.relation('shared-db').is_relation('mysql'))
+
+    def test_change_and_remove(self):
+        status = self.juju_state.status()
+        self.juju_state.apply_deltas([unit_delta('mysql/0', '1', 'started'),
+                                      ['unit', 'remove',
+                                       dict(Name='keystone/0')]])
+        self.assertIsNot(status, self.juju_state.status())
+        self.assertEqual(self.juju_state.get_agent_states(),
+                         [('mysql', 'started')])
+        self.assertEqual(self.juju_state.service('keystone').units, [])
+        self.assertTrue(self.juju_state.all_agents_started())
+
+    def test_deltas_publish_events(self):
+        gen = self.juju_state.events.generation
+        events = []
+        self.juju_state.events.subscribe(events.extend)
+        self.juju_state.apply_deltas([unit_delta('mysql/0', '1', 'error')])
+        self.assertEqual(self.juju_state.events.generation, gen + 1)
+        self.assertEqual([(e.type, e.name) for e in events],
+                         [(EventType.UNIT_STATE_CHANGED, 'mysql/0'),
+                          (EventType.UNIT_ERROR, 'mysql/0')])
+        self.assertEqual(self.juju_state.wait_for_events(gen, timeout=0),
+                         gen + 1)
+
+    def test_reset_discards_model(self):
+        self.juju_state.apply_deltas([machine_delta('2')], reset=True)
+        self.assertEqual([m.machine_id for m in self.juju_state.machines()],
+                         ['2'])
+        self.assertEqual(self.juju_state.services, [])
+
+    def test_does_not_fetch_full_status(self):
+        self.juju_state.machines()
+        self.juju_state.invalidate_status_cache()
+        self.juju_state.machines()
+        self.assertEqual(self.juju_state.juju.status.call_count, 0)
+
+    def test_unsynced_falls_back_to_full_status(self):
+        js = JujuWatcherState(juju=MagicMock())
+        js.juju.status.return_value = {'Machines': {}, 'Services': {}}
+        self.assertEqual(js.machines(), [])
+        js.juju.status.assert_called_once_with()
+
+
+class JujuWatcherStateWatchTestCase(unittest.TestCase):
+
+    """ Tests the watch loop against a mock API connection """
+
+    def setUp(self):
+        self.juju_state = JujuWatcherState(juju=MagicMock(), next_timeout=7,
+                                           resubscribe_delay=3)
+        self.juju_state.juju.get_watcher.side_effect = [
+            dict(AllWatcherId='1'), dict(AllWatcherId='2')]
+        self.calls = []
+        self.replies = []
+        self.juju_state.juju.call.side_effect = self.call
+
+    def call(self, params, timeout=None):
+        self.calls.append((params['Request'], params['Id'], timeout))
+        if params['Request'] != 'Next':
+            return {}
+        if len(self.replies) == 0:
+            self.juju_state._watching = False
+            raise RequestTimeout()
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def watch(self):
+        self.juju_state._watching = True
+        with patch('cloudinstall.juju.time.sleep') as sleep:
+            self.juju_state._watch()
+        return sleep
+
+    def test_next_timeout_resubscribes(self):
+        self.replies = [dict(Deltas=INITIAL_DELTAS), RequestTimeout(),
+                        dict(Deltas=[machine_delta('2')])]
+        self.watch()
+        self.assertEqual(self.calls, [('Next', '1', 7),
+                                      ('Next', '1', 7),
+                                      ('Stop', '1', 30),
+                                      ('Next', '2', 7),
+                                      ('Next', '2', 7)])
+        # the new watcher's first batch is the whole model
+        self.assertEqual([m.machine_id for m in self.juju_state.machines()],
+                         ['2'])
+
+    def test_subscribe_timeout_waits(self):
+        self.juju_state.juju.get_watcher.side_effect = [
+            RequestTimeout(), dict(AllWatcherId='2')]
+        self.replies = [dict(Deltas=INITIAL_DELTAS)]
+        sleep = self.watch()
+        sleep.assert_called_once_with(3)
+        self.assertEqual(self.calls[0], ('Next', '2', 7))
+
+
+class JujuWatcherStateServerTestCase(unittest.TestCase):
+
+    """ Tests JujuWatcherState against a fake websocket API server """
+
+    def setUp(self):
+        self.server = FakeJujuServer()
+        self.server.start()
+        self.juju = JujuClient(url=self.server.url, password='fake')
+        self.juju.login()
+        self.juju_state = JujuWatcherState(self.juju, sync_timeout=5)
+
+    def tearDown(self):
+        self.juju_state.stop()
+        self.server.stop()
+        self.juju.close()
+
+    def test_replays_delta_stream(self):
+        self.server.batches.put(INITIAL_DELTAS)
+        self.juju_state.start()
+        # waits up to sync_timeout for the first batch
+        self.assertEqual(len(self.juju_state.machines()), 1)
+        gen = self.juju_state.events.generation
+        self.assertEqual(gen, 1)
+        self.assertFalse(self.juju_state.all_agents_started())
+
+        self.server.batches.put([unit_delta('mysql/0', '1', 'started'),
+                                 unit_delta('keystone/0', '1/lxc/0',
+                                            'started')])
+        gen = self.juju_state.wait_for_events(gen, timeout=5)
+        self.assertEqual(gen, 2)
+        self.assertTrue(self.juju_state.all_agents_started())
+
+        self.server.batches.put([machine_delta('2', status='pending')])
+        self.juju_state.wait_for_events(gen, timeout=5)
+        self.assertEqual(self.juju_state.machine('2').agent_state, 'pending')
+
+        self.assertEqual(self.server.requests.count(('Client', 'WatchAll')),
+                         1)
+        self.assertNotIn(('Client', 'FullStatus'), self.server.requests)
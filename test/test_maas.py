@@ -97,6 +97,22 @@ class MaasMachineTestCase(unittest.TestCase):
     def test_ready_state(self):
         self.assertEqual(self.m_ready.status, MaasMachineStatus.READY)
 
+    def test_typed_hardware(self):
+        m = MaasMachine('m1id', {'cpu_count': 2,
+                                 'storage': 20480,
+                                 'memory': 2048,
+                                 'architecture': 'amd64'})
+        self.assertEqual((m.cpu_count, m.mem_mb, m.storage_mb),
+                         (2, 2048, 20480))
+        self.assertEqual((m.mem, m.storage), ("2.0G", "20.00G"))
+        self.assertEqual(m.arch, 'amd64')
+
+    def test_unknown_hardware(self):
+        m = MaasMachine('m2id', {'storage': '*', 'memory': '*'})
+        self.assertEqual((m.mem_mb, m.storage_mb), (None, None))
+        self.assertEqual((m.mem, m.storage), ("N/A", "N/A"))
+        self.assertEqual(self.empty_machine.storage, "N/A")
+
 
 class MaasMachineStatusTestCase(unittest.TestCase):
     """MaasMachine should use the same labels as MAAS 1.7"""
@@ -160,3 +176,29 @@ class MaasStateTestCase(unittest.TestCase):
         s = MaasState(self.mock_client_oneready)
         ready_machines = s.machines(MaasMachineStatus.READY)
         self.assertEqual(len(ready_machines), 1)
+
+    def test_indexes(self):
+        s = MaasState(self.mock_client_oneready)
+        m = s.machines()[0]
+        self.assertIs(s.machine(m.instance_id), m)
+        self.assertIs(s.machine_by_system_id(m.system_id), m)
+        self.assertIs(s.machine_by_hostname('389wq.maas'), m)
+        self.assertIsNone(s.machine_by_hostname('juju-bootstrap.maas'))
+        self.assertIsNone(s.machine('missing'))
+        self.assertEqual(s.machines(MaasMachineStatus.ALLOCATED), [])
+
+    def test_summary_counts_bootstrap(self):
+        s = MaasState(self.mock_client_oneready)
+        self.assertEqual(s.machines_summary(),
+                         {MaasMachineStatus.READY: 1,
+                          MaasMachineStatus.DEPLOYED: 1})
+
+    def test_machines_built_once_per_refresh(self):
+        nodes = self.mock_client_oneready.nodes
+        client = MagicMock()
+        type(client).nodes = PropertyMock(side_effect=lambda: list(nodes))
+        s = MaasState(client)
+        m = s.machines()[0]
+        self.assertIs(s.machines(MaasMachineStatus.READY)[0], m)
+        s.invalidate_nodes_cache()
+        self.assertIsNot(s.machines()[0], m)
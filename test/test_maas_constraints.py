@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# tests maas/constraints.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import unittest
+
+from cloudinstall.maas import MaasMachine, satisfies
+from cloudinstall.maas.constraints import compile_constraints, MachineColumns
+
+log = logging.getLogger('cloudinstall.test_maas_constraints')
+
+
+def make_machine(name, cpu_count=2, memory=2048, storage=20480,
+                 architecture='amd64/generic'):
+    return MaasMachine(name, {'hostname': name,
+                              'cpu_count': cpu_count,
+                              'memory': memory,
+                              'storage': storage,
+                              'architecture': architecture})
+
+
+class ConstraintMatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.machines = [make_machine('small'),
+                         make_machine('big', cpu_count=16, memory=65536,
+                                      storage=1024000),
+                         make_machine('arm', architecture='armhf/generic'),
+                         make_machine('any', '*', '*', '*', '*'),
+                         MaasMachine('broken', {'hostname': 'broken'})]
+        self.columns = MachineColumns(self.machines)
+
+    def match(self, constraints):
+        return compile_constraints(constraints).match(self.columns)
+
+    def test_empty_matches_everything(self):
+        self.assertEqual(self.match({}).mask, [True] * 5)
+        self.assertEqual(self.match(None).mask, [True] * 5)
+
+    def test_mask_and_failures(self):
+        match = self.match({'mem': '4G', 'arch': 'amd64/generic'})
+        self.assertEqual([m.hostname for m in match.satisfying()],
+                         ['big', 'any'])
+        self.assertEqual(match.failures['mem'],
+                         [True, False, True, False, True])
+        self.assertEqual(match.failures['arch'],
+                         [False, False, True, False, True])
+        self.assertEqual(sorted(match.failed(2)), ['arch', 'mem'])
+        self.assertEqual(match.failed(1), [])
+
+    def test_unknown_arch(self):
+        self.assertEqual(self.match({'arch': 'ENIAC'}).mask,
+                         [False, False, False, True, False])
+
+    def test_agrees_with_satisfies(self):
+        for constraints in [{'mem': 1024, 'root-disk': 20480},
+                            {'cpu_cores': 4, 'storage': '1T'},
+                            {'mem': '2048', 'arch': 'armhf/generic'}]:
+            match = self.match(constraints)
+            for i, m in enumerate(self.machines):
+                sat, failed = satisfies(m, constraints)
+                self.assertEqual(sat, match.mask[i])
+                self.assertEqual(sorted(failed), sorted(match.failed(i)))
+
+    def test_compiled_once(self):
+        constraints = {'mem': '2G', 'cpu_cores': 2}
+        self.assertIs(compile_constraints(constraints),
+                      compile_constraints(dict(constraints)))
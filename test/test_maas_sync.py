@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# tests maas/sync.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+from socketserver import ThreadingMixIn
+import threading
+import unittest
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlsplit
+
+from maasclient import MaasClient
+from maasclient.auth import MaasAuth
+
+from cloudinstall.maas import MaasMachineStatus, MaasState
+from cloudinstall.maas.sync import MaasNodeSync, maas_get
+
+log = logging.getLogger('cloudinstall.test_maas_sync')
+
+
+def make_node(i, status=MaasMachineStatus.NEW.value):
+    system_id = 'node-{}'.format(i)
+    return {'system_id': system_id,
+            'hostname': 'host-{}.maas'.format(i),
+            'status': status,
+            'resource_uri': '/MAAS/api/1.0/nodes/{}/'.format(system_id),
+            'cpu_count': 2, 'memory': 2048, 'storage': 20480,
+            'architecture': 'amd64/generic', 'power_type': 'ipmi'}
+
+
+class FakeMaasHandler(BaseHTTPRequestHandler):
+
+    """ GET /MAAS/api/1.0/nodes/?op=list[&id=...], with ETags """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append((url.path, query))
+        if self.server.fail:
+            self.send_error(500)
+            return
+        if url.path != '/MAAS/api/1.0/nodes/' or query.get('op') != ['list']:
+            self.send_error(404)
+            return
+
+        nodes = list(self.server.nodes.values())
+        ids = query.get('id', None)
+        if ids is not None:
+            nodes = [n for n in nodes if n['system_id'] in ids]
+        body = json.dumps(nodes).encode('utf-8')
+        etag = '"{}"'.format(md5(body).hexdigest())
+        if ids is None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if ids is None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeMaasServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, n_nodes):
+        super().__init__(('127.0.0.1', 0), FakeMaasHandler)
+        self.nodes = {n['system_id']: n for n in
+                      [make_node(i) for i in range(n_nodes)]}
+        self.requests = []
+        self.fail = False
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:{}/MAAS/api/1.0".format(
+            self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,),
+                         daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MaasNodeSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeMaasServer(20)
+        self.server.start()
+        auth = MaasAuth(api_url=self.server.api_url, api_key='a:b:c')
+        self.client = MaasClient(auth)
+        self.sync = MaasNodeSync(self.client, full_sync_interval=60)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def set_status(self, i, status):
+        self.server.nodes['node-{}'.format(i)]['status'] = status.value
+
+    def test_maas_get_signs_like_maasclient(self):
+        self.client.get('/nodes/', dict(op='list'))
+        res = maas_get(self.client.auth, '/nodes/', dict(op='list'),
+                       {'If-None-Match': '"x"'})
+        self.assertEqual(res.status_code, 200)
+        (client_path, client_query), (path, query) = self.server.requests
+        self.assertEqual(path, client_path)
+        self.assertEqual(sorted(query), sorted(client_query))
+        for k in ['oauth_consumer_key', 'oauth_token', 'oauth_signature',
+                  'oauth_signature_method']:
+            self.assertEqual(query[k], client_query[k])
+
+    def test_first_sync_is_full(self):
+        nodes = self.sync.nodes()
+        self.assertEqual(len(nodes), 20)
+        self.assertEqual(nodes, self.client.nodes)
+
+    def test_unchanged_full_listing_is_not_modified(self):
+        nodes = self.sync.nodes()
+        self.assertIs(self.sync.nodes(), nodes)
+        stats = self.sync.stats()
+        self.assertEqual(stats['not_modified'], 1)
+        self.assertEqual(stats['full'], 1)
+        self.assertGreater(stats['bytes_saved'], 0)
+
+    def test_watched_nodes_are_polled(self):
+        nodes = self.sync.nodes()
+        self.sync.watch(['node-3', 'node-4'])
+        self.set_status(3, MaasMachineStatus.READY)
+        new_nodes = self.sync.nodes()
+
+        self.assertIsNot(new_nodes, nodes)
+        self.assertEqual(new_nodes[3]['status'],
+                         MaasMachineStatus.READY.value)
+        self.assertIs(new_nodes[5], nodes[5])
+        _, query = self.server.requests[-1]
+        self.assertEqual(sorted(query['id']), ['node-3', 'node-4'])
+
+        # nothing changed on a second poll: same list
+        self.assertIs(self.sync.nodes(), new_nodes)
+        stats = self.sync.stats()
+        self.assertEqual((stats['requests'], stats['full'],
+                          stats['partial']), (3, 1, 2))
+        self.assertLess(stats['bytes_received'], 2 * stats['bytes_saved'])
+
+    def test_removed_watched_node(self):
+        self.sync.nodes()
+        self.sync.watch(['node-1'])
+        del self.server.nodes['node-1']
+        self.assertEqual(len(self.sync.nodes()), 19)
+
+    def test_unwatched_refresh_is_full_listing(self):
+        self.sync.nodes()
+        self.server.nodes['node-99'] = make_node(99)
+        self.assertEqual(len(self.sync.nodes()), 21)
+        self.assertEqual(len(self.sync.nodes()), 21)
+        stats = self.sync.stats()
+        self.assertEqual((stats['full'], stats['not_modified'],
+                          stats['full_listings_saved']), (2, 1, 1))
+
+    def test_full_listing_picks_up_new_nodes(self):
+        self.sync.nodes()
+        self.sync.watch(['node-1'])
+        self.server.nodes['node-99'] = make_node(99)
+        self.assertEqual(len(self.sync.nodes()), 20)
+        with patch('cloudinstall.maas.sync.time.time') as mock_time:
+            mock_time.return_value = 1e10
+            self.assertEqual(len(self.sync.nodes()), 21)
+
+    def test_error_keeps_last_nodes(self):
+        self.server.fail = True
+        self.assertEqual(self.sync.nodes(), [])
+        self.server.fail = False
+        nodes = self.sync.nodes()
+        self.server.fail = True
+        self.sync.watch(['node-1'])
+        self.assertIs(self.sync.nodes(), nodes)
+        self.assertEqual(self.sync.stats()['errors'], 2)
+
+    def test_maas_state(self):
+        state = MaasState(self.client, sync=self.sync)
+        self.assertEqual(state.machines(MaasMachineStatus.READY), [])
+        pending = state.machines()[:2]
+        state.watch([m.system_id for m in pending])
+        self.set_status(1, MaasMachineStatus.READY)
+        state.invalidate_nodes_cache()
+        ready = state.machines(MaasMachineStatus.READY)
+        self.assertEqual([m.system_id for m in ready], ['node-1'])
+        self.assertEqual(self.sync.stats()['partial'], 1)
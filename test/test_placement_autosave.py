@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# tests placement/autosave.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+import yaml
+
+from cloudinstall.placement.autosave import AutosaveWriter, write_atomic
+
+
+class AutosaveWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'placements.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read(self):
+        with open(self.filename) as f:
+            return yaml.load(f)
+
+    def test_burst_is_one_write(self):
+        writer = AutosaveWriter(self.filename, delay=60)
+        for i in range(100):
+            writer.save({'n': i})
+        self.assertFalse(os.path.exists(self.filename))
+        writer.close()
+        self.assertEqual(writer.write_count, 1)
+        self.assertEqual(self.read(), {'n': 99})
+
+    def test_writes_in_background(self):
+        writer = AutosaveWriter(self.filename, delay=0.01)
+        writer.save({'a': 1})
+        for _ in range(500):
+            if writer.write_count > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.read(), {'a': 1})
+        writer.close()
+
+    def test_unchanged_content_skipped(self):
+        writer = AutosaveWriter(self.filename, delay=60)
+        writer.save({'a': 1})
+        writer.flush()
+        writer.save({'a': 1})
+        writer.flush()
+        writer.close()
+        self.assertEqual(writer.write_count, 1)
+        self.assertEqual(writer.skip_count, 1)
+
+    def test_failed_write_keeps_old_file(self):
+        writer = AutosaveWriter(self.filename, delay=60)
+        writer.save({'a': 1})
+        writer.flush()
+        with patch('cloudinstall.placement.autosave.os.replace',
+                   side_effect=OSError('disk full')):
+            writer.save({'a': 2})
+            writer.flush()
+        writer.close()
+        self.assertEqual(self.read(), {'a': 1})
+        self.assertEqual(os.listdir(self.tempdir), ['placements.yaml'])
+
+    def test_write_atomic_keeps_mode(self):
+        write_atomic(self.filename, 'old')
+        os.chmod(self.filename, 0o600)
+        write_atomic(self.filename, 'new')
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o600)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'new')
@@ -38,6 +38,7 @@ import cloudinstall.utils as utils
 from cloudinstall.placement.controller import (AssignmentType,
                                                PlacementController,
                                                PlacementError)
+from cloudinstall.placement.fileformat import read_placements
 
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'maas-output')
@@ -139,9 +140,10 @@ class PlacementControllerTestCase(unittest.TestCase):
                          {AssignmentType.LXC: [self.mock_machine_2]})
 
     def test_gen_defaults(self):
-        satisfies_importstring = 'cloudinstall.placement.controller.satisfies'
-        with patch(satisfies_importstring) as mock_satisfies:
-            mock_satisfies.return_value = (True, )
+        compile_importstring = \
+            'cloudinstall.placement.controller.compile_constraints'
+        with patch(compile_importstring) as mock_compile:
+            mock_compile.return_value.match.return_value.mask = [True, True]
             defs = self.pc.gen_defaults(charm_classes=[CharmNovaCompute,
                                                        CharmKeystone],
                                         maas_machines=[self.mock_machine,
@@ -372,6 +374,21 @@ class PlacementControllerTestCase(unittest.TestCase):
                    if m.instance_id == 'fake-instance-id-2'))
         self.assertEqual(m2.constraints, {'cpu': 8})
 
+    def test_autosave(self):
+        with NamedTemporaryFile(mode='w+', encoding='utf-8') as tempf:
+            self.pc.set_autosave_filename(tempf.name)
+            self.pc.assign(self.mock_machine, CharmNovaCompute,
+                           AssignmentType.LXC)
+            self.pc.assign(self.mock_machine, CharmKeystone,
+                           AssignmentType.KVM)
+            self.pc.flush_autosave()
+            with open(tempf.name) as f:
+                saved = read_placements(f)
+            self.pc.set_autosave_filename(None)
+
+        self.assertEqual(saved['fake-instance-id-1']['assignments'],
+                         {'LXC': ['nova-compute'], 'KVM': ['keystone']})
+
     def test_load_machines_single(self):
         with NamedTemporaryFile(mode='w+', encoding='utf-8') as tempf:
             utils.spew(tempf.name, yaml.dump(dict()))
@@ -401,6 +418,13 @@ class PlacementControllerTestCase(unittest.TestCase):
                    if m.instance_id == 'fake_iid_2'))
         self.assertEqual(m2.constraints, {'cpu': 8})
 
+    def test_load_newer_version_raises(self):
+        with TemporaryFile(mode='w+', encoding='utf-8') as tempf:
+            tempf.write('{"format": "cloud-install-placements", '
+                        '"version": 99, "machines": {}, "charms": []}')
+            tempf.seek(0)
+            self.assertRaises(PlacementError, self.pc.load, tempf)
+
     def test_load_error_mismatch_charm_name(self):
         """Should safely ignore (and log) a charm name in a placement file
         that can't be matched to a loaded charm class."""
@@ -455,6 +479,128 @@ class PlacementControllerTestCase(unittest.TestCase):
         self.pc.clear_assignments(self.mock_machine)
         self.pc.clear_assignments(self.mock_machine_2)
 
+    def test_indexes_match_rebuild(self):
+        """indexes kept up by each change agree with a full rebuild"""
+        pc = self.pc
+        pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
+        pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
+        pc.assign(self.mock_machine_2, CharmNovaCompute, AssignmentType.KVM)
+        pc.assign(self.mock_machine, CharmKeystone, AssignmentType.LXC)
+        pc.assign(self.mock_machine_2, CharmKeystone, AssignmentType.KVM)
+        pc.mark_deployed(self.mock_machine, CharmNovaCompute,
+                         AssignmentType.LXC)
+        pc.remove_one_assignment(self.mock_machine_2, CharmNovaCompute)
+        pc.assign(self.mock_machine_2, CharmSwiftProxy, AssignmentType.LXC)
+        pc.clear_assignments(self.mock_machine_2)
+
+        def snapshot():
+            return [(pc.get_assignments(cc), pc.get_deployments(cc),
+                     pc.assignment_machine_count_for_charm(cc),
+                     pc.deployment_machine_count_for_charm(cc),
+                     pc.is_assigned(cc), pc.is_deployed(cc))
+                    for cc in pc.charm_classes()] + [
+                pc.machines_pending(), pc.assigned_services,
+                pc.deployed_services]
+
+        incremental = snapshot()
+        pc.reset_assigned_deployed()
+        self.assertEqual(incremental, snapshot())
+        self.assertEqual(pc.get_assignments(CharmNovaCompute),
+                         {AssignmentType.LXC: [self.mock_machine]})
+        self.assertEqual(pc.machines_pending(), [self.mock_machine])
+
+    def test_lookups_do_not_list_machines(self):
+        self.pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
+        self.mock_maas_state.reset_mock()
+        self.pc.get_assignments(CharmNovaCompute)
+        self.pc.assignment_machine_count_for_charm(CharmNovaCompute)
+        self.pc.is_assigned(CharmNovaCompute)
+        self.pc.machines_pending()
+        self.assertEqual(self.mock_maas_state.machines.call_count, 0)
+
+    def test_temp_copy_is_isolated(self):
+        self.pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
+        temp = self.pc.get_temp_copy()
+        temp.assign(self.mock_machine, CharmKeystone, AssignmentType.LXC)
+        self.assertFalse(self.pc.is_assigned_to(CharmKeystone,
+                                                self.mock_machine))
+        self.assertEqual(self.pc.assignments[self.mock_machine.instance_id][
+            AssignmentType.LXC], [CharmNovaCompute])
+        self.pc.update_from_controller(temp)
+        self.assertTrue(self.pc.is_assigned_to(CharmKeystone,
+                                               self.mock_machine))
+
+    def test_cached_charm_states_match_uncached(self):
+        pc = self.pc
+        graph = pc.charm_graph()
+
+        def uncached():
+            return {cc: pc._compute_charm_state(cc, graph)
+                    for cc in pc.charm_classes()}
+
+        self.assertEqual(pc.get_charm_states(), uncached())
+        pc.assign(self.mock_machine, CharmSwift, AssignmentType.BareMetal)
+        self.assertEqual(pc.get_charm_states(), uncached())
+        pc.mark_deployed(self.mock_machine, CharmSwift,
+                         AssignmentType.BareMetal)
+        pc.assign(self.mock_machine_2, CharmCeph, AssignmentType.LXC)
+        self.assertEqual(pc.get_charm_states(), uncached())
+        pc.clear_assignments(self.mock_machine_2)
+        self.assertEqual(pc.get_charm_states(), uncached())
+        pc.reset_assigned_deployed()
+        self.assertEqual(pc.get_charm_states(), uncached())
+
+    def test_assign_recomputes_only_affected_states(self):
+        pc = self.pc
+        pc.get_charm_states()
+        with patch.object(pc, '_compute_charm_state',
+                          wraps=pc._compute_charm_state) as mock_compute:
+            pc.get_charm_states()
+            self.assertEqual(mock_compute.call_count, 0)
+
+            pc.assign(self.mock_machine, CharmSwift, AssignmentType.LXC)
+            pc.get_charm_states()
+            recomputed = set(c[0][0] for c in mock_compute.call_args_list)
+        self.assertEqual(recomputed,
+                         pc.charm_graph().affects[CharmSwift])
+        self.assertIn(CharmSwiftProxy, recomputed)
+        self.assertNotIn(CharmKeystone, recomputed)
+
+    def test_temp_copy_commits_only_changes(self):
+        self.pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
+        self.pc.assign(self.mock_machine_2, CharmSwift, AssignmentType.KVM)
+        self.mock_maas_state.reset_mock()
+        temp = self.pc.get_temp_copy()
+        self.assertEqual(self.mock_maas_state.machines.call_count, 0)
+
+        temp.assign(self.mock_machine_2, CharmKeystone, AssignmentType.LXC)
+        # the original keeps changing while the copy is open
+        self.pc.assign(self.mock_machine, CharmCeph, AssignmentType.LXC)
+        self.assertFalse(temp.is_assigned(CharmCeph))
+
+        self.pc.update_from_controller(temp)
+        self.assertTrue(self.pc.is_assigned_to(CharmKeystone,
+                                               self.mock_machine_2))
+        self.assertTrue(self.pc.is_assigned_to(CharmCeph, self.mock_machine))
+        self.assertEqual(self.pc.assignments[self.mock_machine.instance_id][
+            AssignmentType.LXC], [CharmNovaCompute, CharmCeph])
+
+        incremental = (self.pc.assigned_services,
+                       self.pc.get_charm_states())
+        self.pc.reset_assigned_deployed()
+        self.assertEqual(incremental, (self.pc.assigned_services,
+                                       self.pc.get_charm_states()))
+
+    def test_temp_copy_dropped_leaves_original(self):
+        self.pc.assign(self.mock_machine, CharmNovaCompute, AssignmentType.LXC)
+        temp = self.pc.get_temp_copy()
+        temp.clear_assignments(self.mock_machine)
+        temp.assign(self.mock_machine_2, CharmKeystone, AssignmentType.LXC)
+        self.assertEqual(dict(self.pc.assignments),
+                         {'fake-instance-id-1': {
+                             AssignmentType.LXC: [CharmNovaCompute]}})
+        self.assertEqual(self.pc.assigned_services, {CharmNovaCompute})
+
     def test_gen_defaults_raises_with_no_maas_state(self):
         pc = PlacementController(None, self.conf)
         self.assertRaises(PlacementError, pc.gen_defaults)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# tests placement/fileformat.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from io import StringIO
+import json
+import unittest
+import yaml
+
+from cloudinstall.placement.fileformat import (FORMAT_VERSION,
+                                               PlacementFormatError,
+                                               read_placements,
+                                               write_placements)
+
+PLACEMENTS = {
+    'node-1': {'assignments': {'LXC': ['nova-compute', 'keystone'],
+                               'KVM': ['keystone']}},
+    'node-2': {'deployments': {'BareMetal': ['nova-compute']},
+               'constraints': {'cpu': 8}}}
+
+
+class PlacementFileFormatTestCase(unittest.TestCase):
+
+    def write(self, placements):
+        f = StringIO()
+        write_placements(placements, f)
+        return f.getvalue()
+
+    def test_round_trip(self):
+        text = self.write(PLACEMENTS)
+        self.assertEqual(read_placements(StringIO(text)), PLACEMENTS)
+
+    def test_header_and_charm_table(self):
+        doc = json.loads(self.write(PLACEMENTS))
+        self.assertEqual(doc['version'], FORMAT_VERSION)
+        self.assertEqual(doc['charms'], ['nova-compute', 'keystone'])
+        self.assertEqual(doc['machines']['node-1']['assignments']['KVM'],
+                         [1])
+
+    def test_empty(self):
+        self.assertEqual(read_placements(StringIO(self.write({}))), {})
+        self.assertEqual(read_placements(StringIO('')), {})
+
+    def test_reads_version_1_yaml(self):
+        self.assertEqual(read_placements(StringIO(yaml.dump(PLACEMENTS))),
+                         PLACEMENTS)
+        self.assertEqual(read_placements(StringIO(
+            yaml.dump(PLACEMENTS, default_flow_style=True))), PLACEMENTS)
+
+    def test_newer_version_raises(self):
+        text = self.write(PLACEMENTS).replace(
+            '"version": {}'.format(FORMAT_VERSION), '"version": 3')
+        self.assertRaises(PlacementFormatError, read_placements,
+                          StringIO(text))
+
+    def test_other_document_raises(self):
+        self.assertRaises(PlacementFormatError, read_placements,
+                          StringIO('{"version": 2, "machines": {}}'))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# tests placement/graph.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from cloudinstall.charms.ceph import CharmCeph
+from cloudinstall.charms.ceph_osd import CharmCephOSD
+from cloudinstall.charms.ceph_radosgw import CharmCephRadosGw
+from cloudinstall.charms.keystone import CharmKeystone
+from cloudinstall.charms.swift import CharmSwift
+from cloudinstall.charms.swift_proxy import CharmSwiftProxy
+
+from cloudinstall.placement.graph import CharmGraph
+
+
+class CharmGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = CharmGraph([CharmKeystone, CharmSwift, CharmSwiftProxy,
+                                 CharmCeph, CharmCephOSD])
+
+    def test_conflicts_are_symmetric(self):
+        self.graph.ensure(CharmCephRadosGw)
+        self.assertEqual(self.graph.conflicts[CharmCephRadosGw],
+                         {CharmSwift, CharmSwiftProxy})
+        self.assertIn(CharmCephRadosGw, self.graph.conflicts[CharmSwift])
+        self.assertIn(CharmCephRadosGw,
+                      self.graph.conflicts[CharmSwiftProxy])
+
+    def test_dependents(self):
+        self.assertEqual(self.graph.dependents[CharmSwiftProxy],
+                         {CharmSwift})
+        self.assertEqual(self.graph.dependents[CharmCeph], {CharmCephOSD})
+        self.assertEqual(self.graph.dependents[CharmKeystone], set())
+
+    def test_affects(self):
+        self.assertEqual(self.graph.affects[CharmCephOSD],
+                         {CharmCephOSD, CharmCeph})
+        self.assertEqual(self.graph.affects[CharmKeystone], {CharmKeystone})
+        self.graph.ensure(CharmCephRadosGw)
+        self.assertEqual(self.graph.affects[CharmCephRadosGw],
+                         {CharmCephRadosGw, CharmCeph, CharmSwift,
+                          CharmSwiftProxy})
+        self.assertIn(CharmCephRadosGw, self.graph.affects[CharmSwift])
+        self.assertIn(CharmCephRadosGw, self.graph.dependents[CharmCeph])
+
+    def test_core(self):
+        self.assertIn(CharmKeystone, self.graph.core)
+        self.assertNotIn(CharmSwift, self.graph.core)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# tests placement/solver.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import unittest
+from unittest.mock import MagicMock
+
+from cloudinstall.charms.ceph import CharmCeph
+from cloudinstall.charms.compute import CharmNovaCompute
+from cloudinstall.charms.glance import CharmGlance
+from cloudinstall.charms.keystone import CharmKeystone
+from cloudinstall.charms.mysql import CharmMysql
+from cloudinstall.charms.quantum import CharmQuantum
+from cloudinstall.charms.rabbitmq import CharmRabbitMQ
+from cloudinstall.config import Config
+from cloudinstall.maas import MaasMachine
+from cloudinstall.placement.controller import (AssignmentType,
+                                               PlacementController,
+                                               PlacementError)
+from cloudinstall.placement.solver import PlacementSolver
+
+log = logging.getLogger('cloudinstall.test_placement_solver')
+
+
+def make_machine(name, cpu_count, memory, storage):
+    return MaasMachine(name, {'hostname': name,
+                              'resource_uri': name,
+                              'cpu_count': cpu_count,
+                              'memory': memory,
+                              'storage': storage,
+                              'architecture': 'amd64/generic'})
+
+
+def hostnames(placements):
+    return [(m.hostname, cc.charm_name) for m, cc in placements]
+
+
+class PlacementSolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # listed largest first, so first-fit would waste the storage node
+        self.storage_node = make_machine('storage', 8, 16384, 2048000)
+        self.medium = make_machine('medium', 4, 8192, 81920)
+        self.small = make_machine('small', 2, 4096, 40960)
+        self.tiny = make_machine('tiny', 1, 2048, 20480)
+        self.machines = [self.storage_node, self.medium, self.small,
+                         self.tiny]
+
+    def test_isolated_on_smallest_satisfying(self):
+        solver = PlacementSolver(self.machines)
+        isolated, shared = solver.solve([CharmNovaCompute], [])
+        self.assertEqual(hostnames(isolated),
+                         [('small', 'nova-compute')])
+        self.assertEqual(solver.report['unused_machines'], 3)
+
+    def test_largest_demand_chooses_first(self):
+        solver = PlacementSolver([self.small, self.tiny, self.medium])
+        isolated, _ = solver.solve([CharmQuantum, CharmNovaCompute], [])
+        self.assertEqual(sorted(hostnames(isolated)),
+                         [('small', 'nova-compute'),
+                          ('tiny', 'quantum-gateway')])
+
+    def test_controller_services_spread_by_headroom(self):
+        solver = PlacementSolver([self.medium, self.small])
+        isolated, shared = solver.solve(
+            [], [CharmKeystone, CharmGlance, CharmMysql, CharmRabbitMQ])
+        # each takes 1G and 1 core, and goes where the most is left
+        self.assertEqual(hostnames(shared),
+                         [('medium', 'keystone'), ('medium', 'glance'),
+                          ('medium', 'mysql'),
+                          ('small', 'rabbitmq-server')])
+        self.assertEqual(solver.report['controller_hosts'], 2)
+        self.assertEqual(solver.report['headroom'],
+                         {'memory': 3072, 'cpu_count': 1})
+
+    def test_unplaced_are_reported(self):
+        solver = PlacementSolver([self.tiny])
+        isolated, shared = solver.solve([CharmCeph], [CharmKeystone])
+        self.assertEqual(hostnames(isolated), [('tiny', 'ceph')])
+        self.assertEqual(shared, [])
+        self.assertEqual(solver.report['unplaced'],
+                         ['ceph', 'ceph', 'keystone'])
+
+    def test_utilisation(self):
+        solver = PlacementSolver([self.small])
+        solver.solve([CharmNovaCompute], [])
+        self.assertEqual(solver.report['utilisation']['memory'], 1.0)
+        self.assertEqual(solver.report['utilisation']['storage'], 1.0)
+
+
+class GenDefaultsSolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.maas_state = MagicMock()
+        self.pc = PlacementController(self.maas_state, Config())
+        self.machines = [make_machine('big', 8, 16384, 2048000),
+                         make_machine('small', 2, 4096, 40960),
+                         make_machine('other', 4, 8192, 81920)]
+
+    def gen(self, solver):
+        return self.pc.gen_defaults([CharmNovaCompute, CharmKeystone],
+                                    list(self.machines), solver)
+
+    def test_first_fit(self):
+        defs = self.gen('first-fit')
+        self.assertEqual(defs['big'][AssignmentType.BareMetal],
+                         [CharmNovaCompute])
+        self.assertEqual(defs['small'][AssignmentType.LXC],
+                         [CharmKeystone])
+
+    def test_best_fit(self):
+        defs = self.gen('best-fit')
+        self.assertEqual(defs['small'][AssignmentType.BareMetal],
+                         [CharmNovaCompute])
+        self.assertEqual(defs['big'][AssignmentType.LXC],
+                         [CharmKeystone])
+
+    def test_config_option(self):
+        self.pc.config.setopt('placement_solver', 'best-fit')
+        defs = self.pc.gen_defaults([CharmNovaCompute],
+                                    list(self.machines))
+        self.assertIn('small', defs)
+
+    def test_unknown_solver(self):
+        self.assertRaises(PlacementError, self.gen, 'worst-fit')
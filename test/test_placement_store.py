@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# tests placement/store.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from cloudinstall.charms.compute import CharmNovaCompute
+from cloudinstall.charms.keystone import CharmKeystone
+from cloudinstall.placement.controller import AssignmentType
+from cloudinstall.placement.store import PlacementStore
+
+LXC = AssignmentType.LXC
+KVM = AssignmentType.KVM
+
+
+class PlacementStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = PlacementStore({'m1': {LXC: [CharmNovaCompute]},
+                                     'm2': {KVM: [CharmKeystone]}})
+
+    def test_unknown_machine_reads_empty(self):
+        self.assertEqual(self.store['nope'][LXC], [])
+        self.assertNotIn('nope', self.store)
+        self.assertEqual(self.store['m1'][KVM], [])
+        self.assertNotIn(KVM, self.store['m1'])
+
+    def test_snapshot_shares_until_written(self):
+        snap = self.store.snapshot()
+        self.assertIs(snap['m1'], self.store['m1'])
+        snap.add('m1', KVM, CharmKeystone)
+        self.assertIsNot(snap['m1'], self.store['m1'])
+        self.assertIs(snap['m2'], self.store['m2'])
+
+    def test_snapshot_isolated_from_store(self):
+        snap = self.store.snapshot()
+        self.store.add('m1', LXC, CharmKeystone)
+        del self.store['m2']
+        self.assertEqual(dict(snap), {'m1': {LXC: [CharmNovaCompute]},
+                                      'm2': {KVM: [CharmKeystone]}})
+        self.assertEqual(snap.diff(), {})
+
+    def test_store_isolated_from_snapshot(self):
+        snap = self.store.snapshot()
+        snap.add('m1', LXC, CharmKeystone)
+        snap.remove('m2', KVM, CharmKeystone)
+        snap['m3'] = {LXC: [CharmNovaCompute]}
+        self.assertEqual(dict(self.store),
+                         {'m1': {LXC: [CharmNovaCompute]},
+                          'm2': {KVM: [CharmKeystone]}})
+        self.assertEqual(snap.diff(),
+                         {'m1': {LXC: [CharmNovaCompute, CharmKeystone]},
+                          'm2': {},
+                          'm3': {LXC: [CharmNovaCompute]}})
+
+    def test_snapshots_isolated_from_each_other(self):
+        a = self.store.snapshot()
+        b = self.store.snapshot()
+        a.add('m1', LXC, CharmKeystone)
+        b.clear()
+        self.assertEqual(a['m1'][LXC], [CharmNovaCompute, CharmKeystone])
+        self.assertEqual(len(b), 0)
+        self.assertEqual(self.store['m1'][LXC], [CharmNovaCompute])
+
+    def test_commit_applies_only_diff(self):
+        snap = self.store.snapshot()
+        self.store.add('m2', KVM, CharmNovaCompute)
+        snap.add('m1', LXC, CharmKeystone)
+        self.assertEqual(snap.commit(),
+                         {'m1': {LXC: [CharmNovaCompute, CharmKeystone]}})
+        self.assertEqual(self.store['m1'][LXC],
+                         [CharmNovaCompute, CharmKeystone])
+        self.assertEqual(self.store['m2'][KVM],
+                         [CharmKeystone, CharmNovaCompute])
+        self.assertEqual(snap.diff(), {})
+
+    def test_rollback(self):
+        snap = self.store.snapshot()
+        snap.add('m1', LXC, CharmKeystone)
+        del snap['m2']
+        snap.rollback()
+        self.assertEqual(dict(snap), dict(self.store))
+        self.assertEqual(snap.diff(), {})
+        snap.add('m1', KVM, CharmKeystone)
+        self.assertEqual(self.store['m1'][KVM], [])
+
+    def test_remove_last_drops_machine(self):
+        self.store.remove('m2', KVM, CharmKeystone)
+        self.assertNotIn('m2', self.store)
+        self.assertRaises(ValueError, self.store.remove, 'm1', KVM,
+                          CharmKeystone)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# tests post_proc_scheduler.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from cloudinstall.post_proc_scheduler import PostProcScheduler
+
+
+class FakeCharm:
+
+    """ post_proc() returns results in turn, the last one for good """
+
+    def __init__(self, name, results=(False,), ready=True):
+        self.charm_name = name
+        self.results = list(results)
+        self.ready = ready
+        self.calls = []
+
+    def post_proc_ready(self):
+        return self.ready
+
+    def post_proc(self):
+        self.calls.append(time.time())
+        result = self.results[0]
+        if len(self.results) > 1:
+            self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class PostProcSchedulerTestCase(unittest.TestCase):
+
+    def make_scheduler(self, charms, **kwargs):
+        kwargs.setdefault('retry_delay', 0.01)
+        kwargs.setdefault('poll_interval', 0.01)
+        return PostProcScheduler(charms, **kwargs)
+
+    def test_all_succeed(self):
+        charms = [FakeCharm('a'), FakeCharm('b'), FakeCharm('c')]
+        scheduler = self.make_scheduler(charms)
+        scheduler.run()
+        self.assertTrue(scheduler.is_complete())
+        self.assertEqual([len(c.calls) for c in charms], [1, 1, 1])
+
+    def test_concurrent(self):
+        both_running = threading.Barrier(2, timeout=5)
+
+        class WaitingCharm(FakeCharm):
+
+            def post_proc(self):
+                both_running.wait()
+                return False
+
+        scheduler = self.make_scheduler([WaitingCharm('a'),
+                                         WaitingCharm('b')])
+        scheduler.run()
+        self.assertTrue(scheduler.is_complete())
+
+    def test_retry_backoff_per_charm(self):
+        failing = FakeCharm('a', results=[True, True, False])
+        ok = FakeCharm('b')
+        scheduler = self.make_scheduler([failing, ok], retry_delay=0.05)
+        scheduler.run()
+        self.assertEqual(scheduler.attempts, {failing: 3, ok: 1})
+        first, second = [b - a for a, b in zip(failing.calls,
+                                               failing.calls[1:])]
+        self.assertGreaterEqual(first, 0.05)
+        self.assertGreaterEqual(second, 0.1)
+
+    def test_exception_retried(self):
+        charm = FakeCharm('a', results=[Exception('boom'), False])
+        on_error = MagicMock()
+        scheduler = self.make_scheduler([charm], on_error=on_error)
+        scheduler.run()
+        self.assertEqual(len(charm.calls), 2)
+        self.assertEqual(on_error.call_count, 1)
+        failed_charm, e = on_error.call_args[0]
+        self.assertIs(failed_charm, charm)
+        self.assertEqual(str(e), 'boom')
+
+    def test_waits_until_ready(self):
+        charm = FakeCharm('a', ready=False)
+        scheduler = self.make_scheduler([charm])
+        scheduler.start()
+        self.assertFalse(scheduler.wait_complete(timeout=0.1))
+        self.assertEqual(charm.calls, [])
+        charm.ready = True
+        self.assertTrue(scheduler.wait_complete(timeout=5))
+        self.assertEqual(len(charm.calls), 1)
+
+    def test_stop(self):
+        scheduler = self.make_scheduler([FakeCharm('a', ready=False)])
+        scheduler.start()
+        scheduler.stop()
+        self.assertFalse(scheduler.wait_complete(timeout=5))
+        scheduler._thread.join(5)
+        self.assertFalse(scheduler._thread.is_alive())
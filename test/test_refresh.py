@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# tests refresh.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from macumba import RequestTimeout
+
+from cloudinstall.juju import JujuState
+from cloudinstall.refresh import RefreshCoordinator, backoff_delays
+
+log = logging.getLogger('cloudinstall.test_refresh')
+
+
+class BlockingFetch:
+
+    """ fetch() that blocks until released, counting calls """
+
+    def __init__(self):
+        self.calls = 0
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.entered.set()
+        self.release.wait(5)
+        return self.calls
+
+
+class RefreshCoordinatorTestCase(unittest.TestCase):
+
+    def test_caches_for_ttl(self):
+        fetch = MagicMock(side_effect=[1, 2])
+        rc = RefreshCoordinator(fetch, ttl=60)
+        self.assertEqual(rc.get(), 1)
+        self.assertEqual(rc.get(), 1)
+        self.assertEqual(rc.get(max_age=0), 2)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_invalidate(self):
+        fetch = MagicMock(side_effect=[1, 2])
+        rc = RefreshCoordinator(fetch, ttl=60)
+        rc.get()
+        rc.invalidate()
+        self.assertEqual(rc.get(), 2)
+
+    def test_concurrent_callers_share_one_fetch(self):
+        fetch = BlockingFetch()
+        rc = RefreshCoordinator(fetch, ttl=60)
+        results = []
+
+        def get():
+            results.append(rc.get())
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        threads[0].start()
+        fetch.entered.wait(5)
+        for t in threads[1:]:
+            t.start()
+        fetch.release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(fetch.calls, 1)
+        self.assertEqual(results, [1] * 8)
+
+    def test_stale_flight_is_not_shared(self):
+        fetch = BlockingFetch()
+        rc = RefreshCoordinator(fetch, ttl=60)
+        results = []
+        t1 = threading.Thread(target=lambda: results.append(rc.get()))
+        t1.start()
+        fetch.entered.wait(5)
+        rc.invalidate()
+        t2 = threading.Thread(target=lambda: results.append(rc.get()))
+        t2.start()
+        fetch.release.set()
+        t1.join(5)
+        t2.join(5)
+        self.assertEqual(fetch.calls, 2)
+        self.assertEqual(sorted(results), [1, 2])
+
+    def test_error_is_shared_and_not_cached(self):
+        fetch = MagicMock(side_effect=[ValueError("boom"), 3])
+        rc = RefreshCoordinator(fetch)
+        with self.assertRaises(ValueError):
+            rc.get()
+        self.assertEqual(rc.get(), 3)
+
+    @patch('cloudinstall.refresh.time.sleep')
+    def test_retries_with_backoff(self, mock_sleep):
+        fetch = MagicMock(side_effect=[RequestTimeout(), RequestTimeout(),
+                                       'ok'])
+        rc = RefreshCoordinator(fetch, retries=5, retry_on=(RequestTimeout,))
+        self.assertEqual(rc.get(), 'ok')
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(rc.stats()['count'], 3)
+
+    @patch('cloudinstall.refresh.time.sleep')
+    def test_gives_up_after_retries(self, mock_sleep):
+        fetch = MagicMock(side_effect=RequestTimeout())
+        rc = RefreshCoordinator(fetch, retries=5, retry_on=(RequestTimeout,))
+        with self.assertRaises(RequestTimeout):
+            rc.get()
+        self.assertEqual(fetch.call_count, 5)
+        self.assertEqual(mock_sleep.call_count, 4)
+
+    def test_backoff_delays(self):
+        delays = list(backoff_delays(5, base=1, cap=3))
+        self.assertEqual(len(delays), 4)
+        for d, bound in zip(delays, [1, 2, 3, 3]):
+            self.assertTrue(0 <= d <= bound)
+
+    def test_stats(self):
+        rc = RefreshCoordinator(MagicMock(return_value=1))
+        self.assertEqual(rc.stats()['count'], 0)
+        self.assertIsNone(rc.stats()['last'])
+        rc.get()
+        stats = rc.stats()
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['last'], stats['max'])
+
+
+class JujuStateRefreshTestCase(unittest.TestCase):
+
+    @patch('cloudinstall.refresh.time.sleep')
+    def test_status_timeout_raises(self, mock_sleep):
+        juju = MagicMock()
+        juju.status.side_effect = RequestTimeout()
+        js = JujuState(juju)
+        with self.assertRaises(Exception) as cm:
+            js.status()
+        self.assertEqual(str(cm.exception),
+                         "Connection failure with juju API")
+        self.assertEqual(juju.status.call_count, 5)
+
+    def test_machines_max_age(self):
+        juju = MagicMock()
+        juju.status.return_value = {'Machines': {}, 'Services': {}}
+        js = JujuState(juju)
+        js.machines()
+        js.machines()
+        self.assertEqual(juju.status.call_count, 1)
+        js.machines(max_age=0)
+        self.assertEqual(juju.status.call_count, 2)
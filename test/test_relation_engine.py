@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# tests relation_engine.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from macumba import ServerError
+
+from cloudinstall.relation_engine import is_related, RelationEngine
+from cloudinstall.service import Service
+
+MYSQL_GLANCE = ('mysql:shared-db', 'glance:shared-db')
+MYSQL_KEYSTONE = ('mysql:shared-db', 'keystone:shared-db')
+GLANCE_KEYSTONE = ('glance:identity-service', 'keystone:identity-service')
+
+
+class FakeJujuState:
+
+    """ Services whose relations are whatever add_relation has added """
+
+    def __init__(self):
+        self.relations = {}
+
+    def relate(self, relation_a, relation_b):
+        for this, other in ((relation_a, relation_b),
+                            (relation_b, relation_a)):
+            svc, rel = this.split(':')
+            self.relations.setdefault(svc, {}).setdefault(rel, []).append(
+                other.split(':')[0])
+
+    def service(self, name):
+        return Service(name, {'Relations': self.relations.get(name, {})})
+
+
+class RelationEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.juju_state = FakeJujuState()
+        self.juju = MagicMock(name='juju')
+        self.juju.add_relation.side_effect = self.juju_state.relate
+        self.engine = RelationEngine(self.juju, self.juju_state,
+                                     retry_delay=0.01, max_attempts=3)
+
+    def test_is_related(self):
+        self.assertFalse(is_related(self.juju_state, *MYSQL_GLANCE))
+        self.juju_state.relate('glance:shared-db', 'mysql:shared-db')
+        self.assertTrue(is_related(self.juju_state, *MYSQL_GLANCE))
+        self.assertTrue(is_related(self.juju_state, 'mysql', 'glance'))
+        self.assertFalse(is_related(self.juju_state, *MYSQL_KEYSTONE))
+
+    def test_only_missing_added(self):
+        self.juju_state.relate(*MYSQL_GLANCE)
+        futures = self.engine.start([MYSQL_GLANCE, MYSQL_KEYSTONE,
+                                     (MYSQL_KEYSTONE[1], MYSQL_KEYSTONE[0])])
+        self.assertEqual(self.engine.wait(timeout=5), {})
+        self.juju.add_relation.assert_called_once_with(*MYSQL_KEYSTONE)
+        self.assertEqual(futures[MYSQL_GLANCE].result(), 0)
+        self.assertEqual(futures[MYSQL_KEYSTONE].result(), 1)
+
+    def test_nothing_missing_done_at_once(self):
+        self.juju_state.relate(*MYSQL_GLANCE)
+        self.engine.start([MYSQL_GLANCE])
+        self.assertTrue(self.engine.done.is_set())
+        self.assertFalse(self.juju.add_relation.called)
+
+    def test_retry_one_relation(self):
+        failures = [ServerError('service "keystone" not found', {})]
+
+        def add_relation(a, b):
+            if 'keystone' in b and len(failures) > 0:
+                raise failures.pop()
+            self.juju_state.relate(a, b)
+        self.juju.add_relation.side_effect = add_relation
+
+        futures = self.engine.start([MYSQL_GLANCE, GLANCE_KEYSTONE])
+        self.assertEqual(self.engine.wait(timeout=5), {})
+        self.assertEqual(futures[MYSQL_GLANCE].result(), 1)
+        self.assertEqual(futures[GLANCE_KEYSTONE].result(), 2)
+
+    def test_already_exists_is_success(self):
+        self.juju.add_relation.side_effect = ServerError(
+            'cannot add relation: relation already exists', {})
+        futures = self.engine.start([MYSQL_GLANCE])
+        self.assertEqual(self.engine.wait(timeout=5), {})
+        self.assertEqual(futures[MYSQL_GLANCE].result(), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        error = ServerError('no such endpoint', {})
+        self.juju.add_relation.side_effect = error
+        self.engine.start([MYSQL_GLANCE])
+        self.assertEqual(self.engine.wait(timeout=5), {MYSQL_GLANCE: error})
+        self.assertEqual(self.juju.add_relation.call_count, 3)
+        self.assertTrue(self.engine.gave_up(*MYSQL_GLANCE))
+        self.assertTrue(self.engine.gave_up(MYSQL_GLANCE[1], MYSQL_GLANCE[0]))
+        self.assertFalse(self.engine.gave_up(*MYSQL_KEYSTONE))
+
+    def test_concurrent(self):
+        both_running = threading.Barrier(2, timeout=5)
+
+        def add_relation(a, b):
+            both_running.wait()
+            self.juju_state.relate(a, b)
+        self.juju.add_relation.side_effect = add_relation
+
+        self.engine.start([MYSQL_GLANCE, MYSQL_KEYSTONE])
+        self.assertEqual(self.engine.wait(timeout=5), {})
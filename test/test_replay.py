@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# tests replay.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloudinstall.juju import JujuState
+from cloudinstall.maas import MaasState
+from cloudinstall.replay import (Recorder, read_recording, ReplayClock,
+                                 ReplayJujuClient, ReplayMaasClient)
+
+log = logging.getLogger('cloudinstall.test_replay')
+
+
+def juju_status(state):
+    return {'Machines': {'1': {'Id': '1', 'AgentState': state}},
+            'Services': {}}
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json.gz')
+        os.close(fd)
+        os.unlink(self.path)
+        with patch('cloudinstall.replay.time') as mock_time:
+            mock_time.time.side_effect = [100, 101, 110, 130]
+            recorder = Recorder(self.path)
+            recorder.record('juju', juju_status('pending'))
+            recorder.record('maas', [{'hostname': 'a', 'status': 4}])
+            recorder.record('juju', juju_status('started'))
+            recorder.record('juju', juju_status('down'))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_read_recording(self):
+        records = list(read_recording(self.path))
+        self.assertEqual([(t, s) for t, s, _ in records],
+                         [(100, 'juju'), (101, 'maas'), (110, 'juju'),
+                          (130, 'juju')])
+        self.assertEqual(len(list(read_recording(self.path, 'maas'))), 1)
+
+    def test_truncated_recording(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-10])
+        self.assertEqual(len(list(read_recording(self.path))), 3)
+
+    def test_step_replay(self):
+        juju = ReplayJujuClient(self.path, ReplayClock(speed=0))
+        states = [juju.status()['Machines']['1']['AgentState']
+                  for _ in range(4)]
+        self.assertEqual(states, ['pending', 'started', 'down', 'down'])
+        self.assertTrue(juju.source.finished)
+
+    @patch('cloudinstall.replay.time')
+    def test_accelerated_replay(self, mock_time):
+        clock = ReplayClock(speed=10)
+        juju = ReplayJujuClient(self.path, clock)
+
+        def state_at(wall):
+            mock_time.time.return_value = wall
+            return juju.status()['Machines']['1']['AgentState']
+
+        self.assertEqual(state_at(1000), 'pending')
+        self.assertEqual(state_at(1000.9), 'pending')
+        self.assertEqual(state_at(1001), 'started')
+        self.assertEqual(state_at(1003), 'down')
+
+    def test_replay_through_state(self):
+        clock = ReplayClock(speed=0)
+        js = JujuState(ReplayJujuClient(self.path, clock))
+        self.assertEqual(js.machine('1').agent_state, 'pending')
+        ms = MaasState(ReplayMaasClient(self.path, clock))
+        self.assertEqual([m.hostname for m in ms.machines()], ['a'])
+
+    def test_writes_are_ignored(self):
+        juju = ReplayJujuClient(self.path, ReplayClock())
+        self.assertEqual(juju.deploy('cs:trusty/mysql', 'mysql', 1), {})
+        maas = ReplayMaasClient(self.path, ReplayClock())
+        self.assertEqual(maas.nodes_accept_all(), {})
+
+
+class RecordingStateTestCase(unittest.TestCase):
+
+    def test_records_each_new_juju_status(self):
+        juju = MagicMock()
+        juju.status.return_value = juju_status('pending')
+        js = JujuState(juju)
+        js.recorder = MagicMock()
+        js.machines()
+        js.machines()
+        js.machines(max_age=0)
+        self.assertEqual(js.recorder.record.call_count, 1)
+        juju.status.return_value = juju_status('started')
+        js.machines(max_age=0)
+        js.recorder.record.assert_called_with('juju',
+                                              juju_status('started'))
+
+    def test_records_maas_nodes(self):
+        maas = MagicMock()
+        maas.nodes = [{'hostname': 'a'}]
+        ms = MaasState(maas)
+        ms.recorder = MagicMock()
+        ms.nodes()
+        ms.nodes()
+        ms.recorder.record.assert_called_once_with('maas',
+                                                   [{'hostname': 'a'}])
+
+    def test_invalidated_maas_nodes_recorded_once(self):
+        sync = MagicMock()
+        sync.nodes.return_value = [{'hostname': 'a'}]
+        ms = MaasState(MagicMock(), sync=sync)
+        ms.recorder = MagicMock()
+        ms.nodes()
+        ms.invalidate_nodes_cache()
+        ms.nodes()
+        self.assertEqual(sync.nodes.call_count, 2)
+        ms.recorder.record.assert_called_once_with('maas',
+                                                   [{'hostname': 'a'}])
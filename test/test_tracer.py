@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# tests tracer.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cloudinstall import tracer
+from cloudinstall.tracer import NULL_SPAN, Span, Tracer
+
+
+def make_span(trace, name, start, end, parent=None, cat='deploy'):
+    """ A finished span at fixed times, relative to the trace epoch """
+    span = trace.span(name, parent=parent, cat=cat)
+    span.start = trace.epoch + start
+    span.end = trace.epoch + end
+    return span
+
+
+class TracerDisabledTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tracer.set_tracer(None)
+
+    def test_null_span(self):
+        with tracer.span('phase', attr=1) as span:
+            span.set(result=True)
+        self.assertIs(span, NULL_SPAN)
+        self.assertIs(tracer.current_span(), NULL_SPAN)
+
+    def test_traced_calls_through(self):
+        @tracer.traced()
+        def f(x):
+            return x + 1
+        self.assertEqual(f(1), 2)
+        self.assertEqual(f.__name__, 'f')
+
+
+class TracerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trace = Tracer()
+        tracer.set_tracer(self.trace)
+
+    def tearDown(self):
+        tracer.set_tracer(None)
+
+    def test_nesting(self):
+        with tracer.span('outer') as outer:
+            with tracer.span('inner', charm='mysql') as inner:
+                self.assertIs(tracer.current_span(), inner)
+            self.assertIs(tracer.current_span(), outer)
+        self.assertIsInstance(outer, Span)
+        self.assertIs(inner.parent, outer)
+        self.assertIsNone(outer.parent)
+        self.assertEqual(inner.attrs, {'charm': 'mysql'})
+        self.assertIsNotNone(inner.end)
+        self.assertIs(tracer.current_span(), NULL_SPAN)
+
+    def test_error_recorded(self):
+        with self.assertRaises(ValueError):
+            with tracer.span('failing') as span:
+                raise ValueError('boom')
+        self.assertEqual(span.attrs['error'], repr(ValueError('boom')))
+        self.assertIsNotNone(span.end)
+
+    def test_parent_from_other_thread(self):
+        spans = []
+        with tracer.span('fan out') as parent:
+            def work():
+                with tracer.span('machine', parent=parent) as span:
+                    spans.append(span)
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+        self.assertIs(spans[0].parent, parent)
+        self.assertNotEqual(spans[0].tid, parent.tid)
+
+    def test_traced(self):
+        @tracer.traced('named', kind='phase')
+        def f():
+            return tracer.current_span()
+        span = f()
+        self.assertEqual(span.name, 'named')
+        self.assertEqual(span.attrs, {'kind': 'phase'})
+
+    def test_chrome_trace(self):
+        root = make_span(self.trace, 'begin_deployment', 0, 2)
+        make_span(self.trace, 'deploy mysql', 0.5, 1.5, parent=root)
+        open_span = self.trace.span('post processing')
+        doc = json.loads(json.dumps(self.trace.chrome_trace()))
+        events = [e for e in doc['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual([(e['name'], e['ts'], e['dur']) for e in events[:2]],
+                         [('begin_deployment', 0, 2000000),
+                          ('deploy mysql', 500000, 1000000)])
+        self.assertEqual(events[1]['args']['parent'], root.span_id)
+        self.assertTrue(events[2]['args']['unfinished'])
+        self.assertEqual(events[2]['tid'], open_span.tid)
+        meta = [e for e in doc['traceEvents'] if e['ph'] == 'M']
+        self.assertEqual(meta[0]['args']['name'],
+                         threading.current_thread().name)
+
+    def test_critical_path(self):
+        root = make_span(self.trace, 'begin', 0, 10)
+        make_span(self.trace, 'machines', 0, 3, parent=root)
+        deploy = make_span(self.trace, 'deploy', 3, 8, parent=root)
+        make_span(self.trace, 'deploy mysql', 3, 5, parent=deploy)
+        make_span(self.trace, 'deploy ntp', 3, 4, parent=deploy)
+        make_span(self.trace, 'deploy keystone', 5, 7, parent=deploy)
+        make_span(self.trace, 'task', 0, 10, cat='task')
+        path = [(names, round(seconds, 3)) for names, seconds in
+                self.trace.critical_path()]
+        self.assertEqual(path, [
+            (('begin', 'machines'), 3),
+            (('begin', 'deploy', 'deploy mysql'), 2),
+            (('begin', 'deploy', 'deploy keystone'), 2),
+            (('begin', 'deploy'), 1),
+            (('begin',), 2)])
+
+    def test_critical_path_between_roots(self):
+        make_span(self.trace, 'relations', 0, 2)
+        make_span(self.trace, 'post processing', 3, 4)
+        path = [(names, round(seconds, 3)) for names, seconds in
+                self.trace.critical_path()]
+        self.assertEqual(path, [(('relations',), 2), ((), 1),
+                                (('post processing',), 1)])
+
+    def test_write(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        fname = os.path.join(tempdir, 'trace.json')
+        make_span(self.trace, 'begin', 0, 1)
+        self.trace.write(fname)
+        with open(fname) as f:
+            self.assertEqual(len(json.load(f)['traceEvents']), 2)
+        with open(fname + '.critical-path') as f:
+            summary = f.read()
+        self.assertIn('Critical path: 1.0 sec', summary)
+        self.assertIn('100.0%  begin', summary)
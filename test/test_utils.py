@@ -22,14 +22,17 @@ from jinja2 import Environment, FileSystemLoader
 import logging
 import os
 from subprocess import PIPE
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import threading
 import unittest
-from unittest.mock import patch, PropertyMock
+from unittest.mock import MagicMock, patch, PropertyMock
 import yaml
 
 
 from cloudinstall.utils import (render_charm_config,
-                                merge_dicts, slurp, get_command_output)
+                                merge_dicts, slurp, get_command_output,
+                                RemoteSession, remote_fan_out,
+                                remote_fan_out_failures, remote_run)
 from cloudinstall.config import Config
 
 
@@ -161,3 +164,150 @@ class TestGetCommandOutput(unittest.TestCase):
         mock_Popen.side_effect = OSError()
         with self.assertRaises(OSError):
             get_command_output('foo')
+
+
+def local_juju_ssh(command):
+    """ Runs a RemoteSession script here instead of over juju ssh """
+    script = command.split('< ')[-1]
+    with open(script) as f:
+        text = f.read().replace('sudo -H bash', 'bash')
+    with NamedTemporaryFile('w', suffix='.sh') as f:
+        f.write(text)
+        f.flush()
+        return get_command_output('bash -s < ' + f.name)
+
+
+@patch('cloudinstall.utils.get_command_output', side_effect=local_juju_ssh)
+class TestRemoteSession(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.src = os.path.join(self.tempdir.name, 'src.sh')
+        with open(self.src, 'w') as f:
+            f.write('echo hello from $0\n')
+        os.chmod(self.src, 0o750)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_one_connection(self, mock_output):
+        dst = os.path.join(self.tempdir.name, 'remote', 'dst.sh')
+        session = RemoteSession('1', 'JUJU_HOME=fake')
+        session.put(self.src, dst)
+        session.run(dst)
+        session.run(['echo one', 'echo two >&2', 'exit 3'])
+        session.run('echo after')
+        results = session.execute()
+
+        self.assertEqual(mock_output.call_count, 1)
+        self.assertTrue(mock_output.call_args[0][0].startswith(
+            'JUJU_HOME=fake juju ssh --pty=false 1 bash -s < '))
+        self.assertEqual(os.stat(dst).st_mode & 0o777, 0o750)
+        self.assertEqual([(r['status'], r['output']) for r in results],
+                         [(0, 'hello from {}\n'.format(dst)),
+                          (3, 'one\ntwo\n'),
+                          (0, 'after\n')])
+
+    def test_stop_on_error(self, mock_output):
+        session = RemoteSession('1', 'JUJU_HOME=fake', stop_on_error=True)
+        session.run('false')
+        session.run('echo skipped')
+        results = session.execute()
+        self.assertEqual([r['status'] for r in results], [1, None])
+
+    def test_remote_run_wrapper(self, mock_output):
+        ret = remote_run('1', ['echo a', 'echo b'], 'JUJU_HOME=fake')
+        self.assertEqual(ret, dict(status=0, output='a\nb\n', err=''))
+
+    def test_carriage_returns_stripped(self, mock_output):
+        def crlf_output(command):
+            ret = local_juju_ssh(command)
+            return dict(ret, output=ret['output'].replace('\n', '\r\n'))
+        mock_output.side_effect = crlf_output
+        session = RemoteSession('1', 'JUJU_HOME=fake')
+        session.run('echo 10.0.3.1')
+        self.assertEqual(session.execute(),
+                         [dict(status=0, output='10.0.3.1\n', err='')])
+
+    def test_session_killed(self, mock_output):
+        session = RemoteSession('1', 'JUJU_HOME=fake')
+        session.run('echo done')
+        session.run('echo partial; kill -9 $PPID')
+        session.run('echo never')
+        results = session.execute()
+        self.assertEqual([r['output'] for r in results],
+                         ['done\n', 'partial\n', ''])
+        self.assertEqual(results[0]['status'], 0)
+        self.assertNotIn(results[1]['status'], (0, None))
+        self.assertIsNone(results[2]['status'])
+
+    def test_truncated_output(self, mock_output):
+        def truncated(command):
+            ret = local_juju_ssh(command)
+            output = ret['output']
+            return dict(ret, output=output[:output.rindex(' end 0 ')])
+        mock_output.side_effect = truncated
+        session = RemoteSession('1', 'JUJU_HOME=fake')
+        session.run('echo cut off')
+        results = session.execute()
+        self.assertEqual(results[0]['status'], -1)
+        self.assertTrue(results[0]['output'].startswith('cut off\n'))
+
+    def test_connection_failure(self, mock_output):
+        mock_output.side_effect = None
+        mock_output.return_value = dict(status=255, output='',
+                                        err='ERROR no such machine')
+        session = RemoteSession('9', 'JUJU_HOME=fake')
+        session.run('true')
+        self.assertEqual(session.execute(),
+                         [dict(status=255, output='',
+                               err='ERROR no such machine')])
+
+
+class TestRemoteFanOut(unittest.TestCase):
+
+    def session(self, machine_id, execute):
+        session = MagicMock(name='session{}'.format(machine_id))
+        session.machine_id = machine_id
+        session.execute.side_effect = execute
+        return session
+
+    def test_failures_do_not_block_others(self):
+        both_running = threading.Barrier(2, timeout=5)
+
+        def ok():
+            both_running.wait()
+            return [dict(status=0, output='', err='')]
+
+        def fails():
+            both_running.wait()
+            return [dict(status=1, output='oops', err='')]
+
+        def raises():
+            raise OSError('no juju')
+
+        report = remote_fan_out([self.session('1', ok),
+                                 self.session('2', fails),
+                                 self.session('3', raises)])
+        self.assertEqual(report['1']['results'][0]['status'], 0)
+        self.assertEqual(report['2']['results'][0]['status'], 1)
+        self.assertIsNone(report['3']['results'])
+        self.assertIsInstance(report['3']['error'], OSError)
+        for r in report.values():
+            self.assertGreaterEqual(r['elapsed'], 0)
+
+    def test_failures(self):
+        ok = dict(status=0, output='', err='')
+        report = {
+            '1': dict(results=[ok, ok], error=None),
+            '2': dict(results=[ok, dict(status=255, output='',
+                                        err='ERROR no such machine\n')],
+                      error=None),
+            '3': dict(results=[dict(status=1, output='oops\n', err=''),
+                               dict(status=None, output='', err='')],
+                      error=None),
+            '4': dict(results=None, error=OSError('no juju'))}
+        self.assertEqual(remote_fan_out_failures(report), {
+            '2': 'command 1 exited 255: ERROR no such machine',
+            '3': 'command 0 exited 1: oops',
+            '4': repr(OSError('no juju'))})